@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Measure throughput of one shared TensorflowRep driven by many threads.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from onnx_tf.backend import prepare
+from models import make_conv_model
+
+
+def run_threads(tf_rep, x, num_threads, runs_per_thread):
+  """Run the model from num_threads threads and return runs per second."""
+
+  def worker():
+    for _ in range(runs_per_thread):
+      tf_rep.run(x)
+
+  threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return num_threads * runs_per_thread / (time.time() - start)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+  parser.add_argument("--runs", type=int, default=200)
+  parser.add_argument("--size", type=int, default=28)
+  args = parser.parse_args()
+
+  model = make_conv_model(size=args.size)
+  x = np.random.randn(1, 16, args.size, args.size).astype(np.float32)
+  with prepare(model) as tf_rep:
+    # Warm up the session and the compiled callable.
+    tf_rep.run(x)
+    base = None
+    print("threads\truns/s\tspeedup")
+    for num_threads in args.threads:
+      throughput = run_threads(tf_rep, x, num_threads, args.runs)
+      base = base or throughput
+      print("{}\t{:.1f}\t{:.2f}x".format(num_threads, throughput,
+                                        throughput / base))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Time the conversion of chains of elementwise nodes of growing length to
+check that it scales linearly with the number of nodes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+from onnx_tf.backend import TensorflowBackendBase
+from models import make_chain_model
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      "--nodes", type=int, nargs="+", default=[1000, 10000, 100000])
+  args = parser.parse_args()
+
+  print("nodes\tconvert_s\tus_per_node")
+  for nodes in args.nodes:
+    model = make_chain_model(nodes)
+    start = time.time()
+    TensorflowBackendBase.onnx_graph_to_tensorflow_net(
+        model.graph, opset=model.opset_import[0].version)
+    convert_time = time.time() - start
+    print("{}\t{:.2f}\t{:.1f}".format(nodes, convert_time,
+                                      convert_time / nodes * 1e6))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Time the dispatch of ONNX nodes to their handlers and the conversion of
+a long chain of elementwise nodes, with the handler registry and with the
+former per-node dispatch.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import importlib
+import re
+import time
+
+from onnx_tf.backend import TensorflowBackendBase, prepare
+from onnx_tf.common import ONNX_OP_TO_TF_OP
+from onnx_tf.opset_version import backend_opset_version
+from models import make_chain_model
+
+
+def legacy_get_handler(cls, op_type, opset):
+  # Dispatch formerly run for every node.
+  op_name_lowered = re.sub('(?<!^)(?=[A-Z])', '_', op_type).lower()
+  handler_name = "handle_" + op_name_lowered
+  versions = backend_opset_version[op_name_lowered]
+  if opset == 0:
+    version = max(versions)
+  else:
+    versions = sorted(versions + [opset])
+    version = versions[max([i for i, v in enumerate(versions) if v == opset])
+                       - 1]
+  backend_ver = 'backend_v{}'.format(version)
+  backend = cls.backend_version_cache.setdefault(
+      backend_ver,
+      importlib.import_module('onnx_tf.backends.' +
+                              backend_ver).TensorflowBackend)
+  if hasattr(backend, handler_name):
+    return getattr(backend, handler_name)
+  elif op_name_lowered in ONNX_OP_TO_TF_OP.keys():
+    return backend.handle_trivial
+  raise NotImplementedError("{} op is not implemented.".format(op_type))
+
+
+def time_dispatch(get_handler, op_types, opset):
+  start = time.time()
+  for op_type in op_types:
+    get_handler(op_type, opset)
+  return time.time() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--nodes", type=int, default=10000)
+  args = parser.parse_args()
+
+  model = make_chain_model(args.nodes)
+  opset = model.opset_import[0].version
+  op_types = [node.op_type for node in model.graph.node]
+  registry = TensorflowBackendBase.__dict__["_get_handler"]
+  legacy = classmethod(legacy_get_handler)
+
+  print("dispatch\tdispatch_us_per_node\tprepare_s")
+  for name, get_handler in [("legacy", legacy), ("registry", registry)]:
+    TensorflowBackendBase._get_handler = get_handler
+    try:
+      dispatch_time = time_dispatch(TensorflowBackendBase._get_handler,
+                                    op_types, opset)
+      start = time.time()
+      prepare(model).close()
+      prepare_time = time.time() - start
+    finally:
+      TensorflowBackendBase._get_handler = registry
+    print("{}\t{:.2f}\t{:.2f}".format(name, dispatch_time / len(op_types) * 1e6,
+                                      prepare_time))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Time the conversion and the run of a ShuffleNet style model, whose
+grouped convs are converted to depthwise convs and batched matmuls, against
+the same model with every grouped conv split into one Conv per group, the
+way grouped convs used to be converted.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+import numpy as np
+from onnx import helper
+
+from onnx_tf.backend import prepare
+from models import make_shufflenet_model
+
+
+def split_grouped_convs(model):
+  """Rewrite every grouped Conv of model as Split, one Conv per group and
+  Concat along the channels."""
+  initializers = dict((tp.name, tp) for tp in model.graph.initializer)
+  nodes = []
+  for node in model.graph.node:
+    attrs = dict((attr.name, helper.get_attribute_value(attr))
+                 for attr in node.attribute)
+    group = attrs.pop("group", 1)
+    if node.op_type != "Conv" or group == 1:
+      nodes.append(node)
+      continue
+    out_channels = initializers[node.input[1]].dims[0]
+    in_channels = initializers[node.input[1]].dims[1] * group
+    names = lambda what: [
+        "{}_{}{}".format(node.output[0], what, g) for g in range(group)
+    ]
+    nodes.append(
+        helper.make_node(
+            "Split", [node.input[0]], names("x"),
+            axis=1,
+            split=[in_channels // group] * group))
+    nodes.append(
+        helper.make_node(
+            "Split", [node.input[1]], names("w"),
+            axis=0,
+            split=[out_channels // group] * group))
+    nodes.append(
+        helper.make_node(
+            "Split", [node.input[2]], names("b"),
+            axis=0,
+            split=[out_channels // group] * group))
+    for x, w, b, y in zip(names("x"), names("w"), names("b"), names("y")):
+      nodes.append(helper.make_node("Conv", [x, w, b], [y], **attrs))
+    nodes.append(helper.make_node("Concat", names("y"), node.output, axis=1))
+  legacy_model = helper.make_model(
+      helper.make_graph(nodes, model.graph.name, model.graph.input,
+                        model.graph.output, model.graph.initializer))
+  return legacy_model
+
+
+def benchmark(model, x, runs):
+  start = time.time()
+  tf_rep = prepare(model)
+  prepare_time = time.time() - start
+  with tf_rep:
+    y = tf_rep.run(x).Y
+    start = time.time()
+    for _ in range(runs):
+      tf_rep.run(x)
+    latency = (time.time() - start) / runs
+    ops = len(tf_rep.predict_net.graph.get_operations())
+  return prepare_time, ops, latency, y
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--batch-size", type=int, default=1)
+  parser.add_argument("--size", type=int, default=224)
+  parser.add_argument("--channels", type=int, default=240)
+  parser.add_argument("--groups", type=int, default=3)
+  parser.add_argument("--units", type=int, default=8)
+  parser.add_argument("--runs", type=int, default=20)
+  args = parser.parse_args()
+
+  model = make_shufflenet_model(args.batch_size, args.channels, args.size,
+                                args.groups, args.units)
+  x = np.random.randn(args.batch_size, 3, args.size,
+                      args.size).astype(np.float32)
+  results = [("split", benchmark(split_grouped_convs(model), x, args.runs)),
+             ("grouped", benchmark(model, x, args.runs))]
+  np.testing.assert_allclose(results[0][1][3], results[1][1][3], rtol=1e-4,
+                             atol=1e-4)
+
+  print("conversion\tprepare_s\ttf_ops\tlatency_ms")
+  for name, (prepare_time, ops, latency, _) in results:
+    print("{}\t{:.2f}\t{}\t{:.2f}".format(name, prepare_time, ops,
+                                          latency * 1e3))
+
+
+if __name__ == '__main__':
+  main()
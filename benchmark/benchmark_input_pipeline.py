@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Measure bulk scoring of samples stored as .npy files, fed batch by batch
+through run or read by the tf.data pipeline of run_pipeline.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from onnx_tf.backend import prepare
+from models import make_conv_model
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--samples", type=int, default=4096)
+  parser.add_argument("--batch-size", type=int, default=32)
+  parser.add_argument("--size", type=int, default=28)
+  args = parser.parse_args()
+
+  model = make_conv_model(batch_size=-1, size=args.size)
+  source_dir = tempfile.mkdtemp()
+  try:
+    np.save(
+        os.path.join(source_dir, "X.npy"),
+        np.random.randn(args.samples, 16, args.size,
+                        args.size).astype(np.float32))
+    with prepare(model) as tf_rep:
+      x = np.load(os.path.join(source_dir, "X.npy"), mmap_mode="r")
+      tf_rep.run(np.asarray(x[:args.batch_size]))
+
+      start = time.time()
+      for i in range(0, args.samples, args.batch_size):
+        tf_rep.run(np.asarray(x[i:i + args.batch_size]))
+      base = args.samples / (time.time() - start)
+      print("mode\tsamples/s\tspeedup")
+      print("run\t{:.1f}\t1.00x".format(base))
+
+      start = time.time()
+      for _ in tf_rep.run_pipeline(source_dir, batch_size=args.batch_size):
+        pass
+      throughput = args.samples / (time.time() - start)
+      print("run_pipeline\t{:.1f}\t{:.2f}x".format(throughput,
+                                                 throughput / base))
+  finally:
+    shutil.rmtree(source_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Count the transposes run by a ResNet style model and time it, with and
+without prepare(optimize_layout=True).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from onnx_tf.backend import prepare
+from models import make_resnet_model
+
+
+def count_transposes(tf_rep):
+  """Number of Transpose ops on activations needed to compute the model
+  outputs. Transposes of constant weights are folded by Tensorflow and are
+  not counted."""
+  graph_def = tf_rep.predict_net.graph.as_graph_def()
+  outputs = [
+      tf_rep.predict_net.tensor_dict[name].op.name
+      for name in tf_rep.predict_net.external_output
+  ]
+  sub_graph = tf.graph_util.extract_sub_graph(graph_def, outputs)
+  ops = dict((node.name, node.op) for node in sub_graph.node)
+  return len([
+      node for node in sub_graph.node
+      if node.op == "Transpose" and ops[node.input[0].split(":")[0]] != "Const"
+  ])
+
+
+def time_run(tf_rep, x, runs):
+  tf_rep.run(x)
+  start = time.time()
+  for _ in range(runs):
+    tf_rep.run(x)
+  return (time.time() - start) / runs
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--batch-size", type=int, default=8)
+  parser.add_argument("--size", type=int, default=112)
+  parser.add_argument("--blocks", type=int, default=8)
+  parser.add_argument("--runs", type=int, default=20)
+  args = parser.parse_args()
+
+  model = make_resnet_model(args.batch_size, size=args.size, blocks=args.blocks)
+  x = np.random.randn(args.batch_size, 3, args.size,
+                      args.size).astype(np.float32)
+  results = {}
+  for optimize_layout in [False, True]:
+    with prepare(model, optimize_layout=optimize_layout) as tf_rep:
+      results[optimize_layout] = (count_transposes(tf_rep),
+                                  time_run(tf_rep, x, args.runs),
+                                  tf_rep.run(x).Y)
+  np.testing.assert_allclose(results[True][2], results[False][2], rtol=1e-4,
+                             atol=1e-4)
+
+  print("optimize_layout\ttransposes\tlatency_ms")
+  for optimize_layout in [False, True]:
+    transposes, latency, _ = results[optimize_layout]
+    print("{}\t{}\t{:.2f}".format(optimize_layout, transposes, latency * 1e3))
+  print("transposes removed: {}, latency saved: {:.1f}%".format(
+      results[False][0] - results[True][0],
+      100. * (1 - results[True][1] / results[False][1])))
+
+
+if __name__ == '__main__':
+  main()
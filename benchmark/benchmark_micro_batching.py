@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Measure throughput and latency of single sample requests from many
+concurrent clients, run directly on a shared TensorflowRep or coalesced by
+a MicroBatcher.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from onnx_tf.backend import prepare
+from onnx_tf.batching import MicroBatcher
+from models import make_conv_model
+
+
+def run_clients(run, x, num_clients, requests_per_client):
+  """Send requests from num_clients threads, return the p50 and p99
+  request latencies in ms and the requests per second."""
+  latencies = [[] for _ in range(num_clients)]
+
+  def client(i):
+    for _ in range(requests_per_client):
+      start = time.time()
+      run(x)
+      latencies[i].append((time.time() - start) * 1000)
+
+  threads = [
+      threading.Thread(target=client, args=(i,)) for i in range(num_clients)
+  ]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  latencies = np.concatenate(latencies)
+  return (np.percentile(latencies, 50), np.percentile(latencies, 99),
+          len(latencies) / elapsed)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      "--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+  parser.add_argument("--requests", type=int, default=50)
+  parser.add_argument("--max-batch-size", type=int, default=32)
+  parser.add_argument("--max-latency-ms", type=float, default=2.)
+  parser.add_argument("--size", type=int, default=28)
+  args = parser.parse_args()
+
+  model = make_conv_model(batch_size=-1, size=args.size)
+  x = np.random.randn(1, 16, args.size, args.size).astype(np.float32)
+  with prepare(model) as tf_rep:
+    # Warm up the session and the compiled callable.
+    tf_rep.run(x)
+    print("clients\tmode\tp50_ms\tp99_ms\trequests/s")
+    for num_clients in args.clients:
+      p50, p99, throughput = run_clients(tf_rep.run, x, num_clients,
+                                         args.requests)
+      print("{}\tdirect\t{:.2f}\t{:.2f}\t{:.1f}".format(
+          num_clients, p50, p99, throughput))
+      with MicroBatcher(
+          tf_rep,
+          max_batch_size=args.max_batch_size,
+          max_latency_ms=args.max_latency_ms) as batcher:
+        p50, p99, throughput = run_clients(batcher.run, x, num_clients,
+                                           args.requests)
+      print("{}\tbatched\t{:.2f}\t{:.2f}\t{:.1f}".format(
+          num_clients, p50, p99, throughput))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Compare in-graph padded pooling with the former tf.py_func fallback.
+
+Both paths pool a 224x224 input with SAME_LOWER and with explicit
+asymmetric pads; the script checks that they agree and reports the time
+of one run of each.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import itertools
+import time
+
+import numpy as np
+import tensorflow as tf
+from onnx import helper
+from onnx.onnx_pb2 import TensorProto
+
+from onnx_tf.backend import prepare
+from onnx_tf.backends.backend_v1 import TensorflowBackend
+
+
+def legacy_py_pool(x, kernel_shape, strides_shape, pads, out_shape, pad_shape,
+                   pooling_type):
+  # Pure Python pooling formerly run through tf.py_func.
+  pooling_type = pooling_type.decode('UTF-8')
+  x_shape = np.shape(x)
+  spatial_size = len(x_shape[2:])
+  pad_attr = [(0, 0), (0, 0)] + [
+      (pads[i], pads[i + spatial_size]) for i in range(spatial_size)
+  ]
+  padded = np.pad(x, pad_attr, mode="constant", constant_values=np.nan)
+  y = np.zeros([x_shape[0], x_shape[1]] + list(out_shape))
+  f = np.average if pooling_type == 'AVG' else np.max
+  for shape in itertools.product(
+      range(x_shape[0]), range(x_shape[1]), *[
+          range(
+              int((x_shape[i + 2] + pad_shape[i] - kernel_shape[i]) /
+                  strides_shape[i] + 1)) for i in range(spatial_size)
+      ]):
+    window = padded[shape[0], shape[1]]
+    window_vals = np.array([
+        window[i] for i in list(
+            itertools.product(*[
+                range(strides_shape[i] * shape[i + 2],
+                      strides_shape[i] * shape[i + 2] + kernel_shape[i])
+                for i in range(spatial_size)
+            ]))
+    ])
+    y[shape] = f(window_vals[np.where(~np.isnan(window_vals))])
+  return y.astype(np.float32)
+
+
+def legacy_pool(x_value, kernel_shape, strides, pads, pooling_type):
+  graph = tf.Graph()
+  with graph.as_default():
+    x = tf.placeholder(tf.float32, x_value.shape)
+    pad_shape = [pads[i] + pads[i + 2] for i in range(2)]
+    out_shape = [(x_value.shape[i + 2] + pad_shape[i] - kernel_shape[i]) //
+                 strides[i] + 1 for i in range(2)]
+    y = tf.py_func(legacy_py_pool, [
+        x, kernel_shape, strides, pads, out_shape, pad_shape, pooling_type
+    ], tf.float32)
+    with tf.Session() as sess:
+      start = time.time()
+      y_value = sess.run(y, {x: x_value})
+      return y_value, time.time() - start
+
+
+def new_pool(x_value, op_type, attrs):
+  graph_def = helper.make_graph(
+      [helper.make_node(op_type, ["X"], ["Y"], **attrs)], "pool",
+      [helper.make_tensor_value_info("X", TensorProto.FLOAT, x_value.shape)],
+      [helper.make_tensor_value_info("Y", TensorProto.FLOAT, None)])
+  with prepare(helper.make_model(graph_def)) as tf_rep:
+    tf_rep.run(x_value)
+    start = time.time()
+    y_value = tf_rep.run(x_value).Y
+    return y_value, time.time() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--channels", type=int, default=4)
+  parser.add_argument("--size", type=int, default=224)
+  args = parser.parse_args()
+
+  x = np.random.randn(1, args.channels, args.size,
+                      args.size).astype(np.float32)
+  kernel_shape, strides = [3, 3], [2, 2]
+  same_lower = TensorflowBackend._get_same_lower_pads(
+      [args.size, args.size], kernel_shape, strides)
+  cases = [
+      ("SAME_LOWER", {"auto_pad": "SAME_LOWER"}, same_lower),
+      ("pads", {"pads": [1, 0, 0, 1]}, [1, 0, 0, 1]),
+  ]
+  print("op\tpadding\tlegacy_s\tnew_s\tspeedup")
+  for op_type, pooling_type in [("MaxPool", "MAX"), ("AveragePool", "AVG")]:
+    for name, attrs, pads in cases:
+      attrs = dict(attrs, kernel_shape=kernel_shape, strides=strides)
+      y_new, t_new = new_pool(x, op_type, attrs)
+      y_old, t_old = legacy_pool(x, kernel_shape, strides, pads, pooling_type)
+      np.testing.assert_allclose(y_new, y_old, rtol=1e-5, atol=1e-6)
+      print("{}\t{}\t{:.3f}\t{:.5f}\t{:.0f}x".format(op_type, name, t_old,
+                                                   t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+  main()
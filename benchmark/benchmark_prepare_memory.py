@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Measure peak memory and wall time of prepare() on large initializers.
+
+Every model size is measured in a fresh subprocess so that the peak
+resident set size reported by getrusage belongs to that size only.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+from onnx import helper, numpy_helper
+from onnx.onnx_pb2 import TensorProto
+
+# Parameters per initializer, keeps every tensor well below 2GB.
+CHUNK = 10 * 1000 * 1000
+
+
+def make_model(num_params):
+  """A graph summing num_params float parameters split in chunks."""
+  initializers = []
+  inputs = []
+  nodes = []
+  acc = None
+  for i in range(int(np.ceil(num_params / CHUNK))):
+    size = min(CHUNK, num_params - i * CHUNK)
+    name = "W{}".format(i)
+    initializers.append(
+        numpy_helper.from_array(np.ones([size], dtype=np.float32), name))
+    inputs.append(helper.make_tensor_value_info(name, TensorProto.FLOAT,
+                                                [size]))
+    out = "S{}".format(i)
+    nodes.append(helper.make_node("ReduceSum", [name], [out], keepdims=0))
+    if acc is not None:
+      nodes.append(helper.make_node("Add", [acc, out], ["A{}".format(i)]))
+      out = "A{}".format(i)
+    acc = out
+  graph_def = helper.make_graph(
+      nodes,
+      "large_initializers",
+      inputs, [helper.make_tensor_value_info(acc, TensorProto.FLOAT, [])],
+      initializer=initializers)
+  return helper.make_model(graph_def)
+
+
+def legacy_initializer_to_input_dict_items(cls,
+                                           initializer,
+                                           init_net_name='init'):
+  # The conversion used before initializers went through NumPy buffers.
+  import onnx.numpy_helper
+  import tensorflow as tf
+  from onnx_tf.common import ONNX_TYPE_TO_TF_TYPE
+  return [(tp.name,
+           tf.constant(
+               onnx.numpy_helper.to_array(tp).flatten().tolist(),
+               shape=tp.dims,
+               dtype=ONNX_TYPE_TO_TF_TYPE[tp.data_type])) for tp in initializer]
+
+
+def max_rss_mb():
+  # ru_maxrss is in kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(num_params, legacy):
+  from onnx_tf.backend import TensorflowBackendBase, prepare
+  if legacy:
+    TensorflowBackendBase.onnx_initializer_to_input_dict_items = classmethod(
+        legacy_initializer_to_input_dict_items)
+  model = make_model(num_params)
+  before = max_rss_mb()
+  start = time.time()
+  prepare(model)
+  elapsed = time.time() - start
+  print("{}\t{:.2f}\t{:.0f}\t{:.0f}".format(num_params, elapsed, before,
+                                            max_rss_mb()))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      "--params",
+      type=int,
+      nargs="+",
+      default=[10 * 1000 * 1000, 100 * 1000 * 1000, 500 * 1000 * 1000])
+  parser.add_argument(
+      "--legacy",
+      action="store_true",
+      help="convert initializers through Python lists as onnx-tf used to")
+  parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child is not None:
+    measure(args.child, args.legacy)
+    return
+
+  print("params\tprepare_s\trss_before_mb\tpeak_rss_mb")
+  for num_params in args.params:
+    cmd = [sys.executable, __file__, "--child", str(num_params)]
+    if args.legacy:
+      cmd.append("--legacy")
+    sys.stdout.flush()
+    subprocess.check_call(cmd)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measure offline scoring of a stream of samples with TensorflowRep.run_iter
+against a plain Python loop calling run on every sample.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+import numpy as np
+
+from onnx_tf.backend import prepare
+from models import make_conv_model
+
+
+def generate_samples(num_samples, size):
+  """Yield samples the way a reader would, one freshly decoded array at a
+  time."""
+  for _ in range(num_samples):
+    yield np.random.randn(16, size, size).astype(np.float32)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--samples", type=int, default=2000)
+  parser.add_argument("--batch-sizes", type=int, nargs="+",
+                      default=[1, 8, 32, 128])
+  parser.add_argument("--prefetch", type=int, default=2)
+  parser.add_argument("--size", type=int, default=28)
+  args = parser.parse_args()
+
+  model = make_conv_model(batch_size=-1, size=args.size)
+  with prepare(model) as tf_rep:
+    # Warm up the session and the compiled callable.
+    tf_rep.run(np.zeros([1, 16, args.size, args.size], np.float32))
+
+    start = time.time()
+    for x in generate_samples(args.samples, args.size):
+      tf_rep.run(x[np.newaxis])
+    base = args.samples / (time.time() - start)
+    print("mode\tbatch_size\tsamples/s\tspeedup")
+    print("loop\t1\t{:.1f}\t1.00x".format(base))
+
+    for batch_size in args.batch_sizes:
+      start = time.time()
+      for _ in tf_rep.run_iter(
+          generate_samples(args.samples, args.size),
+          batch_size=batch_size,
+          prefetch=args.prefetch):
+        pass
+      throughput = args.samples / (time.time() - start)
+      print("run_iter\t{}\t{:.1f}\t{:.2f}x".format(batch_size, throughput,
+                                                   throughput / base))
+
+
+if __name__ == '__main__':
+  main()
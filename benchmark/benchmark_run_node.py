@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Time repeated run_node calls on the same node signature, which reuse the
+graph and session cached by the first call, against the former behavior of
+building a graph and a session on every call.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+from onnx import helper
+
+from onnx_tf.backend import OnnxNode, TensorflowBackendBase, run_node
+
+
+def legacy_run_node(node, inputs):
+  # run_node formerly converted the node in a new graph and session.
+  node_graph = tf.Graph()
+  with node_graph.as_default():
+    node = OnnxNode(node)
+    input_dict = dict(
+        (name, tf.constant(value)) for name, value in zip(node.inputs, inputs))
+    ops = TensorflowBackendBase._onnx_node_to_tensorflow_op(node, input_dict)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      return sess.run(ops)
+
+
+def time_calls(func, node, inputs, calls):
+  start = time.time()
+  for _ in range(calls):
+    func(node, inputs)
+  return (time.time() - start) / calls
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--calls", type=int, default=200)
+  args = parser.parse_args()
+
+  cases = [
+      (helper.make_node("Relu", ["X"], ["Y"]), [[8, 16]]),
+      (helper.make_node("Add", ["X", "Y"], ["Z"]), [[8, 16], [8, 16]]),
+      (helper.make_node(
+          "Conv", ["X", "W"], ["Y"], kernel_shape=[3, 3], pads=[1, 1, 1, 1]),
+       [[1, 8, 16, 16], [8, 8, 3, 3]]),
+  ]
+  print("op\tlegacy_ms\tcached_ms\tspeedup")
+  for node, shapes in cases:
+    inputs = [np.random.randn(*shape).astype(np.float32) for shape in shapes]
+    np.testing.assert_allclose(
+        run_node(node, inputs)[0], legacy_run_node(node, inputs)[0],
+        rtol=1e-5, atol=1e-5)
+    legacy = time_calls(legacy_run_node, node, inputs, args.calls // 10)
+    cached = time_calls(run_node, node, inputs, args.calls)
+    print("{}\t{:.3f}\t{:.3f}\t{:.0f}x".format(node.op_type, legacy * 1e3,
+                                             cached * 1e3, legacy / cached))
+
+
+if __name__ == '__main__':
+  main()
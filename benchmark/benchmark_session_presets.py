@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Compare the session presets of prepare on CPU for a conv model and an
+LSTM model: latency of one client and throughput of many concurrent ones.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from onnx_tf.backend import prepare
+from onnx_tf.session_config import SESSION_PRESETS
+from models import make_conv_model, make_lstm_model
+
+
+def get_model_and_input(name, size):
+  if name == "conv":
+    x = np.random.randn(1, 16, size, size).astype(np.float32)
+    return make_conv_model(size=size), x
+  if name == "lstm":
+    x = np.random.randn(32, 1, 64).astype(np.float32)
+    return make_lstm_model(seq_length=32, input_size=64), x
+  raise ValueError("Unknown model {}.".format(name))
+
+
+def measure_latency(tf_rep, x, runs):
+  """Return the p50 and p99 latencies of runs sequential runs, in ms."""
+  latencies = []
+  for _ in range(runs):
+    start = time.time()
+    tf_rep.run(x)
+    latencies.append((time.time() - start) * 1000)
+  return np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def measure_throughput(tf_rep, x, num_threads, runs):
+  """Return the runs per second of num_threads threads running the model
+  runs times in total."""
+
+  def worker():
+    for _ in range(runs // num_threads):
+      tf_rep.run(x)
+
+  threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return runs // num_threads * num_threads / (time.time() - start)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      "--models", nargs="+", default=["conv", "lstm"], choices=["conv", "lstm"])
+  parser.add_argument(
+      "--presets", nargs="+", default=["default"] + SESSION_PRESETS,
+      choices=["default"] + SESSION_PRESETS)
+  parser.add_argument("--runs", type=int, default=200)
+  parser.add_argument("--threads", type=int, default=8)
+  parser.add_argument("--size", type=int, default=56)
+  args = parser.parse_args()
+
+  print("model\tpreset\tp50_ms\tp99_ms\truns/s@{}".format(args.threads))
+  for name in args.models:
+    model, x = get_model_and_input(name, args.size)
+    for preset in args.presets:
+      session_preset = None if preset == "default" else preset
+      with prepare(model, session_preset=session_preset) as tf_rep:
+        # Warm up the session, the compiled callable and the JIT.
+        for _ in range(5):
+          tf_rep.run(x)
+        p50, p99 = measure_latency(tf_rep, x, args.runs)
+        throughput = measure_throughput(tf_rep, x, args.threads, args.runs)
+      print("{}\t{}\t{:.2f}\t{:.2f}\t{:.1f}".format(name, preset, p50, p99,
+                                                  throughput))
+
+
+if __name__ == '__main__':
+  main()
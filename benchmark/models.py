@@ -0,0 +1,284 @@
+"""Synthetic ONNX models shared by the benchmark scripts.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+from onnx import helper, numpy_helper
+from onnx.onnx_pb2 import TensorProto
+
+
+def _initializer(name, shape, scale=0.1):
+  value = (np.random.randn(*shape) * scale).astype(np.float32)
+  return numpy_helper.from_array(value, name)
+
+
+def make_chain_model(nodes=1000):
+  """Build a chain of cheap elementwise nodes, the binary ones adding or
+  multiplying the model input.
+
+  :param nodes: number of nodes of the chain.
+
+  :returns: an ONNX ModelProto with input "X" and output "Y".
+  """
+  op_types = ["Relu", "Sigmoid", "Neg", "Abs", "Exp", "Tanh", "Add", "Mul"]
+  node_defs = []
+  x = "X"
+  for i in range(nodes):
+    op_type = op_types[i % len(op_types)]
+    y = "Y" if i == nodes - 1 else "t{}".format(i)
+    inputs = [x, "X"] if op_type in ("Add", "Mul") else [x]
+    node_defs.append(helper.make_node(op_type, inputs, [y]))
+    x = y
+  graph_def = helper.make_graph(
+      node_defs, "chain_model",
+      [helper.make_tensor_value_info("X", TensorProto.FLOAT, [1, 4])],
+      [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [1, 4])])
+  return helper.make_model(graph_def)
+
+
+def make_conv_model(batch_size=1, channels=16, size=56, depth=8):
+  """Build a stack of 3x3 Conv + Relu layers with constant spatial size.
+
+  :param batch_size: leading dimension of the input, None for dynamic.
+  :param channels: number of channels of every layer.
+  :param size: height and width of the input.
+  :param depth: number of Conv + Relu layers.
+
+  :returns: an ONNX ModelProto with input "X" and output "Y".
+  """
+  nodes = []
+  inputs = [
+      helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                    [batch_size, channels, size, size])
+  ]
+  initializers = []
+  x = "X"
+  for i in range(depth):
+    w, b = "W{}".format(i), "B{}".format(i)
+    initializers.append(_initializer(w, [channels, channels, 3, 3]))
+    initializers.append(_initializer(b, [channels]))
+    inputs.append(
+        helper.make_tensor_value_info(w, TensorProto.FLOAT,
+                                      [channels, channels, 3, 3]))
+    inputs.append(helper.make_tensor_value_info(b, TensorProto.FLOAT,
+                                                [channels]))
+    conv = "conv{}".format(i)
+    y = "Y" if i == depth - 1 else "relu{}".format(i)
+    nodes.append(
+        helper.make_node(
+            "Conv", [x, w, b], [conv], kernel_shape=[3, 3], pads=[1, 1, 1, 1]))
+    nodes.append(helper.make_node("Relu", [conv], [y]))
+    x = y
+  graph_def = helper.make_graph(
+      nodes,
+      "conv_model",
+      inputs, [
+          helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                        [batch_size, channels, size, size])
+      ],
+      initializer=initializers)
+  return helper.make_model(graph_def)
+
+
+def make_resnet_model(batch_size=1, channels=32, size=56, blocks=4):
+  """Build a ResNet style model: a strided conv and max pool stem, then
+  residual blocks of Conv + Relu + Conv + Add + Relu, then a Flatten.
+
+  :param batch_size: leading dimension of the input.
+  :param channels: number of channels of every conv.
+  :param size: height and width of the input.
+  :param blocks: number of residual blocks.
+
+  :returns: an ONNX ModelProto with input "X" and output "Y".
+  """
+  nodes = []
+  inputs = [
+      helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                    [batch_size, 3, size, size])
+  ]
+  initializers = []
+
+  def conv(x, y, in_channels, **attrs):
+    w, b = y + "_W", y + "_B"
+    initializers.append(_initializer(w, [channels, in_channels, 3, 3]))
+    initializers.append(_initializer(b, [channels]))
+    inputs.append(
+        helper.make_tensor_value_info(w, TensorProto.FLOAT,
+                                      [channels, in_channels, 3, 3]))
+    inputs.append(helper.make_tensor_value_info(b, TensorProto.FLOAT,
+                                                [channels]))
+    nodes.append(
+        helper.make_node(
+            "Conv", [x, w, b], [y],
+            kernel_shape=[3, 3],
+            pads=[1, 1, 1, 1],
+            **attrs))
+
+  conv("X", "stem", 3, strides=[2, 2])
+  nodes.append(helper.make_node("Relu", ["stem"], ["stem_relu"]))
+  nodes.append(
+      helper.make_node(
+          "MaxPool", ["stem_relu"], ["block0"],
+          kernel_shape=[3, 3],
+          pads=[1, 1, 1, 1],
+          strides=[2, 2]))
+  x = "block0"
+  for i in range(blocks):
+    prefix = "block{}_".format(i)
+    conv(x, prefix + "conv1", channels)
+    nodes.append(
+        helper.make_node("Relu", [prefix + "conv1"], [prefix + "relu1"]))
+    conv(prefix + "relu1", prefix + "conv2", channels)
+    nodes.append(
+        helper.make_node("Add", [prefix + "conv2", x], [prefix + "add"]))
+    y = "block{}".format(i + 1)
+    nodes.append(helper.make_node("Relu", [prefix + "add"], [y]))
+    x = y
+  nodes.append(helper.make_node("Flatten", [x], ["Y"], axis=1))
+  out_size = size // 4
+  graph_def = helper.make_graph(
+      nodes,
+      "resnet_model",
+      inputs, [
+          helper.make_tensor_value_info(
+              "Y", TensorProto.FLOAT,
+              [batch_size, channels * out_size * out_size])
+      ],
+      initializer=initializers)
+  return helper.make_model(graph_def)
+
+
+def make_shufflenet_model(batch_size=1, channels=240, size=224, groups=3,
+                          units=4):
+  """Build a ShuffleNet style model: a strided conv and max pool stem, then
+  units of grouped 1x1 Conv + Relu, channel shuffle, 3x3 depthwise Conv,
+  grouped 1x1 Conv, residual Add and Relu.
+
+  :param batch_size: leading dimension of the input.
+  :param channels: number of channels of the units, a multiple of 4 * groups.
+  :param size: height and width of the input, a multiple of 4.
+  :param groups: number of groups of the 1x1 convs.
+  :param units: number of ShuffleNet units.
+
+  :returns: an ONNX ModelProto with input "X" and output "Y".
+  """
+  nodes = []
+  inputs = [
+      helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                    [batch_size, 3, size, size])
+  ]
+  initializers = []
+
+  def conv(x, y, out_channels, in_channels, kernel, group=1, **attrs):
+    w, b = y + "_W", y + "_B"
+    w_shape = [out_channels, in_channels // group, kernel, kernel]
+    initializers.append(_initializer(w, w_shape))
+    initializers.append(_initializer(b, [out_channels]))
+    inputs.append(helper.make_tensor_value_info(w, TensorProto.FLOAT,
+                                                w_shape))
+    inputs.append(helper.make_tensor_value_info(b, TensorProto.FLOAT,
+                                                [out_channels]))
+    nodes.append(
+        helper.make_node(
+            "Conv", [x, w, b], [y],
+            kernel_shape=[kernel, kernel],
+            group=group,
+            **attrs))
+
+  conv("X", "stem", channels, 3, 3, strides=[2, 2], pads=[1, 1, 1, 1])
+  nodes.append(helper.make_node("Relu", ["stem"], ["stem_relu"]))
+  nodes.append(
+      helper.make_node(
+          "MaxPool", ["stem_relu"], ["unit0"],
+          kernel_shape=[3, 3],
+          pads=[1, 1, 1, 1],
+          strides=[2, 2]))
+  bottleneck = channels // 4
+  out_size = size // 4
+  # Shapes of the channel shuffle reshapes.
+  for name, shape in [
+      ("grouped_shape",
+       [batch_size, groups, bottleneck // groups, out_size, out_size]),
+      ("shuffle_shape", [batch_size, bottleneck, out_size, out_size]),
+  ]:
+    initializers.append(
+        numpy_helper.from_array(np.array(shape, dtype=np.int64), name))
+    inputs.append(
+        helper.make_tensor_value_info(name, TensorProto.INT64, [len(shape)]))
+  x = "unit0"
+  for i in range(units):
+    prefix = "unit{}_".format(i)
+    conv(x, prefix + "gconv1", bottleneck, channels, 1, groups)
+    nodes.append(
+        helper.make_node("Relu", [prefix + "gconv1"], [prefix + "relu1"]))
+    nodes.append(
+        helper.make_node("Reshape", [prefix + "relu1", "grouped_shape"],
+                         [prefix + "grouped"]))
+    nodes.append(
+        helper.make_node(
+            "Transpose", [prefix + "grouped"], [prefix + "shuffled"],
+            perm=[0, 2, 1, 3, 4]))
+    nodes.append(
+        helper.make_node("Reshape", [prefix + "shuffled", "shuffle_shape"],
+                         [prefix + "shuffle"]))
+    conv(prefix + "shuffle", prefix + "dwconv", bottleneck, bottleneck, 3,
+         bottleneck, pads=[1, 1, 1, 1])
+    conv(prefix + "dwconv", prefix + "gconv2", channels, bottleneck, 1, groups)
+    nodes.append(
+        helper.make_node("Add", [prefix + "gconv2", x], [prefix + "add"]))
+    y = "unit{}".format(i + 1)
+    nodes.append(helper.make_node("Relu", [prefix + "add"], [y]))
+    x = y
+  nodes.append(helper.make_node("Flatten", [x], ["Y"], axis=1))
+  graph_def = helper.make_graph(
+      nodes,
+      "shufflenet_model",
+      inputs, [
+          helper.make_tensor_value_info(
+              "Y", TensorProto.FLOAT,
+              [batch_size, channels * out_size * out_size])
+      ],
+      initializer=initializers)
+  return helper.make_model(graph_def)
+
+
+def make_lstm_model(seq_length=32, batch_size=1, input_size=64,
+                    hidden_size=128):
+  """Build a single forward LSTM node.
+
+  :param seq_length: number of time steps of the input.
+  :param batch_size: batch dimension of the input.
+  :param input_size: number of features of every time step.
+  :param hidden_size: number of hidden units.
+
+  :returns: an ONNX ModelProto with input "X", time major, and output "Y",
+  the hidden state of every time step.
+  """
+  initializers = [
+      _initializer("W", [1, 4 * hidden_size, input_size]),
+      _initializer("R", [1, 4 * hidden_size, hidden_size]),
+      _initializer("B", [1, 8 * hidden_size]),
+  ]
+  node_def = helper.make_node(
+      "LSTM", ["X", "W", "R", "B"], ["Y", "Y_h", "Y_c"],
+      hidden_size=hidden_size)
+  inputs = [
+      helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                    [seq_length, batch_size, input_size])
+  ] + [
+      helper.make_tensor_value_info(init.name, TensorProto.FLOAT,
+                                    list(init.dims)) for init in initializers
+  ]
+  graph_def = helper.make_graph(
+      [node_def],
+      "lstm_model",
+      inputs, [
+          helper.make_tensor_value_info(
+              "Y", TensorProto.FLOAT,
+              [seq_length, 1, batch_size, hidden_size])
+      ],
+      initializer=initializers)
+  return helper.make_model(graph_def)
@@ -3,6 +3,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import shutil
+import tempfile
 import unittest
 import numpy as np
 import onnx
@@ -10,15 +12,7 @@ import onnx_tf.backend as tf
 import onnx_caffe2.backend as c2
 from onnx import helper
 from onnx.onnx_pb2 import TensorProto
-
-
-def find_between(s, first, last):
-  try:
-    start = s.index(first) + len(first)
-    end = s.index(last, start)
-    return s[start:end]
-  except ValueError:
-    return ""
+from onnx_tf.taps import compare_taps, format_report
 
 
 class TestLargeModel(unittest.TestCase):
@@ -26,42 +20,34 @@ class TestLargeModel(unittest.TestCase):
 
   def test(self):
     _model = onnx.load(self.MODEL_PATH + "shufflenet/model.pb")
-    node_count = len(_model.graph.node)
-    more_outputs = []
-    output_to_check = []
-    for node in _model.graph.node:
-      more_outputs.append(
-          helper.make_tensor_value_info(node.output[0], TensorProto.FLOAT,
-                                        (100, 100)))
-      output_to_check.append(node.output[0])
-    _model.graph.output.extend(more_outputs)
-
-    tf_rep = tf.prepare(_model)
-    cf_rep = c2.prepare(_model)
-
     sample = np.load(
         self.MODEL_PATH + "shufflenet/test_data_{}.npz".format(str(1)),
         encoding='bytes')
     inputs = list(sample['inputs'])
-    outputs = list(sample['outputs'])
-
-    my_out = tf_rep.run(inputs)
-    cf_out = cf_rep.run(inputs)
 
-    for op in output_to_check:
-      try:
-        np.savetxt(
-            op.replace("/", "__") + ".cf", cf_out[op].flatten(), delimiter='\t')
-        np.savetxt(
-            op.replace("/", "__") + ".tf", my_out[op].flatten(), delimiter='\t')
-        np.testing.assert_allclose(my_out[op], cf_out[op], rtol=1e-2)
-        print(op, "results of this layer are correct within tolerence.")
-      except Exception as e:
-        np.set_printoptions(threshold=np.inf)
-        mismatch_percent = (find_between(str(e), "(mismatch", "%)"))
-        print(op, "mismatch with percentage {} %".format(mismatch_percent))
+    # Tensorflow fetches every layer of the model prepared once, in a
+    # single run, and streams them to a memory-mapped store. Folding
+    # BatchNormalization into Conv would drop the Conv outputs.
+    tf_rep = tf.prepare(_model, fold_batch_norm=False)
+    store_dir = tempfile.mkdtemp()
+    try:
+      my_out = tf_rep.run_taps(inputs, store_dir=store_dir)
+
+      # Caffe2 only returns graph outputs, so list every layer as one.
+      output_to_check = [node.output[0] for node in _model.graph.node]
+      _model.graph.output.extend(
+          helper.make_tensor_value_info(name, TensorProto.FLOAT, (100, 100))
+          for name in output_to_check)
+      cf_rep = c2.prepare(_model)
+      cf_out = cf_rep.run(inputs)
+      reference = dict((name, cf_out[name]) for name in output_to_check)
+
+      report = compare_taps(my_out, reference, rtol=1e-2)
+      print(format_report(report))
+    finally:
+      tf_rep.close()
+      shutil.rmtree(store_dir)
 
 
 if __name__ == '__main__':
   unittest.main()
-  pass
@@ -0,0 +1,83 @@
+"""Asyncio front end of TensorflowRep, see TensorflowRep.run_async.
+
+This module needs Python 3.5 or later and is only imported on the first
+call to run_async.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import weakref
+
+import tensorflow as tf
+
+
+class AsyncRunner(object):
+  """Runs a TensorflowRep on a fixed pool of threads for coroutines.
+
+  At most queue_depth calls are admitted at a time, running or waiting for
+  a thread. Further calls wait for a slot in their event loop without
+  holding any thread, which gives the caller backpressure.
+
+  Args:
+    tf_rep: The TensorflowRep to run.
+    max_workers: Number of threads running the session.
+    queue_depth: Number of calls admitted at a time.
+  """
+
+  def __init__(self, tf_rep, max_workers, queue_depth):
+    if queue_depth < 1:
+      raise ValueError("queue_depth must be positive, got {}.".format(
+          queue_depth))
+    self.tf_rep = tf_rep
+    self.queue_depth = queue_depth
+    self._executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Set by shutdown, after which calls go to the runner of tf_rep.
+    self._closed = False
+    # One semaphore per event loop, asyncio primitives being bound to a
+    # loop.
+    self._slots = weakref.WeakKeyDictionary()
+    self._slots_lock = threading.Lock()
+
+  def _get_slots(self, loop):
+    with self._slots_lock:
+      slots = self._slots.get(loop)
+      if slots is None:
+        slots = asyncio.Semaphore(self.queue_depth)
+        self._slots[loop] = slots
+      return slots
+
+  async def run(self, inputs, outputs=None, timeout_ms=None):
+    """Coroutine running inputs on the pool, see TensorflowRep.run_async."""
+    run_options = None
+    if timeout_ms is not None:
+      run_options = tf.RunOptions(timeout_in_ms=int(timeout_ms))
+    loop = asyncio.get_event_loop()
+    async with self._get_slots(loop):
+      try:
+        # Cancelling the caller cancels the call unless it already runs,
+        # the session then stops it once the timeout is reached.
+        future = loop.run_in_executor(
+            self._executor,
+            lambda: self.tf_rep.run(
+                inputs, outputs=outputs, run_options=run_options))
+      except RuntimeError:
+        if not self._closed:
+          raise
+        future = None
+      if future is not None:
+        return await future
+    # TensorflowRep.close shut this runner down while the call waited for
+    # a slot, hand it to the runner of the reopened representation.
+    return await self.tf_rep.run_async(
+        inputs, outputs=outputs, timeout_ms=timeout_ms)
+
+  def shutdown(self, wait=True):
+    """Stop taking calls, calls waiting for a slot then go to the next
+    runner of tf_rep."""
+    self._closed = True
+    self._executor.shutdown(wait=wait)
@@ -0,0 +1,161 @@
+"""Search of the thread counts and batch size running a TensorflowRep
+fastest on the local CPU, see TensorflowRep.autotune.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+TUNING_FILE = "tuning.json"
+
+# Batch sizes tried when the inputs have a dynamic batch dimension.
+DEFAULT_BATCH_SIZES = (1, 4, 16, 64)
+
+# Timed runs of a trial, whatever its share of the budget.
+MIN_RUNS = 3
+
+Trial = namedtuple("Trial", [
+    "session_options", "batch_size", "p50_ms", "p99_ms", "throughput"
+])
+
+
+def get_thread_configs(cpu_count=None):
+  """
+  Candidate (intra_op_parallelism_threads, inter_op_parallelism_threads)
+  pairs: powers of two intra op threads up to cpu_count, each with one
+  inter op thread and with enough of them to occupy every core.
+  """
+  cpu_count = cpu_count or multiprocessing.cpu_count()
+  intra_counts = sorted(
+      set([2**i for i in range(cpu_count.bit_length())] + [cpu_count]))
+  configs = []
+  for intra in intra_counts:
+    for inter in sorted(set([1, max(1, cpu_count // intra)])):
+      configs.append((intra, inter))
+  return configs
+
+
+def _resize_batch(values, batch_size):
+  """Repeat or cut the rows of every value to batch_size rows."""
+  return [
+      np.take(value, np.arange(batch_size) % len(value), axis=0)
+      for value in values
+  ]
+
+
+def _has_dynamic_batch(tf_rep):
+  for name in tf_rep.predict_net.external_input:
+    shape = tf_rep.predict_net.tensor_dict[name].shape
+    if shape.ndims is None:
+      continue
+    if shape.ndims == 0 or shape.as_list()[0] is not None:
+      return False
+  return True
+
+
+def _time_trial(tf_rep, feed_values, batch_size, seconds):
+  # The first run creates the session and compiles the callable.
+  tf_rep.run(feed_values)
+  latencies = []
+  start = time.time()
+  while len(latencies) < MIN_RUNS or time.time() - start < seconds:
+    run_start = time.time()
+    tf_rep.run(feed_values)
+    latencies.append(time.time() - run_start)
+  elapsed = time.time() - start
+  return (np.percentile(latencies, 50) * 1000,
+          np.percentile(latencies, 99) * 1000,
+          batch_size * len(latencies) / elapsed)
+
+
+def autotune(tf_rep,
+             sample_inputs,
+             budget_seconds=30.,
+             batch_sizes=None,
+             thread_configs=None,
+             objective="throughput"):
+  """
+  Time tf_rep for every thread configuration and batch size.
+
+  The budget is split evenly between the trials. Every trial replaces the
+  session of tf_rep, which is left with the options of the best trial.
+
+  Args:
+    tf_rep: The TensorflowRep to tune.
+    sample_inputs: Inputs of tf_rep, in any form TensorflowRep.run
+      accepts. Their rows are repeated or cut to each batch size.
+    budget_seconds: Total time spent timing runs.
+    batch_sizes: Batch sizes to try. Defaults to DEFAULT_BATCH_SIZES when
+      every input has a dynamic batch dimension, else to the batch size of
+      sample_inputs.
+    thread_configs: (intra, inter) thread count pairs to try, defaults to
+      get_thread_configs().
+    objective: "throughput" to maximize the samples per second, "latency"
+      to minimize the p99 latency of a run.
+
+  Returns:
+    The list of Trial, best first. throughput is in samples per second.
+  """
+  if objective not in ("throughput", "latency"):
+    raise ValueError("Unknown objective {}.".format(objective))
+  feed_values = [np.asarray(value)
+                 for value in tf_rep._get_feed_values(sample_inputs)]
+  if batch_sizes is None:
+    batch_sizes = (DEFAULT_BATCH_SIZES if _has_dynamic_batch(tf_rep) else
+                   [len(feed_values[0])])
+  thread_configs = thread_configs or get_thread_configs()
+  seconds = budget_seconds / (len(batch_sizes) * len(thread_configs))
+
+  base_options = tf_rep.session_options
+  trials = []
+  for intra, inter in thread_configs:
+    session_options = dict(
+        base_options,
+        intra_op_parallelism_threads=intra,
+        inter_op_parallelism_threads=inter)
+    tf_rep.session_options = session_options
+    for batch_size in batch_sizes:
+      p50_ms, p99_ms, throughput = _time_trial(
+          tf_rep, _resize_batch(feed_values, batch_size), batch_size,
+          seconds)
+      trials.append(
+          Trial(session_options, batch_size, p50_ms, p99_ms, throughput))
+
+  if objective == "throughput":
+    trials.sort(key=lambda trial: -trial.throughput)
+  else:
+    trials.sort(key=lambda trial: trial.p99_ms)
+  tf_rep.session_options = trials[0].session_options
+  return trials
+
+
+def save_tuning(path, trial):
+  """Write trial to the JSON file path, with the CPU count it holds for."""
+  tuning = dict(trial._asdict(), cpu_count=multiprocessing.cpu_count())
+  with open(path, "w") as tuning_file:
+    json.dump(tuning, tuning_file)
+
+
+def load_tuning(path):
+  """
+  Read the Trial saved by save_tuning.
+
+  Returns:
+    The Trial, or None when path does not exist or was tuned on a host
+    with another number of CPUs.
+  """
+  if not os.path.exists(path):
+    return None
+  with open(path, "r") as tuning_file:
+    tuning = json.load(tuning_file)
+  if tuning.pop("cpu_count", None) != multiprocessing.cpu_count():
+    return None
+  return Trial(**tuning)
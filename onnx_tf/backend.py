@@ -7,7 +7,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 import importlib
+import threading
 import warnings
 import sys
 from math import ceil, floor
@@ -20,28 +23,50 @@ except ImportError:  # will be 3.x series
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.client import device_lib
+from tensorflow.python.framework import tensor_util
 
 from onnx_tf.tf_net import TensorflowNet
+from onnx_tf.autotune import TUNING_FILE, load_tuning
 from onnx_tf.backend_rep import TensorflowRep
+from onnx_tf.device_plan import DevicePlan
+from onnx_tf.graph_builder import GraphBuilder
+from onnx_tf.graph_transform import (GraphView, fold_batch_normalization,
+                                     prune_unreachable)
+from onnx_tf.prepare_cache import PrepareCache
+from onnx_tf.session_config import get_session_options, make_session_config
 from onnx_tf.opset_version import backend_opset_version
 from onnx_tf.common import (ONNX_OP_TO_TF_OP, ONNX_ATTR_TO_TF_ATTR,
                             ONNX_ATTR_TO_TF_ATTR_PER_OP,
                             ONNX_ATTR_TO_REMOVE_PER_OP, ONNX_TYPE_TO_TF_TYPE,
-                            STR_TO_TF_TYPE, TF_TYPE_ENUM, op_name_to_lower)
+                            ONNX_LAYOUT_AGNOSTIC_OPS, STR_TO_TF_TYPE,
+                            TF_TYPE_ENUM, op_name_to_lower)
 from onnx.backend.base import (
     Backend,
-    Device,
-    DeviceType,
     namedtupledict,
 )
 import onnx.defs
 import onnx.numpy_helper
 
+# Options of the conversion running on the current thread, see
+# TensorflowBackendBase.get_conversion_option.
+_conversion_options = threading.local()
 
-# TODO: allow more flexible placement
-def get_device_option(device):
-  m = {DeviceType.CPU: '/cpu', DeviceType.CUDA: '/gpu'}
-  return m[device.type]
+# Graphs converted by run_node and run_nodes, keyed by the signatures of
+# their nodes, least recently used first. See TensorflowBackendBase.run_node_cache_size.
+_run_node_cache = OrderedDict()
+_run_node_cache_lock = threading.Lock()
+# Lookups of _run_node_cache that found, and did not find, their graph.
+_run_node_cache_stats = {"hits": 0, "misses": 0}
+
+# Statistics of the run_node cache, see
+# TensorflowBackendBase.run_node_cache_info.
+RunNodeCacheInfo = namedtuple("RunNodeCacheInfo",
+                              ["hits", "misses", "maxsize", "currsize"])
+
+# Device -> whether this process can run on it, probed once per device.
+_supported_devices = {}
+# Device -> DevicePlan of the conversions targeting it.
+_device_plans = {}
 
 
 # TODO: Move this into ONNX main library
@@ -170,6 +195,13 @@ class TensorflowBackendBase(Backend):
 
   backend_version_cache = {}
 
+  # (op_type, opset) -> handler converting the nodes of op_type for the
+  # opset, filled on first use by _get_handler.
+  handler_registry = {}
+
+  # Number of node graphs and sessions kept by run_node and run_nodes.
+  run_node_cache_size = 256
+
   # input_shape, kernel_shape, strides are specified for
   # spatial dims only.
   @classmethod
@@ -199,11 +231,15 @@ class TensorflowBackendBase(Backend):
     return None
 
   @classmethod
-  def get_padding_as_op(cls, x, pads):
+  def get_padding_as_op(cls, x, pads, data_format=None):
     num_dim = int(len(pads) / 2)
 
     tf_pads = np.transpose(np.array(pads).reshape([2, num_dim]))
-    tf_pads = [0, 0, 0, 0] + tf_pads.flatten().tolist()
+    if data_format is not None and data_format.endswith("C"):
+      # channels last
+      tf_pads = [0, 0] + tf_pads.flatten().tolist() + [0, 0]
+    else:
+      tf_pads = [0, 0, 0, 0] + tf_pads.flatten().tolist()
 
     padding = tf.constant(
         np.array(tf_pads).reshape([num_dim + 2, 2])
@@ -237,51 +273,178 @@ class TensorflowBackendBase(Backend):
 
   @classmethod
   def run_node(cls, node, inputs, device='CPU'):
-    super(TensorflowBackendBase, cls).run_node(node, inputs, device)
-    node_graph = tf.Graph()
-    with node_graph.as_default():
-      node = OnnxNode(node)
-      device_option = get_device_option(Device(device))
-      input_tensors = []
-      for i in inputs:
-        input_tensors.append(tf.constant(i))
+    return cls.run_nodes([(node, inputs)], device=device)[0]
 
+  @classmethod
+  def run_nodes(cls, nodes_and_inputs, device='CPU'):
+    """Run many independent nodes in one graph and one session run.
+
+    The graph, its session and a callable running it are cached for the
+    signatures of the nodes (op type, attributes, input dtypes and shapes)
+    the way run_node caches them for a single node.
+
+    :param nodes_and_inputs: list of (node, inputs) pairs, where node is a
+    NodeProto and inputs are its input values as passed to run_node.
+    :param device: the device to run the nodes on.
+
+    :returns: a list with the outputs of every node, as run_node returns
+    them.
+    """
+    nodes, feeds = [], []
+    for node, inputs in nodes_and_inputs:
+      super(TensorflowBackendBase, cls).run_node(node, inputs, device)
       if isinstance(inputs, dict):
         feed_dict_raw = inputs
       else:
-        assert len(node.inputs) == len(inputs)
-        feed_dict_raw = dict(zip(node.inputs, inputs))
+        assert len(node.input) == len(inputs)
+        feed_dict_raw = dict(zip(node.input, inputs))
+      # Inputs fed by name, a name listed twice is fed once.
+      input_names = list(OrderedDict.fromkeys(node.input))
+      nodes.append(node)
+      feeds.append([(name, cls._to_feed_value(feed_dict_raw[name]))
+                    for name in input_names])
+
+    signature = tuple(
+        cls._get_node_signature(node, [value for _, value in feed], device)
+        for node, feed in zip(nodes, feeds))
+    with _run_node_cache_lock:
+      entry = _run_node_cache.pop(signature, None)
+      if entry is not None:
+        _run_node_cache[signature] = entry
+        _run_node_cache_stats["hits"] += 1
+      else:
+        _run_node_cache_stats["misses"] += 1
+    if entry is None:
+      entry, is_stateful = cls._build_nodes_callable(nodes, feeds, device)
+      # Stateful kernels, e.g. seeded random ops, would go on from the
+      # state left by the previous call: those graphs are built per call.
+      if not is_stateful:
+        with _run_node_cache_lock:
+          _run_node_cache[signature] = entry
+          while len(_run_node_cache) > cls.run_node_cache_size:
+            # Sessions of evicted entries are closed once they are no
+            # longer referenced, never while another thread may still run
+            # them.
+            _run_node_cache.popitem(last=False)
+
+    run_callable, outputs_types = entry
+    output_values = run_callable(
+        *[value for feed in feeds for _, value in feed])
+    results = []
+    for outputs_type, count in outputs_types:
+      results.append(outputs_type(*output_values[:count]))
+      output_values = output_values[count:]
+    return results
+
+  @classmethod
+  def run_node_cache_info(cls):
+    """Report how run_node and run_nodes used their graph cache.
 
-      # TODO: is constant the best way for feeding inputs?
-      input_dict = dict(
-          [(x[0], tf.constant(x[1])) for x in feed_dict_raw.items()])
-      ops = cls._onnx_node_to_tensorflow_op(node, input_dict)
-      output_vals = []
+    :returns: a RunNodeCacheInfo with the number of cache hits and misses
+    since the cache was last cleared, the maximum number of cached graphs
+    and the number of graphs cached now. Graphs with stateful kernels are
+    never cached, each of their runs counts as a miss.
+    """
+    with _run_node_cache_lock:
+      return RunNodeCacheInfo(_run_node_cache_stats["hits"],
+                              _run_node_cache_stats["misses"],
+                              cls.run_node_cache_size, len(_run_node_cache))
+
+  @classmethod
+  def run_node_cache_clear(cls):
+    """Drop the graphs cached by run_node and run_nodes and reset the
+    statistics of run_node_cache_info.
+    """
+    with _run_node_cache_lock:
+      _run_node_cache.clear()
+      _run_node_cache_stats["hits"] = 0
+      _run_node_cache_stats["misses"] = 0
+
+  @classmethod
+  def _get_node_signature(cls, node, input_values, device):
+    attrs = tuple(attr.SerializeToString() for attr in node.attribute)
+    input_types = tuple(
+        (value.dtype.str, value.shape) for value in input_values)
+    return (node.op_type, attrs, tuple(node.input), tuple(node.output),
+            input_types, device)
+
+  @classmethod
+  def _to_feed_value(cls, value):
+    """Value as an array, typed the way tf.constant would type it."""
+    if isinstance(value, (np.ndarray, np.generic)):
+      return np.asarray(value)
+    value = np.asarray(value)
+    if value.dtype == np.float64:
+      return value.astype(np.float32)
+    if value.dtype == np.int64:
+      return value.astype(np.int32)
+    return value
 
-      with tf.Session() as sess:
-        with tf.device(device_option):
-          sess.run(tf.global_variables_initializer())
-          output_vals = sess.run(ops)
+  @classmethod
+  def _build_nodes_callable(cls, nodes, feeds, device):
+    """Convert nodes in a graph of their own fed through placeholders, and
+    compile a callable running it in a session kept with the graph.
 
-    return namedtupledict('Outputs', node.outputs)(*output_vals)
+    Returns the (callable, output types) entry of the run_node cache, and
+    whether the graph has ops with stateful kernels."""
+    node_graph = tf.Graph()
+    placeholders, ops, outputs_types = [], [], []
+    device_plan = cls.get_device_plan(device)
+    with node_graph.as_default(), cls._conversion_scope(
+        device_plan=device_plan), tf.device(device_plan.tf_device):
+      for i, (node, feed) in enumerate(zip(nodes, feeds)):
+        node = OnnxNode(node)
+        with tf.name_scope("node{}".format(i)):
+          input_dict = {}
+          for name, value in feed:
+            input_dict[name] = tf.placeholder(
+                tf.as_dtype(value.dtype), shape=value.shape)
+            placeholders.append(input_dict[name])
+          node_ops = cls._onnx_node_to_tensorflow_op(node, input_dict)
+        ops.extend(node_ops)
+        outputs_types.append((namedtupledict('Outputs', node.outputs),
+                              len(node_ops)))
+      init_op = tf.global_variables_initializer()
+
+    sess = tf.Session(graph=node_graph,
+                      config=device_plan.get_session_config())
+    sess.run(init_op)
+    run_callable = sess.make_callable(ops, feed_list=placeholders)
+    is_stateful = any(
+        op.op_def.is_stateful for op in node_graph.get_operations())
+    return (run_callable, outputs_types), is_stateful
 
   @classmethod
-  def onnx_graph_to_tensorflow_net(cls, graph_def, opset):
-    model_graph = tf.Graph()
-    with model_graph.as_default():
+  def onnx_graph_to_tensorflow_net(cls,
+                                   graph_def,
+                                   opset,
+                                   initializers_as_variables=False,
+                                   optimize_layout=False,
+                                   device=None):
+    builder = GraphBuilder()
+    device_plan = cls.get_device_plan(device)
+    with builder, cls._conversion_scope(
+        optimize_layout=optimize_layout,
+        device_plan=device_plan), tf.device(device_plan.tf_device):
+      predict_net = TensorflowNet()
+      predict_net.name = graph_def.name
+      predict_net.graph = builder.graph
+      predict_net.device = device_plan.device
+
       # initializer: TensorProtos representing the values to initialize
       # a given tensor.
       # initialized: A list of names of the initialized tensors.
       if graph_def.initializer:
-        input_dict_items = cls.onnx_initializer_to_input_dict_items(
-            graph_def.initializer)
+        if initializers_as_variables:
+          input_dict_items = cls.onnx_initializer_to_variable_items(
+              graph_def.initializer, predict_net)
+        else:
+          input_dict_items = cls.onnx_initializer_to_input_dict_items(
+              graph_def.initializer)
         initialized = {init.name for init in graph_def.initializer}
       else:
         input_dict_items = []
         initialized = set()
-      predict_net = TensorflowNet()
-      predict_net.name = graph_def.name
-      predict_net.graph = model_graph
 
       predict_net.external_input.extend(value_info.name
                                         for value_info in graph_def.input
@@ -304,29 +467,129 @@ class TensorflowBackendBase(Backend):
 
       # tensor dict: this dictionary is a map from variable names
       # to the latest produced TF tensors of the given name.
-      # This dictionary will get updated as we build the graph to
+      # The builder updates it in place as we build the graph to
       # record the names of newly produced tensors.
-      tensor_dict = dict(input_dict_items)
-      # Since tensor dict may be updated, we need to keep a copy
-      # of the original input dict where we track the earliest
-      # defined tensors so we can have access to the placeholders
-      # to feed in input tensors when we run the graph.
-      input_dict = dict(input_dict_items)
+      builder.add_inputs(input_dict_items)
+      tensor_dict = builder.tensor_dict
 
       for node in graph_def.node:
         node = OnnxNode(node)
 
-        output_ops = cls._onnx_node_to_tensorflow_op(
-            node, tensor_dict, opset=opset)
-        curr_node_output_map = list(zip(node.outputs, output_ops))
-        tensor_dict = dict(list(tensor_dict.items()) + curr_node_output_map)
+        output_ops = None
+        if optimize_layout and node.op_type in ONNX_LAYOUT_AGNOSTIC_OPS:
+          output_ops = cls._propagate_layout(node, tensor_dict, opset=opset)
+        if output_ops is None:
+          output_ops = cls._onnx_node_to_tensorflow_op(
+              node, tensor_dict, opset=opset)
+        builder.add_node_outputs(node, output_ops)
 
       predict_net.tensor_dict = tensor_dict
+      predict_net.node_outputs = [
+          name for node in graph_def.node for name in node.output
+          if name and name in builder.producers
+      ]
+
+      # Some handlers create variables; build their initializer once here
+      # so that running the graph never has to add ops to it. Initializers
+      # loaded as variables are assigned one by one by TensorflowRep.
+      assign_ops = set(predict_net.initializer_assign_ops.values())
+      variables = [
+          variable for variable in tf.global_variables()
+          if variable.initializer.name not in assign_ops
+      ]
+      if variables:
+        predict_net.init_op = tf.variables_initializer(variables)
+      if predict_net.initializer_placeholders:
+        # tensor_dict holds the reads of the variables, save the variables
+        # they read from.
+        predict_net.saver = tf.train.Saver({
+            name: tensor_dict[name].op.inputs[0]
+            for name in predict_net.initializer_placeholders
+        })
 
     return predict_net
 
   @classmethod
-  def prepare(cls, model, device='CPU', **kwargs):
+  @contextmanager
+  def _conversion_scope(cls, **options):
+    """Make options visible to handlers converting nodes on this thread."""
+    previous = getattr(_conversion_options, "options", {})
+    _conversion_options.options = options
+    try:
+      yield
+    finally:
+      _conversion_options.options = previous
+
+  @classmethod
+  def get_conversion_option(cls, name, default=None):
+    """Value of an option of the conversion running on this thread."""
+    return getattr(_conversion_options, "options", {}).get(name, default)
+
+  @classmethod
+  def _get_transpose_perm(cls, x):
+    """Permutation of x if it is produced by a transpose, else None."""
+    if x.op.type != "Transpose":
+      return None
+    perm = tensor_util.constant_value(x.op.inputs[1])
+    return None if perm is None else perm.tolist()
+
+  @classmethod
+  def _transpose(cls, x, perm):
+    """
+    Transpose x by perm, for handlers moving data into a compute format.
+
+    When the conversion optimizes layout and x is itself a transpose of
+    some tensor by the inverse permutation, that tensor is returned and no
+    op is added. Chains of layout sensitive ops then stay in compute
+    format; the transpose back to storage format only runs if some other
+    op consumes it.
+    """
+    if cls.get_conversion_option("optimize_layout"):
+      x_perm = cls._get_transpose_perm(x)
+      if x_perm is not None and [x_perm[p] for p in perm] == list(
+          range(len(perm))):
+        return x.op.inputs[0]
+    return tf.transpose(x, perm=perm)
+
+  @classmethod
+  def _propagate_layout(cls, node, input_dict, opset=0):
+    """
+    Convert a layout agnostic node before the transpose feeding it.
+
+    If every input of node is a transpose by the same permutation, the
+    node is converted on the untransposed tensors and its outputs are
+    transposed instead. This moves transposes down the graph, where
+    _transpose can cancel them against the next layout sensitive op.
+
+    Returns:
+      Output tensors, or None when the node cannot be moved.
+    """
+    inputs = [input_dict[name] for name in node.inputs]
+    perms = [cls._get_transpose_perm(x) for x in inputs]
+    if (not perms or perms[0] is None or
+        any(perm != perms[0] for perm in perms) or "axis" in node.attrs):
+      return None
+    untransposed = dict(
+        (name, x.op.inputs[0]) for name, x in zip(node.inputs, inputs))
+    outputs = cls._onnx_node_to_tensorflow_op(node, untransposed, opset=opset)
+    return [tf.transpose(y, perm=perms[0]) for y in outputs]
+
+  @classmethod
+  def prepare(cls,
+              model,
+              device='CPU',
+              cache_dir=None,
+              cache_max_bytes=None,
+              initializers_as_variables=False,
+              optimize_layout=False,
+              fold_batch_norm=True,
+              outputs=None,
+              session_preset=None,
+              session_options=None,
+              tuning_path=None,
+              max_batch_per_call=None,
+              memory_budget_bytes=None,
+              **kwargs):
     """Prepare an ONNX model for Tensorflow Backend
 
     This function converts an ONNX model to an internel representation
@@ -334,34 +597,154 @@ class TensorflowBackendBase(Backend):
     the converted representation.
 
     :param model: the ONNX model to be converted
-    :param device: the device to execute this model on
+    :param device: the device to execute this model on, e.g. "CPU" or
+    "CUDA:0". The data layout of the graph follows it, whatever devices the
+    host has
+    :param cache_dir: optional directory caching converted graphs, keyed
+    by the model, opset, device and onnx-tf version
+    :param cache_max_bytes: size cap of cache_dir, least recently used
+    entries are evicted beyond it
+    :param initializers_as_variables: load initializers as variables
+    assigned one at a time when the session is created instead of
+    constants baked into the graph, which keeps the GraphDef small
+    :param optimize_layout: keep activations in the compute format of the
+    device across chains of layout sensitive ops instead of transposing
+    them back and forth around every such op
+    :param fold_batch_norm: fold inference BatchNormalization nodes into
+    the Conv feeding them when all their parameters are initializers. The
+    outputs of folded Conv nodes are then not computed: they cannot be
+    fetched with TensorflowRep.run or run_taps unless listed in outputs,
+    which keeps them from being folded
+    :param outputs: names of the tensors the representation computes,
+    defaults to the graph outputs; only the nodes, initializers and inputs
+    they depend on are converted
+    :param session_preset: name of a preset of session options, one of
+    onnx_tf.session_config.SESSION_PRESETS: "latency", "throughput" or
+    "memory"
+    :param session_options: dict of options of the sessions running the
+    model, e.g. thread pool sizes, Grappler rewrite options or XLA JIT;
+    they override the preset. See onnx_tf.session_config
+    :param tuning_path: path of the file TensorflowRep.autotune saves its
+    best trial to. When it holds a trial tuned on a host with as many CPUs,
+    its session options are used, under session_preset and
+    session_options. Defaults to a file of the cache entry when cache_dir
+    is given
+    :param max_batch_per_call: number of rows above which run splits its
+    inputs along the first dimension into chunks run one after the other
+    :param memory_budget_bytes: bound of the memory of the tensors a
+    session run computes; run splits larger batches into chunks sized from
+    the shapes of the intermediate tensors. Both options require a graph
+    computing the rows of a batch independently, run raises ValueError
+    otherwise. Only the inputs with a dynamic first dimension are split;
+    graphs whose inputs all have a static one run unchunked
 
     :returns: a TensorflowRep class object representing the ONNX model
     """
     super(TensorflowBackendBase, cls).prepare(model, device, **kwargs)
 
+    session_options = get_session_options(session_preset, session_options)
+    # Validate the options before converting the model.
+    make_session_config(session_options)
+
+    opset = model.opset_import[0].version
+    graph_def = GraphView(model.graph)
+    prune_unreachable(graph_def, outputs)
+
+    def get_graph_def():
+      # Folding computes new Conv weights: a cache hit only pays for it
+      # when they are loaded as variables. Folding twice is a no-op.
+      if fold_batch_norm:
+        fold_batch_normalization(graph_def)
+      return graph_def
+
+    options = {
+        "initializers_as_variables": initializers_as_variables,
+        "optimize_layout": optimize_layout,
+    }
+    cache = None
+    if cache_dir is not None:
+      cache = PrepareCache(cache_dir, cache_max_bytes)
+      cache_key = cache.get_key(
+          model, opset, device,
+          dict(options, fold_batch_norm=fold_batch_norm, outputs=outputs))
+      if tuning_path is None:
+        tuning_path = cache.get_entry_file(cache_key, TUNING_FILE)
+      predict_net = cache.load(cache_key, get_graph_def)
+      if predict_net is not None:
+        return cls._make_rep(predict_net, session_options, tuning_path,
+                             max_batch_per_call=max_batch_per_call,
+                             memory_budget_bytes=memory_budget_bytes)
+
     predict_net = (cls.onnx_graph_to_tensorflow_net(
-        model.graph, opset=model.opset_import[0].version))
+        get_graph_def(), opset=opset, device=device, **options))
+
+    if cache is not None:
+      cache.store(cache_key, predict_net)
 
-    return TensorflowRep(predict_net)
+    return cls._make_rep(predict_net, session_options, tuning_path,
+                         max_batch_per_call=max_batch_per_call,
+                         memory_budget_bytes=memory_budget_bytes)
+
+  @classmethod
+  def _make_rep(cls, predict_net, session_options, tuning_path, **kwargs):
+    """Wrap predict_net, starting from the tuned session options saved at
+    tuning_path if any."""
+    tuning = load_tuning(tuning_path) if tuning_path is not None else None
+    if tuning is not None:
+      tuned_options = dict(tuning.session_options)
+      tuned_options.update(session_options)
+      session_options = tuned_options
+    return TensorflowRep(
+        predict_net,
+        session_options=session_options,
+        tuning_path=tuning_path,
+        **kwargs)
 
   @classmethod
   def onnx_initializer_to_input_dict_items(cls,
                                            initializer,
                                            init_net_name='init'):
 
-    def tensor2list(onnx_tensor):
-      # Use the onnx.numpy_helper because the data may be raw
-      return onnx.numpy_helper.to_array(onnx_tensor).flatten().tolist()
+    def tensor2array(onnx_tensor):
+      # Use the onnx.numpy_helper because the data may be raw. The array
+      # is handed to Tensorflow as is: going through a Python list would
+      # allocate one Python object per element.
+      return onnx.numpy_helper.to_array(onnx_tensor)
 
     input_dict = [(tp.name,
                    tf.constant(
-                       tensor2list(tp),
-                       shape=tp.dims,
+                       tensor2array(tp),
                        dtype=ONNX_TYPE_TO_TF_TYPE[tp.data_type]))
                   for tp in initializer]
     return input_dict
 
+  @classmethod
+  def onnx_initializer_to_variable_items(cls, initializer, predict_net):
+    """
+    Load initializers as variables assigned from placeholders.
+
+    The values are not part of the graph: predict_net records, for every
+    initializer, the op assigning the variable and the placeholder that has
+    to be fed with its value when it runs.
+
+    Args:
+      initializer: TensorProtos of the initializers.
+      predict_net: TensorflowNet under construction.
+
+    Returns:
+      List of (initializer name, tensor reading the variable) pairs.
+    """
+    input_dict = []
+    for tp in initializer:
+      init_value = tf.placeholder(
+          ONNX_TYPE_TO_TF_TYPE[tp.data_type], shape=list(tp.dims))
+      variable = tf.Variable(init_value, trainable=False)
+      predict_net.initializer_placeholders[tp.name] = init_value.name
+      predict_net.initializer_assign_ops[tp.name] = variable.initializer.name
+      predict_net.initializer_values[tp.name] = tp
+      input_dict.append((tp.name, variable.value()))
+    return input_dict
+
   @classmethod
   def _onnx_node_to_tensorflow_op(cls, node, input_dict, opset=0):
     """
@@ -375,7 +758,20 @@ class TensorflowBackendBase(Backend):
     Returns:
       Tensorflow op
     """
-    op_name_lowered = op_name_to_lower(node.op_type)
+    return cls._get_handler(node.op_type, opset)(node, input_dict)
+
+  @classmethod
+  def _get_handler(cls, op_type, opset):
+    """Handler converting the nodes of op_type for the opset."""
+    handler = cls.handler_registry.get((op_type, opset))
+    if handler is None:
+      handler = cls._resolve_handler(op_type, opset)
+      cls.handler_registry[(op_type, opset)] = handler
+    return handler
+
+  @classmethod
+  def _resolve_handler(cls, op_type, opset):
+    op_name_lowered = op_name_to_lower(op_type)
     handler_name = "handle_" + op_name_lowered
 
     # Check if specialized handler exists.
@@ -388,20 +784,23 @@ class TensorflowBackendBase(Backend):
       version = versions[max([i for i, v in enumerate(versions) if v == opset])
                          - 1]
 
-    backend_ver = 'backend_v{}'.format(version)
-    backend = cls.backend_version_cache.setdefault(
-        backend_ver,
-        importlib.import_module(
-            'onnx_tf.backends.' + backend_ver).TensorflowBackend)
-
+    backend = cls._get_backend(version)
     if hasattr(backend, handler_name):
-      method_to_call = getattr(backend, handler_name)
-      return method_to_call(node, input_dict)
+      return getattr(backend, handler_name)
     elif op_name_lowered in ONNX_OP_TO_TF_OP.keys():
-      return backend.handle_trivial(node, input_dict)
+      return backend.handle_trivial
     else:
-      raise NotImplementedError("{} op is not implemented.".format(
-          node.op_type))
+      raise NotImplementedError("{} op is not implemented.".format(op_type))
+
+  @classmethod
+  def _get_backend(cls, version):
+    backend_ver = 'backend_v{}'.format(version)
+    backend = cls.backend_version_cache.get(backend_ver)
+    if backend is None:
+      backend = importlib.import_module(
+          'onnx_tf.backends.' + backend_ver).TensorflowBackend
+      cls.backend_version_cache[backend_ver] = backend
+    return backend
 
   @classmethod
   def handle_trivial(cls, node, input_dict):
@@ -446,8 +845,7 @@ class TensorflowBackendBase(Backend):
                 x in ONNX_ATTR_TO_REMOVE_PER_OP[op_name_lowered])
     }
     inputs = [input_dict[name] for name in node.inputs]
-    return [ONNX_OP_TO_TF_OP[op_name_to_lower(node.op_type)] \
-              (*inputs, **attrs)]
+    return [ONNX_OP_TO_TF_OP[op_name_lowered](*inputs, **attrs)]
 
   @classmethod
   def get_data_format(cls, x_rank, support_cuda):
@@ -471,19 +869,51 @@ class TensorflowBackendBase(Backend):
 
   @classmethod
   def supports_device(cls, device):
-    if device == "CUDA":
-      local_device_protos = device_lib.list_local_devices()
-      return len(
-          [x.name for x in local_device_protos if x.device_type == 'GPU']) > 0
-    elif device == "CPU":
-      return True
-    return False
+    supported = _supported_devices.get(device)
+    if supported is None:
+      if device == "CUDA":
+        # Listing local devices initializes them, do it once per process.
+        local_device_protos = device_lib.list_local_devices()
+        supported = len([
+            x.name for x in local_device_protos if x.device_type == 'GPU'
+        ]) > 0
+      elif device == "CPU":
+        supported = True
+      else:
+        supported = False
+      _supported_devices[device] = supported
+    return supported
+
+  @classmethod
+  def get_device_plan(cls, device=None):
+    """
+    Device plan of a conversion.
+
+    Args:
+      device: ONNX device string the graph targets. None means the device
+        of the conversion running on this thread, or outside of any
+        conversion the default device of the host, CUDA when available.
+
+    Returns:
+      The DevicePlan of device, shared by all conversions targeting it.
+    """
+    if device is None:
+      plan = cls.get_conversion_option("device_plan")
+      if plan is not None:
+        return plan
+      device = "CUDA" if cls.supports_device("CUDA") else "CPU"
+    plan = _device_plans.get(device)
+    if plan is None:
+      plan = _device_plans.setdefault(device, DevicePlan(device))
+    return plan
 
 
 prepare = TensorflowBackendBase.prepare
 
 run_node = TensorflowBackendBase.run_node
 
+run_nodes = TensorflowBackendBase.run_nodes
+
 run_model = TensorflowBackendBase.run_model
 
 supports_device = TensorflowBackendBase.supports_device
@@ -3,51 +3,571 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+import multiprocessing
+import threading
+
+import numpy as np
 import tensorflow as tf
 
 from onnx.backend.base import BackendRep, namedtupledict
+import onnx.numpy_helper
+
+from onnx_tf import autotune
+from onnx_tf import chunking
+from onnx_tf.batching import prefetch_batches
+from onnx_tf.device_plan import DevicePlan
+from onnx_tf.input_pipeline import make_dataset
+from onnx_tf.session_config import make_session_config
+from onnx_tf.taps import TapStore
 
 
 class TensorflowRep(BackendRep):
+  """Backend representation of an ONNX model converted to Tensorflow.
+
+  A TensorflowRep is safe to share between threads: all calls to run go
+  through one session shared by every thread, and a call only builds its
+  own feed values and output tuple. Running never adds ops to the graph
+  nor installs it as the default graph, so concurrent calls do not
+  contend on any global Tensorflow state.
+
+  Args:
+    predict_net: The TensorflowNet to run.
+    session_options: Optional dict of options of the sessions created to
+      run predict_net, see onnx_tf.session_config.
+    tuning_path: Optional path of the file autotune saves its best trial
+      to when called without save_path.
+    max_batch_per_call: Optional number of rows above which run splits its
+      inputs with a dynamic first dimension into chunks run one after the
+      other.
+    memory_budget_bytes: Optional bound of the memory of the tensors
+      computed by a session run. run splits larger batches into chunks
+      whose size comes from the shapes of the intermediate tensors.
+  """
+
+  # Number of compiled callables kept for fetch sets passed to run as
+  # outputs, beyond the one fetching external_output.
+  callable_cache_size = 8
 
-  def __init__(self, predict_net):
+  # Whether the first chunked run of every fetch set also checks that two
+  # different rows run together give the results of the rows run apart.
+  # This catches mixes of rows the shapes do not show, at the cost of three
+  # extra session runs, and rejects graphs drawing random values.
+  check_chunk_rows = False
+
+  # Number of threads running the calls of run_async, None for one per
+  # CPU, and number of such calls admitted at a time, the others waiting
+  # in their event loop. Read when run_async is first called.
+  async_max_workers = None
+  async_queue_depth = 64
+
+  def __init__(self,
+               predict_net,
+               session_options=None,
+               tuning_path=None,
+               max_batch_per_call=None,
+               memory_budget_bytes=None):
     super(TensorflowRep, self).__init__()
     self.predict_net = predict_net
+    self._session_options = dict(session_options or {})
+    self.tuning_path = tuning_path
+    self.max_batch_per_call = max_batch_per_call
+    self.memory_budget_bytes = memory_budget_bytes
+    # Bytes of the tensors computed for one row, per fetch set, and fetch
+    # sets whose rows were checked to be computed independently.
+    self._sample_bytes = {}
+    self._independent_fetches = set()
+    # Indices of the inputs carrying the batch, found on first use.
+    self._batched_inputs = None
+    # Guards the lazy creation of the session and of compiled callables.
+    self._lock = threading.Lock()
+    # Long-lived session and the callable compiled for the default
+    # feeds (external_input) and fetches (external_output). Both are
+    # created on first use and released by close().
+    self._sess = None
+    self._run_callable = None
+    # Callables and output types for other fetch sets, least recently used
+    # first.
+    self._fetch_callables = OrderedDict()
+    # onnx_tf.async_run.AsyncRunner of run_async, created on first use.
+    self._async_runner = None
+    self._outputs_type = namedtupledict('Outputs',
+                                        self.predict_net.external_output)
+
+  @property
+  def sess(self):
+    """The persistent session running the graph of this representation.
+
+    The session is created on first access and the variables of the graph
+    are initialized exactly once, right after creation.
+    """
+    sess = self._sess
+    if sess is None:
+      with self._lock:
+        if self._sess is None:
+          sess = tf.Session(
+              graph=self.predict_net.graph, config=self._get_session_config())
+          self._init_variables(sess)
+          self._sess = sess
+        sess = self._sess
+    return sess
+
+  @property
+  def session_options(self):
+    """Options of the sessions created by this representation, a copy."""
+    return dict(self._session_options)
+
+  @session_options.setter
+  def session_options(self, options):
+    """Replace the session options. The current session is closed, the
+    next call to run creates one with the new options."""
+    make_session_config(options)
+    self.close()
+    self._session_options = dict(options or {})
+
+  def _get_session_config(self):
+    config = None
+    if self.predict_net.device is not None:
+      config = DevicePlan(self.predict_net.device).get_session_config()
+    return make_session_config(self._session_options, base=config)
+
+  def _init_variables(self, sess, scope=""):
+    """Initialize the variables of the graph of predict_net, imported under
+    scope in the graph of sess.
+
+    Initializers loaded as variables are assigned one at a time from their
+    TensorProtos, so that at most one of them is converted to an array at
+    a time.
+    """
+    predict_net = self.predict_net
+    if predict_net.init_op is not None:
+      sess.run(scope + predict_net.init_op.name)
+    for name, placeholder in predict_net.initializer_placeholders.items():
+      value = onnx.numpy_helper.to_array(predict_net.initializer_values[name])
+      sess.run(
+          scope + predict_net.initializer_assign_ops[name],
+          feed_dict={scope + placeholder: value})
+
+  def close(self):
+    """Close the session owned by this representation.
 
-  def run(self, inputs, **kwargs):
+    The calls of run_async already handed to a thread complete first, on
+    the session being closed; those still waiting for a thread run on a
+    new session. The representation stays usable; a new session is created
+    on the next call to run.
+    """
+    with self._lock:
+      async_runner, self._async_runner = self._async_runner, None
+    if async_runner is not None:
+      # Outside of the lock, which the running calls may take.
+      async_runner.shutdown(wait=True)
+    with self._lock:
+      if self._sess is not None:
+        self._sess.close()
+      self._sess = None
+      self._run_callable = None
+      self._fetch_callables.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _get_feed_values(self, inputs):
+    """Order the given inputs the way external_input lists them."""
+    if isinstance(inputs, dict):
+      return [inputs[key] for key in self.predict_net.external_input]
+    elif isinstance(inputs, list) or isinstance(inputs, tuple):
+      if len(self.predict_net.external_input) != len(inputs):
+        raise RuntimeError('Expected {} values for uninitialized '
+                           'graph inputs ({}), but got {}.'.format(
+                               len(self.predict_net.external_input),
+                               ', '.join(self.predict_net.external_input),
+                               len(inputs)))
+      return list(inputs)
+    # single input
+    return [inputs]
+
+  def run(self, inputs, outputs=None, run_options=None, **kwargs):
+    """Run the graph on inputs.
+
+    :param inputs: values of external_input, as a dict keyed by name, a
+    list in the order of external_input or a single value.
+    :param outputs: names of the tensors to fetch, any of
+    predict_net.tensor_dict including intermediate tensors. Defaults to
+    external_output. The outputs of Conv nodes folded with a
+    BatchNormalization are not part of it, see the fold_batch_norm option
+    of prepare.
+    :param run_options: optional tf.RunOptions of the run, e.g. with a
+    timeout_in_ms past which the run raises tf.errors.DeadlineExceededError.
+
+    :returns: the fetched values, as a namedtupledict keyed by name.
+    """
     super(TensorflowRep, self).run(inputs, **kwargs)
 
-    # TODO: handle name scope if necessary
-    with self.predict_net.graph.as_default():
-      with tf.Session() as sess:
-        if isinstance(inputs, dict):
-          feed_dict = inputs
-        elif isinstance(inputs, list) or isinstance(inputs, tuple):
-          if len(self.predict_net.external_input) != len(inputs):
-            raise RuntimeError('Expected {} values for uninitialized '
-                               'graph inputs ({}), but got {}.'.format(
-                                   len(self.predict_net.external_input),
-                                   ', '.join(self.predict_net.external_input),
-                                   len(inputs)))
-          feed_dict = dict(zip(self.predict_net.external_input, inputs))
-        else:
-          # single input
-          feed_dict = dict([(self.predict_net.external_input[0], inputs)])
-
-        feed_dict = {
-            self.predict_net.tensor_dict[key]: feed_dict[key]
-            for key in self.predict_net.external_input
-        }
-
-        sess.run(tf.global_variables_initializer())
-        external_output = [
-            self.predict_net.tensor_dict[output]
-            for output in self.predict_net.external_output
+    if outputs is None or list(outputs) == self.predict_net.external_output:
+      run_callable = self._run_callable
+      if run_callable is None:
+        sess = self.sess
+        with self._lock:
+          if self._run_callable is None:
+            self._run_callable = self._make_callable(
+                sess, self.predict_net.external_output)
+          run_callable = self._run_callable
+      outputs_type = self._outputs_type
+    else:
+      run_callable, outputs_type = self._get_fetch_callable(tuple(outputs))
+
+    feed_values = self._get_feed_values(inputs)
+    if (self.max_batch_per_call is not None or
+        self.memory_budget_bytes is not None):
+      output_values = self._run_chunked(
+          run_callable, tuple(outputs or self.predict_net.external_output),
+          feed_values, run_options)
+      if output_values is not None:
+        return outputs_type(*output_values)
+    output_values = run_callable(*feed_values, options=run_options)
+    return outputs_type(*output_values)
+
+  def _get_batched_inputs(self):
+    """Indices of the inputs of external_input carrying the batch."""
+    if self._batched_inputs is None:
+      tensor_dict = self.predict_net.tensor_dict
+      self._batched_inputs = [
+          i for i, name in enumerate(self.predict_net.external_input)
+          if chunking.is_batched(tensor_dict[name])
+      ]
+    return self._batched_inputs
+
+  def _run_chunked(self, run_callable, fetches, feed_values, run_options):
+    """Run feed_values in chunks when they hold more rows than a chunk.
+
+    Returns the output values, or None when the batch is to be run as a
+    whole: it fits in a chunk, or the graph has no input carrying a batch.
+    """
+    batched = self._get_batched_inputs()
+    if not batched or not all(np.ndim(feed_values[i]) for i in batched):
+      return None
+    rows = len(feed_values[batched[0]])
+    if rows <= 1 or (self.memory_budget_bytes is None and
+                     rows <= self.max_batch_per_call):
+      return None
+    chunk_size = self._get_chunk_size(fetches)
+    if chunk_size >= rows:
+      return None
+    feed_values = [
+        np.asarray(value) if i in batched else value
+        for i, value in enumerate(feed_values)
+    ]
+    if self.check_chunk_rows:
+      self._check_rows_independent(fetches, run_callable, feed_values)
+    return self._run_chunks(run_callable, feed_values, chunk_size,
+                            run_options)
+
+  def _slice_rows(self, feed_values, rows):
+    """feed_values with the inputs carrying the batch cut to rows, a slice
+    or a list of row indices, the other inputs as they are."""
+    batched = self._get_batched_inputs()
+    return [
+        value[rows] if i in batched else value
+        for i, value in enumerate(feed_values)
+    ]
+
+  def _get_chunk_size(self, fetches):
+    """Rows per chunk when fetching fetches, checking on first use that
+    every tensor computed keeps the batch as first dimension."""
+    sample_bytes = self._sample_bytes.get(fetches, False)
+    if sample_bytes is False:
+      tensor_dict = self.predict_net.tensor_dict
+      sample_bytes = chunking.get_sample_bytes(
+          [
+              tensor_dict[self.predict_net.external_input[i]]
+              for i in self._get_batched_inputs()
+          ], [tensor_dict[name] for name in fetches])
+      self._sample_bytes[fetches] = sample_bytes
+    return chunking.get_chunk_size(sample_bytes, self.max_batch_per_call,
+                                   self.memory_budget_bytes)
+
+  def _check_rows_independent(self, fetches, run_callable, feed_values):
+    """Check on first use that two different rows run together give the
+    results of the rows run apart, see check_chunk_rows."""
+    if fetches in self._independent_fetches:
+      return
+    batched = self._get_batched_inputs()
+    rows = len(feed_values[batched[0]])
+    # Identical rows would give the same results even when mixed.
+    other = next((row for row in range(1, rows) if any(
+        not np.array_equal(feed_values[i][row], feed_values[i][0])
+        for i in batched)), None)
+    if other is None:
+      return
+    try:
+      together = run_callable(*self._slice_rows(feed_values, [0, other]))
+      apart = [
+          run_callable(*self._slice_rows(feed_values, [row]))
+          for row in [0, other]
+      ]
+    except tf.errors.InvalidArgumentError as e:
+      raise ValueError("The graph cannot run on fewer rows, it mixes values "
+                       "across the batch and cannot run in chunks: "
+                       "{}".format(e.message))
+    for name, value, first, second in zip(fetches, together, *apart):
+      expected = np.concatenate([first, second])
+      if value.shape != expected.shape or not np.allclose(
+          value, expected, rtol=1e-4, atol=1e-5):
+        raise ValueError(
+            "Output {} of two rows run together differs from the rows run "
+            "apart, the graph mixes values across the batch and cannot run "
+            "in chunks.".format(name))
+    self._independent_fetches.add(fetches)
+
+  def _run_chunks(self, run_callable, feed_values, chunk_size, run_options):
+    """Run feed_values chunk_size rows at a time, gathering the outputs
+    in arrays allocated once."""
+    rows = len(feed_values[self._get_batched_inputs()[0]])
+    output_values = None
+    for start in range(0, rows, chunk_size):
+      end = min(start + chunk_size, rows)
+      chunk_values = run_callable(
+          *self._slice_rows(feed_values, slice(start, end)),
+          options=run_options)
+      if output_values is None:
+        output_values = [
+            np.empty((rows,) + value.shape[1:], dtype=value.dtype)
+            for value in chunk_values
         ]
+      for output, value in zip(output_values, chunk_values):
+        output[start:end] = value
+    return output_values
 
-        output_values = sess.run(external_output, feed_dict=feed_dict)
-        return namedtupledict('Outputs',
-                              self.predict_net.external_output)(*output_values)
+  def run_iter(self, samples, batch_size=32, prefetch=2, outputs=None):
+    """Run the graph over an iterable of samples, batch by batch.
+
+    A background thread reads samples and stacks them into batches while
+    the session runs the previous batch. At most prefetch batches are
+    prepared ahead, so memory stays bounded however many samples there
+    are. Samples are read lazily, as the outputs are consumed.
+
+    :param samples: iterable of the inputs of one sample each, without
+    batch dimension, as a dict keyed by name, a list in the order of
+    external_input or a single value.
+    :param batch_size: number of samples run at once. When the graph has a
+    static batch dimension it must be batch_size; the last batch is then
+    padded with copies of its last sample.
+    :param prefetch: number of batches prepared ahead of the session.
+    :param outputs: names of the tensors to fetch, as for run.
+
+    :returns: a generator of the outputs of every sample, in the order of
+    samples, as namedtupledicts keyed by name.
+    """
+    static_batch = any(
+        self.predict_net.tensor_dict[name].shape.ndims and
+        self.predict_net.tensor_dict[name].shape.as_list()[0] is not None
+        for name in self.predict_net.external_input)
+    for values in prefetch_batches(samples, self._get_feed_values, batch_size,
+                                   prefetch):
+      rows = len(values[0])
+      if static_batch and rows < batch_size:
+        values = [
+            np.concatenate([value] + [value[-1:]] * (batch_size - rows))
+            for value in values
+        ]
+      output_values = self.run(values, outputs=outputs)
+      for i in range(rows):
+        yield type(output_values)(*[value[i] for value in output_values])
+
+  def run_pipeline(self,
+                   source,
+                   batch_size=32,
+                   prefetch=2,
+                   outputs=None,
+                   num_parallel_calls=None):
+    """Run the graph over a source of samples read by a tf.data pipeline.
+
+    The graph is imported into a graph of its own, with its inputs wired
+    to the batches of the pipeline instead of placeholders. Reading,
+    parsing, batching and prefetching then run in the threads of
+    Tensorflow, and each batch is a session run without any feed.
+
+    :param source: source of the samples: a dict of arrays, np.memmap
+    arrays included, the path of a .npz file or of a directory of .npy
+    files named after the inputs, or TFRecord files of tf.train.Example.
+    See onnx_tf.input_pipeline.
+    :param batch_size: number of samples per batch, the last batch may be
+    smaller.
+    :param prefetch: number of batches prepared ahead of the graph.
+    :param outputs: names of the tensors to fetch, as for run.
+    :param num_parallel_calls: number of samples or batches read and parsed
+    in parallel, defaults to one per CPU.
+
+    :returns: a generator of the outputs of every batch, in the order of
+    the source, as namedtupledicts keyed by name.
+    """
+    outputs = list(outputs or self.predict_net.external_output)
+    tensor_dict = self.predict_net.tensor_dict
+    missing = [name for name in outputs if name not in tensor_dict]
+    if missing:
+      raise ValueError("Outputs {} are not tensors of the graph.".format(
+          ", ".join(missing)))
+    specs = OrderedDict(
+        (name, (tensor_dict[name].dtype, tensor_dict[name].shape.as_list()[1:]))
+        for name in self.predict_net.external_input)
+
+    graph = tf.Graph()
+    with graph.as_default():
+      dataset, iterator_feed = make_dataset(
+          source, specs, batch_size, prefetch,
+          num_parallel_calls=num_parallel_calls)
+      iterator = dataset.make_initializable_iterator()
+      batch = iterator.get_next()
+      fetches = tf.import_graph_def(
+          self.predict_net.graph.as_graph_def(),
+          input_map={tensor_dict[name].name: batch[name] for name in specs},
+          return_elements=[tensor_dict[name].name for name in outputs],
+          name="model")
+
+    outputs_type = namedtupledict('Outputs', outputs)
+    with tf.Session(graph=graph, config=self._get_session_config()) as sess:
+      self._init_variables(sess, scope="model/")
+      sess.run(iterator.initializer, feed_dict=iterator_feed)
+      run_callable = sess.make_callable(fetches)
+      while True:
+        try:
+          output_values = run_callable()
+        except tf.errors.OutOfRangeError:
+          return
+        yield outputs_type(*output_values)
+
+  def run_async(self, inputs, outputs=None, timeout_ms=None):
+    """Run the graph on inputs from an asyncio event loop.
+
+    Usage: outputs = await tf_rep.run_async(inputs)
+
+    The run is done by a pool of async_max_workers threads shared by all
+    the calls, on the persistent session. At most async_queue_depth calls
+    are admitted at a time, the others wait in the event loop for a slot.
+    Cancelling a call that is still waiting for a thread drops it; a call
+    that already runs completes, or stops after timeout_ms. Requires
+    Python 3.5 or later.
+
+    :param inputs: values of external_input, as for run.
+    :param outputs: names of the tensors to fetch, as for run.
+    :param timeout_ms: optional deadline of the session run, in
+    milliseconds, past which it raises tf.errors.DeadlineExceededError.
+
+    :returns: a coroutine returning the fetched values, as run does.
+    """
+    runner = self._async_runner
+    if runner is None:
+      from onnx_tf.async_run import AsyncRunner
+      with self._lock:
+        if self._async_runner is None:
+          self._async_runner = AsyncRunner(
+              self,
+              max_workers=(self.async_max_workers or
+                           multiprocessing.cpu_count()),
+              queue_depth=self.async_queue_depth)
+        runner = self._async_runner
+    return runner.run(inputs, outputs=outputs, timeout_ms=timeout_ms)
+
+  def _make_callable(self, sess, outputs):
+    tensor_dict = self.predict_net.tensor_dict
+    missing = [name for name in outputs if name not in tensor_dict]
+    if missing:
+      raise ValueError("Outputs {} are not tensors of the graph.".format(
+          ", ".join(missing)))
+    return sess.make_callable(
+        [tensor_dict[output] for output in outputs],
+        feed_list=[tensor_dict[key] for key in self.predict_net.external_input],
+        accept_options=True)
+
+  def _get_fetch_callable(self, outputs):
+    """Callable and output type fetching outputs, compiled on first use
+    and kept in a least recently used cache."""
+    sess = self.sess
+    with self._lock:
+      entry = self._fetch_callables.pop(outputs, None)
+      if entry is None:
+        entry = (self._make_callable(sess, outputs),
+                 namedtupledict('Outputs', outputs))
+      self._fetch_callables[outputs] = entry
+      while len(self._fetch_callables) > self.callable_cache_size:
+        self._fetch_callables.popitem(last=False)
+    return entry
+
+  def run_taps(self, inputs, names=None, store_dir=None):
+    """Fetch intermediate tensors of the graph in a single run.
+
+    This is meant for debugging a conversion layer by layer, see
+    onnx_tf.taps.compare_taps to check the result against reference values.
+
+    :param inputs: values of external_input, as for run.
+    :param names: names of the tensors to fetch, any of
+    predict_net.tensor_dict. Defaults to all the tensors produced by nodes,
+    in graph order. The outputs of Conv nodes folded with a
+    BatchNormalization are not among them; prepare the model with
+    fold_batch_norm=False to compare every layer with a reference.
+    :param store_dir: optional directory of an onnx_tf.taps.TapStore. The
+    tensors are then written to it one at a time and returned
+    memory-mapped instead of held in memory.
+
+    :returns: an OrderedDict of the fetched values keyed by name, or the
+    TapStore when store_dir is given.
+    """
+    if names is None:
+      names = self.predict_net.node_outputs
+    names = list(OrderedDict.fromkeys(names))
+    values = list(self.run(inputs, outputs=names))
+    if store_dir is None:
+      return OrderedDict(zip(names, values))
+
+    def release_values():
+      for i, name in enumerate(names):
+        value, values[i] = values[i], None
+        yield name, value
+
+    store = TapStore(store_dir)
+    store.save_all(release_values())
+    return store
+
+  def autotune(self,
+               sample_inputs,
+               budget_seconds=30.,
+               batch_sizes=None,
+               objective="throughput",
+               save_path=None):
+    """Find the thread counts and batch size running fastest on this host.
+
+    Every pair of thread counts of onnx_tf.autotune.get_thread_configs is
+    timed with every batch size, within budget_seconds overall. The
+    representation keeps the session options of the best trial, which is
+    saved to save_path, or to tuning_path when save_path is None, so that
+    prepare can start other processes with it.
+
+    :param sample_inputs: values of external_input, as for run. Their rows
+    are repeated or cut to each batch size.
+    :param budget_seconds: total time spent timing runs.
+    :param batch_sizes: batch sizes to try. Defaults to a few sizes up to 64
+    when the inputs have a dynamic batch dimension, else to the batch size
+    of sample_inputs.
+    :param objective: "throughput" to maximize samples per second,
+    "latency" to minimize the p99 latency of a run.
+    :param save_path: optional path of the JSON file to save the best trial
+    to.
+
+    :returns: the list of onnx_tf.autotune.Trial, best first.
+    """
+    trials = autotune.autotune(
+        self,
+        sample_inputs,
+        budget_seconds=budget_seconds,
+        batch_sizes=batch_sizes,
+        objective=objective)
+    save_path = save_path or self.tuning_path
+    if save_path is not None:
+      autotune.save_tuning(save_path, trials[0])
+    return trials
 
   def export_graph(self, path):
     """Export backend representation to a Tensorflow proto file.
@@ -56,6 +576,10 @@ class TensorflowRep(BackendRep):
     model associated with the backend representation and serializes
     to a protobuf file.
 
+    Initializers loaded as variables are not part of the graph proto;
+    their values are saved to a Tensorflow checkpoint with prefix
+    path + ".ckpt", keyed by the ONNX initializer names.
+
     :param path: the path to the output TF protobuf file.
 
     :returns: none.
@@ -64,3 +588,8 @@ class TensorflowRep(BackendRep):
     file = open(path, "wb")
     file.write(graph_proto.SerializeToString())
     file.close()
+
+    if self.predict_net.saver is not None:
+      self.predict_net.saver.save(
+          self.sess, path + ".ckpt", write_meta_graph=False,
+          write_state=False)
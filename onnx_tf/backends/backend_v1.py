@@ -8,7 +8,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from functools import partial
-import itertools
 import warnings
 
 try:
@@ -62,144 +61,97 @@ class TensorflowBackend(TensorflowBackendBase):
     return [tf.argmin(data, axis=axis)]
 
   @classmethod
-  def _compatibility_pool(cls, node, input_dict, pooling_type):
-
-    def _get_pad_shape(auto_pad, input_spatial_shape, kernel_spatial_shape,
-                       strides_spatial, output_spatial_shape):
-      pad_shape = [0] * len(input_spatial_shape)
-      if auto_pad in ("SAME_UPPER", "SAME_LOWER"):
-        for i in range(len(input_spatial_shape)):
-          pad_shape[i] = (output_spatial_shape[i] - 1) * strides_spatial[i] + kernel_spatial_shape[i] - \
-                         input_spatial_shape[i]
-      elif auto_pad in ("VALID", ""):
-        pass
-      return pad_shape
-
-    def _get_output_shape(auto_pad, input_spatial_shape, kernel_spatial_shape,
-                          strides_spatial):
-      out_shape = [0] * len(input_spatial_shape)
-      if auto_pad in ("SAME_UPPER", "SAME_LOWER"):
-        for i in range(len(input_spatial_shape)):
-          out_shape[i] = int(
-              np.ceil(
-                  float(input_spatial_shape[i]) / float(strides_spatial[i])))
-      elif auto_pad in ("VALID", ""):
-        for i in range(len(input_spatial_shape)):
-          out_shape[i] = int(
-              np.ceil(
-                  float(input_spatial_shape[i] - (kernel_spatial_shape[i] - 1))
-                  / float(strides_spatial[i])))
-      return out_shape
-
-    def py_pool(x, kernel_shape, strides_shape, pads, out_shape, pad_shape,
-                pooling_type):
-      pooling_type = pooling_type.decode('UTF-8')
-      x_shape = np.shape(x)
-      spatial_size = len(x_shape[2:])
-      pad_attr = [(0, 0), (0, 0)] + [
-          (pads[i], pads[i + spatial_size]) for i in range(spatial_size)
-      ]
-      padded = np.pad(x, pad_attr, mode="constant", constant_values=np.nan)
-
-      y = np.zeros([x_shape[0], x_shape[1]] + list(out_shape))
-
-      for shape in itertools.product(
-          range(x_shape[0]), range(x_shape[1]), *[
-              range(
-                  int((x_shape[i + 2] + pad_shape[i] - kernel_shape[i]
-                      ) / strides_shape[i] + 1)) for i in range(spatial_size)
-          ]):
-        window = padded[shape[0], shape[1]]
-        window_vals = np.array([
-            window[i] for i in list(
-                itertools.product(*[
-                    range(strides_shape[i] * shape[i + 2],
-                          strides_shape[i] * shape[i + 2] + kernel_shape[i])
-                    for i in range(spatial_size)
-                ]))
-        ])
-        if pooling_type == 'AVG':
-          f = np.average
-        elif pooling_type == 'MAX':
-          f = np.max
-        else:
-          raise NotImplementedError(
-              'Pooling type {} does not support. Should be AVG, MAX'.format(
-                  pooling_type))
-        y[shape] = f(window_vals[np.where(~np.isnan(window_vals))])
-      return y.astype(np.float32)
-
-    x = input_dict[node.inputs[0]]
-    x_shape = x.shape.as_list()
-    spatial_size = len(x_shape[2:])
-    kernel_shape = node.attrs["kernel_shape"]
-    strides_shape = node.attrs.get("strides", [1] * spatial_size)
-    pads = node.attrs.get("pads", [0] * spatial_size * 2)
-    auto_pad = node.attrs.get("auto_pad", "")
-
-    # Only auto_pad in ("SAME_LOWER", "") will come here.
-    if auto_pad == "SAME_LOWER":
-      out_shape = _get_output_shape(auto_pad, x_shape[2:], kernel_shape,
-                                    strides_shape)
-      pad_shape = _get_pad_shape(auto_pad, x_shape[2:], kernel_shape,
-                                 strides_shape, out_shape)
-      for i in range(spatial_size):
-        pads[i + spatial_size] = pad_shape[i] // 2
-        pads[i] = pad_shape[i] - pads[i + spatial_size]
-    elif auto_pad == "":
-      pad_shape = [
-          pads[i] + pads[i + spatial_size] for i in range(spatial_size)
-      ]
-      out_shape = _get_output_shape(auto_pad, np.add(x_shape[2:], pad_shape),
-                                    kernel_shape, strides_shape)
-
-    pooled = tf.py_func(py_pool, [
-        x, kernel_shape, strides_shape, pads, out_shape, pad_shape, pooling_type
-    ], tf.float32)
-    pooled.set_shape(x_shape[0:2] + out_shape)
-    return [pooled]
+  def _get_same_lower_pads(cls, input_spatial_shape, kernel_shape, strides):
+    # Output size is ceil(input / stride); the odd padding element goes to
+    # the beginning of each spatial dimension.
+    num_sp_dim = len(input_spatial_shape)
+    pads = [0] * num_sp_dim * 2
+    for i in range(num_sp_dim):
+      output_size = int(
+          np.ceil(float(input_spatial_shape[i]) / float(strides[i])))
+      pad_total = max(0, (output_size - 1) * strides[i] + kernel_shape[i] -
+                      input_spatial_shape[i])
+      pads[i + num_sp_dim] = pad_total // 2
+      pads[i] = pad_total - pads[i + num_sp_dim]
+    return pads
 
   @classmethod
   def _pool(cls, node, input_dict, pool_func, pooling_type):
     x = input_dict[node.inputs[0]]
-    x_rank = len(x.get_shape())
+    x_shape = x.get_shape().as_list()
+    x_rank = len(x_shape)
+    num_sp_dim = x_rank - 2
 
-    support_cuda = cls.supports_device("CUDA")
+    support_cuda = cls.get_device_plan().support_cuda
     storage_format, compute_format = cls.get_data_format(x_rank, support_cuda)
 
     kernel_shape = node.attrs["kernel_shape"]
-    strides = node.attrs.get("strides", [1] * (x_rank - 2))
-
-    # By default, do not pad
-    pad = None
+    strides = node.attrs.get("strides", [1] * num_sp_dim)
+    pads = node.attrs.get("pads", [0] * num_sp_dim * 2)
+    auto_pad = node.attrs.get("auto_pad", "")
 
-    if "auto_pad" in node.attrs:
-      if node.attrs["auto_pad"] == "SAME_UPPER":
-        pad = "SAME"
-      elif node.attrs["auto_pad"] == "VALID":
-        pad = "VALID"
-      elif node.attrs["auto_pad"] == "SAME_LOWER":
-        pad = None
+    if auto_pad == "SAME_UPPER":
+      pad = "SAME"
+    elif auto_pad == "VALID":
+      pad = "VALID"
+    else:
+      if auto_pad == "SAME_LOWER":
+        pads = cls._get_same_lower_pads(x_shape[2:], kernel_shape, strides)
+      # Explicit (possibly asymmetric) pads are applied with tf.pad, then
+      # the padded tensor is pooled without further padding.
+      pad = "VALID"
 
-    if pad is None:
-      return cls._compatibility_pool(node, input_dict, pooling_type)
+    if not support_cuda:
+      x = cls._transpose(
+          x, perm=cls.get_perm_from_formats(storage_format, compute_format))
 
-    if support_cuda:
-      pooled = pool_func(
-          x,
-          kernel_shape,
-          padding=pad,
-          strides=strides,
-          data_format=compute_format)
+    if any(pads):
+      paddings = [[0, 0]] * x_rank
+      for i in range(num_sp_dim):
+        paddings[compute_format.find(storage_format[i + 2])] = [
+            pads[i], pads[i + num_sp_dim]
+        ]
+
+      if pooling_type == "MAX":
+        # Padded elements never win the max.
+        pooled = pool_func(
+            tf.pad(x, paddings, constant_values=float("-inf")),
+            kernel_shape,
+            padding=pad,
+            strides=strides,
+            data_format=compute_format)
+      else:
+        # Padded elements are excluded from the average: divide the average
+        # over zero padded input by the fraction of real elements in each
+        # window, which only depends on the spatial position.
+        spatial_shape = x_shape[2:]
+        if None in spatial_shape:
+          ones = tf.ones_like(x)
+        else:
+          ones = tf.ones(
+              [spatial_shape[storage_format.find(d) - 2]
+               if d in storage_format[2:] else 1 for d in compute_format],
+              dtype=x.dtype)
+        pooled = pool_func(
+            tf.pad(x, paddings),
+            kernel_shape,
+            padding=pad,
+            strides=strides,
+            data_format=compute_format) / pool_func(
+                tf.pad(ones, paddings),
+                kernel_shape,
+                padding=pad,
+                strides=strides,
+                data_format=compute_format)
     else:
-      x = tf.transpose(
-          x, perm=cls.get_perm_from_formats(storage_format, compute_format))
       pooled = pool_func(
           x,
           kernel_shape,
           padding=pad,
           strides=strides,
           data_format=compute_format)
+
+    if not support_cuda:
       pooled = tf.transpose(
           pooled,
           perm=cls.get_perm_from_formats(compute_format, storage_format))
@@ -274,16 +226,16 @@ class TensorflowBackend(TensorflowBackendBase):
   @classmethod
   def handle_constant(cls, node, input_dict):
     value = node.attrs["value"]
-    elements = onnx.numpy_helper.to_array(value).flatten().tolist()
+    elements = onnx.numpy_helper.to_array(value)
     dtype = ONNX_TYPE_TO_TF_TYPE[value.data_type]
-    return [tf.constant(elements, dtype=dtype, shape=value.dims)]
+    return [tf.constant(elements, dtype=dtype)]
 
   @classmethod
   def _conv(cls, node, input_dict, transpose=False):
     x = input_dict[node.inputs[0]]
     x_rank = len(x.get_shape())
 
-    support_cuda = cls.supports_device("CUDA")
+    support_cuda = cls.get_device_plan().support_cuda
     storage_format, compute_format = cls.get_data_format(x_rank, support_cuda)
 
     in_weights = input_dict[node.inputs[1]]
@@ -308,86 +260,109 @@ class TensorflowBackend(TensorflowBackendBase):
     dilations = node.attrs.get("dilations", None)
     strides = node.attrs.get("strides", None)
 
-    if "pads" in node.attrs.keys():
-      x = cls.get_padding_as_op(x, node.attrs["pads"])
-
-    if "group" in node.attrs:
-
-      weight_groups = tf.split(
-          weights, num_or_size_splits=node.attrs["group"], axis=-1)
+    if not support_cuda:
+      x = cls._transpose(
+          x, perm=cls.get_perm_from_formats(storage_format, compute_format))
 
-      if support_cuda:
-        xs = tf.split(x, num_or_size_splits=node.attrs["group"], axis=1)
-      else:
-        x = tf.transpose(
-            x, perm=cls.get_perm_from_formats(storage_format, compute_format))
-        xs = tf.split(x, num_or_size_splits=node.attrs["group"], axis=-1)
-
-      convolved = [
-          tf.nn.convolution(
-              x,
-              weight,
-              "VALID",
-              strides=strides,
-              dilation_rate=dilations,
-              data_format=compute_format)
-          for (x, weight) in zip(xs, weight_groups)
-      ]
+    if "pads" in node.attrs.keys():
+      x = cls.get_padding_as_op(x, node.attrs["pads"], compute_format)
 
-      if len(node.inputs) == 2:
-        if support_cuda:
-          output = tf.concat(convolved, axis=1)
-        else:
-          output = tf.concat(convolved, axis=-1)
-          output = tf.transpose(
-              output,
-              perm=cls.get_perm_from_formats(compute_format, storage_format))
-      else:
-        bias = input_dict[node.inputs[2]]
+    group = node.attrs.get("group", 1)
+    weights_shape = in_weights.get_shape().as_list()
+    spatial_strides = strides or [1] * (x_rank - 2)
+    spatial_dilations = dilations or [1] * (x_rank - 2)
 
-        if support_cuda:
-          output = tf.concat(convolved, axis=1)
-          output = tf.nn.bias_add(output, bias, data_format=compute_format)
-        else:
-          output = tf.concat(convolved, axis=-1)
-          output = tf.nn.bias_add(output, bias, data_format=compute_format)
-          output = tf.transpose(
-              output,
-              perm=cls.get_perm_from_formats(compute_format, storage_format))
-
-      return [output]
+    if group == 1:
+      convolved = tf.nn.convolution(
+          x,
+          weights,
+          "VALID",
+          strides=strides,
+          dilation_rate=dilations,
+          data_format=compute_format)
+    elif (not transpose and x_rank == 4 and None not in weights_shape and
+          weights_shape[1] == 1 and
+          spatial_strides[0] == spatial_strides[1] and
+          (spatial_strides[0] == 1 or spatial_dilations == [1, 1])):
+      # group == C: one depthwise conv instead of C single channel convs.
+      convolved = cls._depthwise_conv(x, in_weights, group, spatial_strides,
+                                      spatial_dilations, compute_format)
+    elif (not transpose and compute_format.endswith("C") and
+          all(d == 1 for d in weights_shape[2:])):
+      # Grouped pointwise conv: one batched matmul over the groups.
+      convolved = cls._grouped_pointwise_conv(x, in_weights, group,
+                                              spatial_strides)
+    else:
+      weight_groups = tf.split(weights, num_or_size_splits=group, axis=-1)
+      xs = tf.split(
+          x,
+          num_or_size_splits=group,
+          axis=1 if compute_format.startswith("NC") else -1)
+      convolved = tf.concat(
+          [
+              tf.nn.convolution(
+                  x,
+                  weight,
+                  "VALID",
+                  strides=strides,
+                  dilation_rate=dilations,
+                  data_format=compute_format)
+              for (x, weight) in zip(xs, weight_groups)
+          ],
+          axis=1 if compute_format.startswith("NC") else -1)
+
+    if len(node.inputs) > 2:
+      # Add the bias while still in compute format.
+      bias = input_dict[node.inputs[2]]
+      convolved = tf.nn.bias_add(convolved, bias, data_format=compute_format)
 
     if not support_cuda:
-      x = tf.transpose(
-          x, perm=cls.get_perm_from_formats(storage_format, compute_format))
+      convolved = tf.transpose(
+          convolved,
+          perm=cls.get_perm_from_formats(compute_format, storage_format))
 
-    convolved = tf.nn.convolution(
+    return [convolved]
+
+  @classmethod
+  def _depthwise_conv(cls, x, in_weights, channels, strides, dilations,
+                      compute_format):
+    """Conv with as many groups as input channels, x in compute format."""
+    # Translate weights from (C * mult x 1 x KH x KW) to (KH x KW x C x mult)
+    kernel_h, kernel_w = in_weights.get_shape().as_list()[2:]
+    weights = tf.reshape(
+        tf.transpose(in_weights, [2, 3, 1, 0]),
+        [kernel_h, kernel_w, channels, -1])
+    if compute_format == "NHWC":
+      conv_strides = [1] + strides + [1]
+    else:
+      conv_strides = [1, 1] + strides
+    return tf.nn.depthwise_conv2d(
         x,
         weights,
+        conv_strides,
         "VALID",
-        strides=strides,
-        dilation_rate=dilations,
+        rate=dilations,
         data_format=compute_format)
 
-    if not support_cuda:
-      convolved = tf.transpose(
-          convolved,
-          perm=cls.get_perm_from_formats(compute_format, storage_format))
+  @classmethod
+  def _grouped_pointwise_conv(cls, x, in_weights, group, strides):
+    """Grouped conv with a 1 x ... x 1 kernel, x in channels last format.
 
-    if len(node.inputs) == 2:
-      return [convolved]
-    else:
-      bias = input_dict[node.inputs[2]]
-      if not support_cuda:
-        convolved = tf.transpose(
-            convolved,
-            perm=cls.get_perm_from_formats(storage_format, compute_format))
-      output = tf.nn.bias_add(convolved, bias, data_format=compute_format)
-      if not support_cuda:
-        output = tf.transpose(
-            output,
-            perm=cls.get_perm_from_formats(compute_format, storage_format))
-      return [output]
+    Every group is a matrix product of its input channels, so that all of
+    them are computed by a single batched matmul.
+    """
+    out_channels, group_channels = in_weights.get_shape().as_list()[:2]
+    if any(stride != 1 for stride in strides):
+      x = x[tuple([slice(None)] + [slice(None, None, s) for s in strides])]
+    out_shape = tf.concat([tf.shape(x)[:-1], [out_channels]], axis=0)
+    # (P x G x C / G) -> (G x P x C / G)
+    x = tf.transpose(tf.reshape(x, [-1, group, group_channels]), [1, 0, 2])
+    # (M x C / G x 1 ... 1) -> (G x C / G x M / G)
+    weights = tf.transpose(
+        tf.reshape(in_weights, [group, out_channels // group, group_channels]),
+        [0, 2, 1])
+    y = tf.transpose(tf.matmul(x, weights), [1, 0, 2])
+    return tf.reshape(y, out_shape)
 
   @classmethod
   def handle_conv(cls, node, input_dict):
@@ -401,13 +376,13 @@ class TensorflowBackend(TensorflowBackendBase):
   def handle_depth_to_space(cls, node, input_dict):
     x = input_dict[node.inputs[0]]
     x_rank = len(x.get_shape())
-    support_cuda = cls.supports_device("CUDA")
+    support_cuda = cls.get_device_plan().support_cuda
     storage_format, compute_format = cls.get_data_format(x_rank, support_cuda)
     if support_cuda:
       y = tf.depth_to_space(
           x, block_size=node.attrs["blocksize"], data_format=compute_format)
     else:
-      x = tf.transpose(
+      x = cls._transpose(
           x, perm=cls.get_perm_from_formats(storage_format, compute_format))
       y = tf.depth_to_space(
           x, block_size=node.attrs["blocksize"], data_format=compute_format)
@@ -551,7 +526,7 @@ class TensorflowBackend(TensorflowBackendBase):
     # TODO: LRN in tf accepts radius
     # but in ONNX/Caffe accepts diameter.
     # This could be a problem.
-    x_t = tf.transpose(x, perm=[0, 2, 3, 1])
+    x_t = cls._transpose(x, perm=[0, 2, 3, 1])
     normed = tf.nn.lrn(
         x_t, depth_radius=depth_radius, bias=bias, alpha=tf_alpha, beta=beta)
     normed = tf.transpose(normed, perm=[0, 3, 1, 2])
@@ -823,13 +798,13 @@ class TensorflowBackend(TensorflowBackendBase):
   def handle_space_to_depth(cls, node, input_dict):
     x = input_dict[node.inputs[0]]
     x_rank = len(x.get_shape())
-    support_cuda = cls.supports_device("CUDA")
+    support_cuda = cls.get_device_plan().support_cuda
     storage_format, compute_format = cls.get_data_format(x_rank, support_cuda)
     if support_cuda:
       y = tf.space_to_depth(
           x, block_size=node.attrs["blocksize"], data_format=compute_format)
     else:
-      x = tf.transpose(
+      x = cls._transpose(
           x, perm=cls.get_perm_from_formats(storage_format, compute_format))
       y = tf.space_to_depth(
           x, block_size=node.attrs["blocksize"], data_format=compute_format)
@@ -858,8 +833,8 @@ class TensorflowBackend(TensorflowBackendBase):
     x = input_dict[node.inputs[0]]
     axis = input_dict[node.inputs[1]]
     tiles = input_dict[node.inputs[2]]
-    multiples = tf.Variable([1] * len(x.shape))
-    multiples = multiples[axis].assign(tiles)
+    multiples = tf.one_hot(
+        axis, len(x.shape), on_value=tiles, off_value=1, dtype=tiles.dtype)
     return [tf.tile(x, multiples=multiples)]
 
   @classmethod
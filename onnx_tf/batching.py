@@ -0,0 +1,261 @@
+"""Coalescing of concurrent requests, or of the samples of an iterable, to
+a TensorflowRep into batches.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import numpy as np
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+
+class _Request(object):
+
+  def __init__(self, values, bucket):
+    self.values = values
+    self.bucket = bucket
+    self.rows = len(values[0])
+    self.arrival = time.time()
+    self.done = threading.Event()
+    self.outputs = None
+    self.error = None
+
+
+class MicroBatcher(object):
+  """Front end of a TensorflowRep running concurrent requests as batches.
+
+  Callers of run block while a background thread concatenates their
+  inputs along the first dimension with those of other pending requests,
+  runs the batch in one session call and hands every caller its rows of
+  the outputs. A batch is run as soon as it holds max_batch_size rows or
+  its oldest request has waited max_latency_ms. Requests larger than
+  max_batch_size are run alone.
+
+  Only requests whose inputs agree in dtype and non-batch dimensions are
+  batched together, other requests wait for a batch of their own. With pad
+  set, requests whose inputs agree in rank and dtype are batched together
+  instead, their inputs zero padded at the end of every non-batch
+  dimension to the largest request of the batch. The outputs are then
+  those of the padded inputs, and the caller has to mask the padding out.
+
+  The graph must treat the rows of a batch independently and every output
+  must have the batch dimension first.
+
+  Args:
+    tf_rep: The TensorflowRep to run. Its inputs need a dynamic batch
+      dimension, unless max_batch_size is 1.
+    max_batch_size: Number of rows above which no more requests are added
+      to a batch.
+    max_latency_ms: Longest time a request waits for others to batch with.
+    pad: Whether to pad inputs differing in non-batch dimensions.
+  """
+
+  def __init__(self, tf_rep, max_batch_size=32, max_latency_ms=5., pad=False):
+    self.tf_rep = tf_rep
+    self.max_batch_size = max_batch_size
+    self.max_latency = max_latency_ms / 1000.
+    self.pad = pad
+    # Requests not batched yet, oldest first.
+    self._pending = []
+    self._cond = threading.Condition()
+    self._closed = False
+    self._thread = threading.Thread(target=self._serve)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def run(self, inputs):
+    """Run inputs within a batch, from any thread.
+
+    :param inputs: values of external_input, as for TensorflowRep.run,
+    with the batch dimension first.
+
+    :returns: the rows of the outputs computed from inputs, as a
+    namedtupledict keyed by name.
+    """
+    values = [
+        np.asarray(value) for value in self.tf_rep._get_feed_values(inputs)
+    ]
+    request = _Request(values, self._get_bucket(values))
+    with self._cond:
+      if self._closed:
+        raise RuntimeError("The micro batcher is closed.")
+      self._pending.append(request)
+      self._cond.notify()
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.outputs
+
+  def close(self):
+    """Run the pending requests, then stop the batching thread."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _get_bucket(self, values):
+    if self.pad:
+      return tuple((value.ndim, value.dtype.str) for value in values)
+    return tuple((value.shape[1:], value.dtype.str) for value in values)
+
+  def _select(self, bucket):
+    """The oldest pending requests of bucket fitting in a batch, and
+    their number of rows."""
+    batch, rows = [], 0
+    for request in self._pending:
+      if request.bucket != bucket:
+        continue
+      if batch and rows + request.rows > self.max_batch_size:
+        break
+      batch.append(request)
+      rows += request.rows
+    return batch, rows
+
+  def _next_batch(self):
+    """Wait for the next batch to run, None once closed and drained."""
+    with self._cond:
+      while not self._pending and not self._closed:
+        self._cond.wait()
+      if not self._pending:
+        return None
+      first = self._pending[0]
+      deadline = first.arrival + self.max_latency
+      while True:
+        batch, rows = self._select(first.bucket)
+        timeout = deadline - time.time()
+        if rows >= self.max_batch_size or self._closed or timeout <= 0:
+          break
+        self._cond.wait(timeout)
+      selected = set(id(request) for request in batch)
+      self._pending = [
+          request for request in self._pending
+          if id(request) not in selected
+      ]
+      return batch
+
+  def _serve(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      try:
+        self._run_batch(batch)
+      except Exception as e:  # pylint: disable=broad-except
+        for request in batch:
+          request.error = e
+      for request in batch:
+        request.done.set()
+
+  def _run_batch(self, batch):
+    if len(batch) == 1:
+      outputs = self.tf_rep.run(batch[0].values)
+    else:
+      outputs = self.tf_rep.run([
+          np.concatenate(self._pad_values([r.values[i] for r in batch]))
+          for i in range(len(batch[0].values))
+      ])
+    rows = sum(request.rows for request in batch)
+    for name, output in zip(outputs._fields, outputs):
+      if np.ndim(output) == 0 or len(output) != rows:
+        raise ValueError("Output {} does not have the batch dimension "
+                         "first, it cannot be split between requests.".format(
+                             name))
+    start = 0
+    for request in batch:
+      end = start + request.rows
+      request.outputs = type(outputs)(*[output[start:end]
+                                        for output in outputs])
+      start = end
+
+  def _pad_values(self, values):
+    """Zero pad values to the largest of each of their non-batch
+    dimensions."""
+    if not self.pad or values[0].ndim < 2:
+      return values
+    shape = np.max([value.shape[1:] for value in values], axis=0)
+    return [
+        np.pad(value, [(0, 0)] + [(0, d - s) for d, s in zip(
+            shape, value.shape[1:])], "constant") for value in values
+    ]
+
+
+class _EndOfInputs(object):
+
+  def __init__(self, error=None):
+    self.error = error
+
+
+def prefetch_batches(samples, get_feed_values, batch_size, prefetch):
+  """
+  Stack the samples of an iterable into batches on a background thread.
+
+  At most prefetch batches are held ahead of the consumer, so that memory
+  stays bounded whatever the length of samples. The thread stops when the
+  generator is closed or garbage collected.
+
+  Args:
+    samples: Iterable of inputs of one sample each, without batch
+      dimension, in any form get_feed_values accepts.
+    get_feed_values: Function ordering the inputs of a sample as a list.
+    batch_size: Number of samples of a batch, the last one may be smaller.
+    prefetch: Number of batches prepared ahead.
+
+  Yields:
+    Lists of batched input values, one per input.
+  """
+  batches = queue.Queue(maxsize=max(1, prefetch))
+  stop = threading.Event()
+
+  def put(item):
+    # Give up once the consumer is gone, it would never take item.
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      batch = []
+      for sample in samples:
+        batch.append([np.asarray(value) for value in get_feed_values(sample)])
+        if len(batch) == batch_size:
+          if not put([np.stack(values) for values in zip(*batch)]):
+            return
+          batch = []
+      if batch:
+        if not put([np.stack(values) for values in zip(*batch)]):
+          return
+      put(_EndOfInputs())
+    except Exception as e:  # pylint: disable=broad-except
+      put(_EndOfInputs(e))
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      batch = batches.get()
+      if isinstance(batch, _EndOfInputs):
+        if batch.error is not None:
+          raise batch.error
+        return
+      yield batch
+  finally:
+    stop.set()
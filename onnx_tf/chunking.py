@@ -0,0 +1,177 @@
+"""Splitting of oversized batches into chunks run one after the other, see
+the max_batch_per_call and memory_budget_bytes options of TensorflowRep.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+from tensorflow.python.framework import tensor_util
+
+# Ops whose outputs describe the shape of their input rather than its
+# values, so that they carry no batch data.
+SHAPE_OP_TYPES = frozenset(["Shape", "ShapeN", "Size", "Rank"])
+
+
+def _get_ancestors(fetches):
+  ops = set()
+  pending = [tensor.op for tensor in fetches]
+  while pending:
+    op = pending.pop()
+    if op in ops:
+      continue
+    ops.add(op)
+    pending.extend(tensor.op for tensor in op.inputs)
+    pending.extend(op.control_inputs)
+  return ops
+
+
+def is_batched(tensor):
+  """Whether tensor may carry a batch: its first dimension is dynamic, or
+  its rank is unknown. Inputs with a static first dimension, e.g. a batch
+  of one fixed by the model, are run as a whole."""
+  shape = tensor.shape
+  return shape.ndims is None or (shape.ndims > 0 and
+                                 shape.as_list()[0] is None)
+
+
+def _mixes_rows(tensor, axis):
+  return ValueError(
+      "Tensor {} of shape {} is not batched along dimension {}, its graph "
+      "mixes values across the batch and cannot run in chunks.".format(
+          tensor.name, tensor.shape, axis))
+
+
+def _get_non_batch_elements(dims, axis):
+  """Number of elements of the dimensions other than axis, None if one is
+  unknown."""
+  other_dims = dims[:axis] + dims[axis + 1:]
+  if None in other_dims:
+    return None
+  return int(np.prod(other_dims))
+
+
+def _get_layout(op, tensor, layouts):
+  """
+  Batch layout of an output of op, from the layouts of its batched inputs.
+
+  A layout is a pair of the dimension holding the batch and the number of
+  entries of that dimension per row, None when unknown. Reshape may merge
+  the batch with the following dimensions, e.g. to run a grouped 1x1 Conv
+  as one matmul over all pixels, and Transpose moves it to another
+  dimension; any other op keeps the layout of its inputs.
+
+  Raises:
+    ValueError: the batch dimension is static, missing or mixed with others.
+  """
+  batched = [layouts[t] for t in op.inputs if t in layouts]
+  axis, rows = batched[0]
+  if any(input_axis != axis for input_axis, _ in batched):
+    raise _mixes_rows(tensor, axis)
+  shape = tensor.shape
+  if shape.ndims is None:
+    return axis, None
+  dims = shape.as_list()
+
+  if op.type == "Transpose":
+    perm = tensor_util.constant_value(op.inputs[1])
+    if perm is None:
+      return axis, None
+    axis = list(perm).index(axis)
+  elif op.type == "Reshape":
+    # Reshape keeps the elements in order: the batch can only stay the
+    # leading dimension, and only the row count of the input is kept.
+    if axis != 0 or not dims or dims[0] is not None:
+      raise _mixes_rows(tensor, 0)
+    in_shape = op.inputs[0].shape
+    in_elements = None
+    if in_shape.ndims is not None and rows is not None:
+      in_elements = _get_non_batch_elements(in_shape.as_list(), 0)
+    out_elements = _get_non_batch_elements(dims, 0)
+    if in_elements is None or out_elements is None:
+      return 0, None
+    # A row must span a whole number of entries of the new dimension.
+    if (rows * in_elements) % out_elements:
+      raise _mixes_rows(tensor, 0)
+    return 0, rows * in_elements // out_elements
+
+  if axis >= len(dims) or dims[axis] is not None:
+    raise _mixes_rows(tensor, axis)
+  return axis, rows
+
+
+def get_sample_bytes(inputs, fetches):
+  """
+  Check that the rows of a batch are computed independently, and estimate
+  the memory a row takes.
+
+  Every tensor computed from the inputs must keep the batch in one dynamic
+  dimension, followed from the inputs through Reshape and Transpose, see
+  _get_layout. A tensor without it, e.g. a reduction over the batch, mixes
+  rows. The fetches must hold the batch as their first dimension, one entry
+  per row, to be gathered from the chunks.
+
+  Args:
+    inputs: Placeholders of the batch, those is_batched holds for.
+    fetches: Tensors to compute from inputs.
+
+  Returns:
+    The bytes of all the tensors computed from the inputs for one row, an
+    upper bound of the memory a row needs. None when a dimension is
+    unknown.
+
+  Raises:
+    ValueError: a tensor mixes values across the batch.
+  """
+  needed = _get_ancestors(fetches)
+  # Tensor -> layout, see _get_layout. Inputs hold a row per entry of their
+  # first dimension.
+  layouts = dict((tensor, (0, 1)) for tensor in inputs)
+  sample_bytes = 0
+  # Operations are listed in the order they were added, inputs first.
+  for op in fetches[0].graph.get_operations():
+    if op not in needed or op.type in SHAPE_OP_TYPES:
+      continue
+    if not any(tensor in layouts for tensor in op.inputs) and not any(
+        tensor in layouts for tensor in op.outputs):
+      continue
+    for tensor in op.outputs:
+      if tensor not in layouts:
+        layouts[tensor] = _get_layout(op, tensor, layouts)
+      axis, rows = layouts[tensor]
+      if sample_bytes is None:
+        continue
+      elements = (_get_non_batch_elements(tensor.shape.as_list(), axis)
+                  if tensor.shape.ndims is not None else None)
+      if rows is None or elements is None:
+        sample_bytes = None
+      else:
+        sample_bytes += rows * elements * tensor.dtype.size
+
+  for tensor in fetches:
+    axis, rows = layouts.get(tensor, (0, 1))
+    if axis != 0 or rows not in (1, None):
+      raise ValueError(
+          "Output {} does not hold one entry per row along its first "
+          "dimension, it cannot be gathered from chunks.".format(tensor.name))
+  return sample_bytes
+
+
+def get_chunk_size(sample_bytes, max_batch_per_call=None,
+                   memory_budget_bytes=None):
+  """
+  Number of rows of a chunk within both limits, at least one row.
+
+  Raises:
+    ValueError: memory_budget_bytes is set but sample_bytes is unknown.
+  """
+  chunk_size = max_batch_per_call
+  if memory_budget_bytes is not None:
+    if sample_bytes is None:
+      raise ValueError("The memory of a row cannot be derived from the "
+                       "shapes of the graph, set max_batch_per_call "
+                       "instead of memory_budget_bytes.")
+    budget_rows = memory_budget_bytes // max(1, sample_bytes)
+    chunk_size = min(chunk_size or budget_rows, budget_rows)
+  return max(1, int(chunk_size))
@@ -165,6 +165,16 @@ ONNX_OP_TO_TF_OP = {
 
 TF_OP_TO_ONNX_OP = invert(ONNX_OP_TO_TF_OP)
 
+# Elementwise ops whose result does not depend on the layout of their
+# inputs, as long as all inputs share the same layout.
+ONNX_LAYOUT_AGNOSTIC_OPS = {
+    "Abs", "Add", "And", "Cast", "Ceil", "Clip", "Div", "Dropout", "Elu",
+    "Equal", "Exp", "Floor", "Greater", "HardSigmoid", "Identity",
+    "LeakyRelu", "Less", "Log", "Max", "Mean", "Min", "Mul", "Neg", "Not",
+    "Or", "Pow", "Reciprocal", "Relu", "Selu", "Sigmoid", "Softplus",
+    "Softsign", "Sqrt", "Sub", "Sum", "Tanh", "ThresholdedRelu", "Xor"
+}
+
 TF_OP_STR_TO_ONNX_OP = {
     "Identity": "Identity",
     "LogicalNot": "Not",
@@ -192,11 +202,18 @@ def get_tf_shape_as_list(tf_shape_dim):
   return list(map(lambda x: x.size, list(tf_shape_dim)))
 
 
+_op_names_lowered = {}
+
+
 # This function inserts an underscore before every upper
 # case letter and lowers that upper case letter except for
 # the first letter.
 def op_name_to_lower(name):
-  return re.sub('(?<!^)(?=[A-Z])', '_', name).lower()
+  lowered = _op_names_lowered.get(name)
+  if lowered is None:
+    lowered = re.sub('(?<!^)(?=[A-Z])', '_', name).lower()
+    _op_names_lowered[name] = lowered
+  return lowered
 
 
 def get_attribute_value(attr):
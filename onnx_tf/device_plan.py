@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import tensorflow as tf
+
+from onnx.backend.base import Device, DeviceType
+
+
+class DevicePlan(object):
+  """Layout and placement of a graph for its target device.
+
+  Plans are resolved once per device by TensorflowBackendBase.get_device_plan
+  and read by handlers through the conversion options, so that no handler
+  probes the devices of the host.
+
+  Attributes:
+    device: The device string the graph targets. It is either an ONNX
+      device string, e.g. "CPU", "CPU:1" or "CUDA:0", or a Tensorflow device
+      string, e.g. "/device:GPU:1". The host does not need to have that
+      device, e.g. a GPU graph can be built on a CPU only host.
+    tf_device: The Tensorflow device string the ops of the graph are
+      pinned to.
+    support_cuda: Whether handlers lay out data for CUDA kernels, channels
+      first, instead of for CPU kernels, channels last.
+  """
+
+  def __init__(self, device):
+    self.device = device
+    if device.startswith("/"):
+      spec = tf.DeviceSpec.from_string(device)
+      device_type = (spec.device_type or "CPU").upper()
+      device_index = spec.device_index or 0
+      self.tf_device = device
+    else:
+      onnx_device = Device(device)
+      device_type = "GPU" if onnx_device.type == DeviceType.CUDA else "CPU"
+      device_index = onnx_device.device_id
+      self.tf_device = "/device:{}:{}".format(device_type, device_index)
+    self.support_cuda = device_type == "GPU"
+    # Sessions only create CPU:0 unless asked for more CPU devices.
+    self._cpu_count = (device_index + 1
+                       if device_type == "CPU" and device_index else None)
+
+  def get_session_config(self):
+    """ConfigProto of the sessions running graphs pinned to the device.
+
+    Soft placement is allowed, so that ops without a kernel for the device,
+    e.g. a py_func or some int64 and string ops on GPU, fall back to the
+    CPU. CPU devices beyond CPU:0 are created when the graph targets one.
+    """
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if self._cpu_count is not None:
+      config.device_count["CPU"] = self._cpu_count
+    return config
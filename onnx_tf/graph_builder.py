@@ -0,0 +1,54 @@
+"""Bookkeeping of the conversion of an ONNX graph to a Tensorflow graph.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import tensorflow as tf
+
+
+class GraphBuilder(object):
+  """Tensorflow graph under construction and the ONNX tensors it holds.
+
+  Used as a context manager, the builder makes its graph the default graph
+  so that handlers add their ops to it.
+
+  Attributes:
+    graph: The tf.Graph being built.
+    tensor_dict: Map from ONNX tensor names to the latest Tensorflow tensor
+      produced for them. It is updated in place as nodes are converted, so
+      handlers may keep reading the same dict.
+    producers: Map from ONNX tensor names to the node producing them.
+      Graph inputs and initializers have no producer.
+  """
+
+  def __init__(self, graph=None):
+    self.graph = graph if graph is not None else tf.Graph()
+    self.tensor_dict = {}
+    self.producers = {}
+    self._graph_context = None
+
+  def __enter__(self):
+    self._graph_context = self.graph.as_default()
+    self._graph_context.__enter__()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    graph_context, self._graph_context = self._graph_context, None
+    return graph_context.__exit__(exc_type, exc_value, traceback)
+
+  def add_inputs(self, items):
+    """Record (name, tensor) pairs of graph inputs or initializers."""
+    self.tensor_dict.update(items)
+
+  def add_node_outputs(self, node, outputs):
+    """Record the tensors produced by converting node, in the order of
+    node.outputs."""
+    for name, tensor in zip(node.outputs, outputs):
+      self.tensor_dict[name] = tensor
+      self.producers[name] = node
+
+  def get_producer(self, name):
+    """The node producing the ONNX tensor name, None for graph inputs."""
+    return self.producers.get(name)
@@ -0,0 +1,217 @@
+"""Conversion-time transformations of ONNX graphs.
+
+The transformations work on a GraphView: a shallow stand-in for an ONNX
+GraphProto that refers to the nodes and tensors of the original model
+instead of copying them, so that transforming a large model does not
+duplicate its weights.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+from onnx import helper
+from onnx import ValueInfoProto
+import onnx.numpy_helper
+
+
+class GraphView(object):
+  """Shallow, mutable copy of an ONNX GraphProto.
+
+  It exposes the fields read by the backend (name, node, initializer,
+  input, output) as lists of references to the protos of the original
+  graph.
+  """
+
+  def __init__(self, graph_def):
+    self.name = graph_def.name
+    self.node = list(graph_def.node)
+    self.initializer = list(graph_def.initializer)
+    self.input = list(graph_def.input)
+    self.output = list(graph_def.output)
+
+  def get_consumers(self):
+    """Map every tensor name to the nodes reading it."""
+    consumers = {}
+    for node in self.node:
+      for name in node.input:
+        consumers.setdefault(name, []).append(node)
+    return consumers
+
+  def get_used_names(self):
+    """The names of all the tensors of the graph."""
+    used = set(tp.name for tp in self.initializer)
+    used.update(value_info.name for value_info in self.input)
+    for node in self.node:
+      used.update(node.input)
+      used.update(node.output)
+    return used
+
+  def get_unique_name(self, name, used=None):
+    """A name derived from name that no tensor of the graph uses.
+
+    used is the set returned by get_used_names, which callers naming many
+    tensors pass to scan the graph once. The returned name is added to it.
+    """
+    if used is None:
+      used = self.get_used_names()
+    unique_name, i = name, 0
+    while unique_name in used:
+      i += 1
+      unique_name = "{}_{}".format(name, i)
+    used.add(unique_name)
+    return unique_name
+
+  def remove_unused_initializers(self, names):
+    """Drop the initializers among names that no node reads anymore."""
+    consumers = self.get_consumers()
+    outputs = set(value_info.name for value_info in self.output)
+    unused = set(
+        name for name in names if name not in consumers and name not in outputs)
+    self.initializer = [tp for tp in self.initializer if tp.name not in unused]
+    self.input = [
+        value_info for value_info in self.input
+        if value_info.name not in unused
+    ]
+
+  def add_initializer(self, array, name, like):
+    """Add array as an initializer, listed as a graph input if like is."""
+    self.initializer.append(onnx.numpy_helper.from_array(array, name))
+    for value_info in self.input:
+      if value_info.name == like:
+        self.input.append(
+            helper.make_tensor_value_info(name, value_info.type.tensor_type
+                                          .elem_type, list(array.shape)))
+        break
+
+
+def fold_batch_normalization(graph):
+  """
+  Fold inference BatchNormalization nodes into the Conv feeding them.
+
+  A BatchNormalization node with is_test=1 and spatial=1 is folded when
+  its input is produced by a Conv read by nothing else, and the Conv
+  weights and bias as well as the BatchNormalization parameters are all
+  initializers. The Conv then directly produces the normalized output:
+    W' = W * scale / sqrt(var + epsilon)
+    b' = (b - mean) * scale / sqrt(var + epsilon) + bias
+
+  Args:
+    graph: GraphView to transform in place.
+
+  Returns:
+    The number of folded BatchNormalization nodes.
+  """
+  initializers = dict((tp.name, tp) for tp in graph.initializer)
+  outputs = set(value_info.name for value_info in graph.output)
+  consumers = graph.get_consumers()
+  producers = dict(
+      (name, node) for node in graph.node for name in node.output)
+  used_names = graph.get_used_names()
+
+  # id of a replaced node -> its replacement, None for removed nodes.
+  replaced = {}
+  folded_params = set()
+  for bn in graph.node:
+    if bn.op_type != "BatchNormalization" or len(bn.output) != 1:
+      continue
+    attrs = dict((attr.name, helper.get_attribute_value(attr))
+                 for attr in bn.attribute)
+    if attrs.get("is_test", 0) != 1 or attrs.get("spatial", 1) != 1:
+      continue
+    conv = producers.get(bn.input[0])
+    if (conv is None or conv.op_type != "Conv" or
+        len(consumers.get(bn.input[0], [])) != 1 or bn.input[0] in outputs):
+      continue
+    params = list(conv.input[1:]) + list(bn.input[1:5])
+    if any(name not in initializers for name in params):
+      continue
+
+    def to_array(name):
+      return onnx.numpy_helper.to_array(initializers[name])
+
+    weights = to_array(conv.input[1])
+    scale, bias, mean, var = [to_array(name) for name in bn.input[1:5]]
+    conv_bias = (to_array(conv.input[2]) if len(conv.input) > 2 else
+                 np.zeros(weights.shape[0], dtype=weights.dtype))
+    factor = scale.astype(np.float64) / np.sqrt(
+        var.astype(np.float64) + attrs.get("epsilon", 1e-5))
+    new_weights = (weights * factor.reshape(
+        [-1] + [1] * (weights.ndim - 1))).astype(weights.dtype)
+    new_bias = ((conv_bias - mean) * factor + bias).astype(weights.dtype)
+
+    weights_name = graph.get_unique_name(conv.input[1] + "_bn_folded",
+                                         used_names)
+    graph.add_initializer(new_weights, weights_name, like=conv.input[1])
+    bias_name = graph.get_unique_name(bn.input[2] + "_bn_folded", used_names)
+    graph.add_initializer(new_bias, bias_name, like=bn.input[2])
+
+    new_conv = helper.make_node(
+        "Conv", [conv.input[0], weights_name, bias_name],
+        list(bn.output),
+        name=conv.name)
+    new_conv.attribute.extend(conv.attribute)
+    replaced[id(conv)] = new_conv
+    replaced[id(bn)] = None
+    folded_params.update(params)
+
+  graph.node = [
+      replaced.get(id(node), node)
+      for node in graph.node
+      if replaced.get(id(node), node) is not None
+  ]
+  graph.remove_unused_initializers(folded_params)
+  return len(replaced) // 2
+
+
+def prune_unreachable(graph, outputs=None):
+  """
+  Remove the nodes and initializers that the outputs do not depend on.
+
+  Nodes are visited once, from the last to the first, which relies on the
+  topological order of the nodes that the conversion requires anyway.
+
+  Args:
+    graph: GraphView to transform in place.
+    outputs: Names of the tensors to compute, graph outputs or intermediate
+      tensors. The graph outputs become exactly these tensors and the graph
+      inputs they do not depend on are removed too. None keeps the outputs
+      and the inputs of the graph.
+
+  Returns:
+    The number of removed nodes.
+  """
+  if outputs is not None:
+    available = set(value_info.name for value_info in graph.input)
+    available.update(tp.name for tp in graph.initializer)
+    for node in graph.node:
+      available.update(node.output)
+    missing = [name for name in outputs if name not in available]
+    if missing:
+      raise ValueError("Outputs {} are not tensors of graph {}.".format(
+          ", ".join(missing), graph.name))
+    graph_outputs = dict(
+        (value_info.name, value_info) for value_info in graph.output)
+    graph.output = [
+        graph_outputs.get(name) or ValueInfoProto(name=name)
+        for name in outputs
+    ]
+
+  needed = set(value_info.name for value_info in graph.output)
+  kept_nodes = []
+  for node in reversed(graph.node):
+    if any(name in needed for name in node.output):
+      kept_nodes.append(node)
+      needed.update(node.input)
+  removed = len(graph.node) - len(kept_nodes)
+  graph.node = kept_nodes[::-1]
+
+  initialized = set(tp.name for tp in graph.initializer)
+  graph.initializer = [tp for tp in graph.initializer if tp.name in needed]
+  graph.input = [
+      value_info for value_info in graph.input
+      if value_info.name in needed or
+      (outputs is None and value_info.name not in initialized)
+  ]
+  return removed
@@ -0,0 +1,200 @@
+"""tf.data pipelines feeding the inputs of a TensorflowRep, see
+TensorflowRep.run_pipeline.
+
+A source of samples is one of:
+  - A dict of arrays keyed by input name, the first dimension of every
+    array indexing the samples. When every array is an np.memmap mapping
+    a file, e.g. a .npy file opened with mmap_mode, the samples are read
+    from the files by the reader ops of Tensorflow. Other arrays are
+    copied once into the pipeline.
+  - The path of a .npz file holding such arrays, or of a directory holding
+    one <input name>.npy file per input, read from the files.
+  - The path of a TFRecord file, a list of them or a directory of
+    .tfrecord files, holding one tf.train.Example per sample. The Example
+    has a feature per input named after it, holding the flattened sample as
+    a float_list for floating point inputs, an int64_list otherwise.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import glob
+import mmap
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+TFRECORD_EXTENSIONS = (".tfrecord", ".tfrecords")
+
+# Types tf.decode_raw reads.
+DECODE_RAW_TYPES = frozenset([
+    tf.float16, tf.float32, tf.float64, tf.int8, tf.int16, tf.int32,
+    tf.int64, tf.uint8, tf.uint16
+])
+
+# Types of paths, str and unicode on Python 2.
+_PATH_TYPES = (str, type(""))
+
+
+def _load_arrays(source, names):
+  """The arrays of source keyed by input name, None for TFRecord sources."""
+  if isinstance(source, dict):
+    arrays = source
+  elif isinstance(source, _PATH_TYPES) and source.endswith(".npz"):
+    arrays = np.load(source)
+  elif isinstance(source, _PATH_TYPES) and os.path.isdir(source):
+    paths = {name: os.path.join(source, name + ".npy") for name in names}
+    if not any(os.path.exists(path) for path in paths.values()):
+      return None
+    arrays = {
+        name: np.load(path, mmap_mode="r")
+        for name, path in paths.items()
+    }
+  else:
+    return None
+  missing = [name for name in names if name not in arrays]
+  if missing:
+    raise ValueError("Source has no values for inputs {}.".format(
+        ", ".join(missing)))
+  arrays = {name: arrays[name] for name in names}
+  if len(set(len(array) for array in arrays.values())) > 1:
+    raise ValueError("Inputs of the source have different sample counts.")
+  return arrays
+
+
+def _get_tfrecord_files(source):
+  if isinstance(source, _PATH_TYPES) and os.path.isdir(source):
+    files = sorted(
+        path for extension in TFRECORD_EXTENSIONS
+        for path in glob.glob(os.path.join(source, "*" + extension)))
+    if not files:
+      raise ValueError(
+          "{} holds neither .npy nor TFRecord files.".format(source))
+    return files
+  if isinstance(source, _PATH_TYPES):
+    return [source]
+  return list(source)
+
+
+def _is_file_record_array(array):
+  """Whether the samples of array are fixed length records of its file,
+  i.e. array is an np.memmap of the whole mapping, not a view of one, in a
+  type tf.decode_raw reads."""
+  if not (isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap)
+          and array.flags.c_contiguous and array.ndim > 0 and
+          array.itemsize * int(np.prod(array.shape[1:])) > 0):
+    return False
+  try:
+    return tf.as_dtype(array.dtype.newbyteorder("=")) in DECODE_RAW_TYPES
+  except TypeError:
+    return False
+
+
+def _file_record_dataset(array, dtype, num_parallel_calls):
+  """Samples of a memory-mapped array read from its file, past the header
+  of a .npy file, and decoded in the pipeline."""
+  sample_shape = list(array.shape[1:])
+  record_bytes = array.itemsize * int(np.prod(sample_shape))
+  footer_bytes = (os.path.getsize(array.filename) - array.offset -
+                  len(array) * record_bytes)
+  file_dtype = tf.as_dtype(array.dtype.newbyteorder("="))
+  little_endian = (array.dtype.byteorder == "<" or
+                   (array.dtype.byteorder in "=|" and
+                    sys.byteorder == "little"))
+
+  def parse(record):
+    value = tf.decode_raw(record, file_dtype, little_endian=little_endian)
+    return tf.cast(tf.reshape(value, sample_shape), dtype)
+
+  return tf.data.FixedLengthRecordDataset(
+      array.filename,
+      record_bytes,
+      header_bytes=array.offset,
+      footer_bytes=footer_bytes).map(
+          parse, num_parallel_calls=num_parallel_calls)
+
+
+def _array_dataset(arrays, specs, batch_size, num_parallel_calls):
+  """Batches of arrays, and the feeds of the iterator initializer."""
+  names = list(specs.keys())
+  if all(_is_file_record_array(arrays[name]) for name in names):
+    # Read the samples from the memory-mapped files with the reader ops of
+    # Tensorflow, instead of loading the whole files in memory.
+    dataset = tf.data.Dataset.zip({
+        name: _file_record_dataset(arrays[name], specs[name][0],
+                                   num_parallel_calls) for name in names
+    })
+    return dataset.batch(batch_size), {}
+
+  # Slice whole batches out of the arrays, copied once into the graph
+  # by the initializer of the iterator.
+  placeholders = {
+      name: tf.placeholder(specs[name][0], [None] + specs[name][1])
+      for name in names
+  }
+  num_samples = len(arrays[names[0]])
+  dataset = tf.data.Dataset.range(0, num_samples, batch_size).map(
+      lambda start: {
+          name: placeholder[start:start + batch_size]
+          for name, placeholder in placeholders.items()
+      })
+  feed_dict = {
+      placeholders[name]: np.asarray(
+          arrays[name], dtype=specs[name][0].as_numpy_dtype)
+      for name in names
+  }
+  return dataset, feed_dict
+
+
+def _tfrecord_dataset(files, specs, batch_size, num_parallel_calls):
+  features = {}
+  for name, (dtype, shape) in specs.items():
+    if None in shape:
+      raise ValueError("Input {} has a dynamic sample shape {}, it cannot be "
+                       "parsed from TFRecord files.".format(name, shape))
+    features[name] = tf.FixedLenFeature(
+        [int(np.prod(shape))], tf.float32 if dtype.is_floating else tf.int64)
+
+  def parse(record):
+    example = tf.parse_single_example(record, features)
+    return {
+        name: tf.reshape(tf.cast(example[name], dtype), shape)
+        for name, (dtype, shape) in specs.items()
+    }
+
+  dataset = tf.data.TFRecordDataset(files).map(
+      parse, num_parallel_calls=num_parallel_calls).batch(batch_size)
+  return dataset, {}
+
+
+def make_dataset(source, specs, batch_size, prefetch=2,
+                 num_parallel_calls=None):
+  """
+  Build the tf.data pipeline of batches of a source, in the default graph.
+
+  Args:
+    source: Source of samples, see the module docstring.
+    specs: OrderedDict from input names to their tf.DType and sample
+      shape, the shape of an input without its batch dimension.
+    batch_size: Number of samples per batch, the last one may be smaller.
+    prefetch: Number of batches prepared ahead of the model.
+    num_parallel_calls: Number of samples or batches read and parsed in
+      parallel, defaults to one per CPU.
+
+  Returns:
+    A pair of the tf.data.Dataset of dicts of batches keyed by input name,
+    and the feed_dict its iterator has to be initialized with.
+  """
+  num_parallel_calls = num_parallel_calls or multiprocessing.cpu_count()
+  arrays = _load_arrays(source, list(specs.keys()))
+  if arrays is not None:
+    dataset, feed_dict = _array_dataset(arrays, specs, batch_size,
+                                        num_parallel_calls)
+  else:
+    dataset, feed_dict = _tfrecord_dataset(
+        _get_tfrecord_files(source), specs, batch_size, num_parallel_calls)
+  return dataset.prefetch(prefetch), feed_dict
@@ -0,0 +1,238 @@
+"""On-disk cache of converted models for the Tensorflow backend.
+
+Every entry is a directory named after a hash of the serialized ONNX
+model, the opset, the device and the onnx-tf version. It holds the
+converted GraphDef together with the metadata needed to rebuild the
+TensorflowNet around it without dispatching any handler.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+
+from onnx_tf.tf_net import TensorflowNet
+from onnx_tf.version import version
+
+# Bump whenever the layout of a cache entry changes.
+CACHE_FORMAT_VERSION = 6
+
+GRAPH_FILE = "graph.pb"
+META_FILE = "meta.json"
+
+# Ops calling back into Python through a token registered in the process
+# that built the graph. The token means nothing in another process, so
+# graphs holding such ops are not cached.
+PY_FUNC_OP_TYPES = frozenset(["PyFunc", "PyFuncStateless", "EagerPyFunc"])
+
+
+class PrepareCache(object):
+  """Content-addressed cache of TensorflowNet objects.
+
+  Args:
+    cache_dir: Directory holding the cache entries, created if missing.
+    max_size_bytes: Upper bound on the total size of the entries. Least
+      recently used entries are evicted once it is exceeded. None means
+      unbounded.
+  """
+
+  def __init__(self, cache_dir, max_size_bytes=None):
+    self.cache_dir = cache_dir
+    self.max_size_bytes = max_size_bytes
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    self.evict()
+
+  @staticmethod
+  def get_key(model, opset, device, options=None):
+    """Hash everything the converted graph depends on.
+
+    Args:
+      model: ONNX ModelProto.
+      opset: Opset version the model is converted with.
+      device: Device passed to prepare.
+      options: Dict of the conversion options passed to prepare.
+
+    Returns:
+      Hex digest naming the cache entry.
+    """
+    sha = hashlib.sha256()
+    sha.update(model.SerializeToString())
+    sha.update("|{}|{}|{}|{}|{}".format(
+        opset, device, sorted((options or {}).items()), version,
+        CACHE_FORMAT_VERSION).encode("utf-8"))
+    return sha.hexdigest()
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def get_entry_file(self, key, file_name):
+    """Path of a file kept in the entry of key beside the converted
+    graph, e.g. the tuning file of TensorflowRep.autotune."""
+    return os.path.join(self._entry_dir(key), file_name)
+
+  def load(self, key, get_graph_def):
+    """Rebuild the TensorflowNet stored under key.
+
+    Corrupt or stale entries are removed from the cache.
+
+    Args:
+      key: Key returned by get_key.
+      get_graph_def: Callable returning the ONNX graph the entry was
+        converted from, transformed as for the conversion. It provides the
+        values of initializers loaded as variables and is only called when
+        the entry has some.
+
+    Returns:
+      The TensorflowNet, or None on a cache miss.
+    """
+    entry_dir = self._entry_dir(key)
+    if not os.path.isdir(entry_dir):
+      return None
+    try:
+      with open(os.path.join(entry_dir, META_FILE), "r") as meta_file:
+        meta = json.load(meta_file)
+      if not self._is_current(meta):
+        raise ValueError("Stale cache entry {}.".format(key))
+      tf_graph_def = tf.GraphDef()
+      with open(os.path.join(entry_dir, GRAPH_FILE), "rb") as graph_file:
+        tf_graph_def.ParseFromString(graph_file.read())
+      if self._has_py_func(tf_graph_def):
+        raise ValueError("Cache entry {} calls Python functions.".format(key))
+      predict_net = self._net_from_graph_def(tf_graph_def, meta)
+      if predict_net.initializer_placeholders:
+        initializers = {tp.name: tp for tp in get_graph_def().initializer}
+        predict_net.initializer_values = {
+            name: initializers[name]
+            for name in predict_net.initializer_placeholders
+        }
+    except Exception:  # pylint: disable=broad-except
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      return None
+    # Record the hit for least-recently-used eviction.
+    os.utime(entry_dir, None)
+    return predict_net
+
+  def store(self, key, predict_net):
+    """Write predict_net under key, then enforce the size cap.
+
+    Graphs calling Python functions are not stored. A failed write is
+    ignored, leaving the cache as it was.
+    """
+    graph_def = predict_net.graph.as_graph_def()
+    if self._has_py_func(graph_def):
+      return
+    meta = {
+        "format": CACHE_FORMAT_VERSION,
+        "version": version,
+        "name": predict_net.name,
+        "device": predict_net.device,
+        "external_input": list(predict_net.external_input),
+        "external_output": list(predict_net.external_output),
+        "tensor_dict": {
+            name: tensor.name
+            for name, tensor in predict_net.tensor_dict.items()
+        },
+        "init_op": (predict_net.init_op.name
+                    if predict_net.init_op is not None else None),
+        "initializer_placeholders": predict_net.initializer_placeholders,
+        "initializer_assign_ops": predict_net.initializer_assign_ops,
+        "saver_def": (base64.b64encode(
+            predict_net.saver.as_saver_def().SerializeToString()).decode(
+                "ascii") if predict_net.saver is not None else None),
+        "node_outputs": predict_net.node_outputs,
+    }
+
+    # Write into a scratch directory first so that readers never observe a
+    # partially written entry.
+    tmp_dir = None
+    try:
+      tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-")
+      with open(os.path.join(tmp_dir, GRAPH_FILE), "wb") as graph_file:
+        graph_file.write(graph_def.SerializeToString())
+      with open(os.path.join(tmp_dir, META_FILE), "w") as meta_file:
+        json.dump(meta, meta_file)
+      entry_dir = self._entry_dir(key)
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      os.rename(tmp_dir, entry_dir)
+    except OSError:
+      # Another process may have stored the same entry in between, keep
+      # it. Otherwise the model is simply converted again next time.
+      if tmp_dir is not None:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+      return
+    self.evict()
+
+  def evict(self):
+    """Drop stale entries, then old entries until under the size cap."""
+    entries = []
+    for key in os.listdir(self.cache_dir):
+      entry_dir = self._entry_dir(key)
+      if key.startswith(".") or not os.path.isdir(entry_dir):
+        continue
+      try:
+        with open(os.path.join(entry_dir, META_FILE), "r") as meta_file:
+          is_current = self._is_current(json.load(meta_file))
+      except Exception:  # pylint: disable=broad-except
+        is_current = False
+      if not is_current:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        continue
+      size = sum(
+          os.path.getsize(os.path.join(entry_dir, f))
+          for f in os.listdir(entry_dir))
+      entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+    if self.max_size_bytes is None:
+      return
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+      if total_size <= self.max_size_bytes:
+        break
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      total_size -= size
+
+  @staticmethod
+  def _has_py_func(graph_def):
+    return any(node.op in PY_FUNC_OP_TYPES for node in graph_def.node)
+
+  @staticmethod
+  def _is_current(meta):
+    return (meta.get("format") == CACHE_FORMAT_VERSION and
+            meta.get("version") == version)
+
+  @staticmethod
+  def _net_from_graph_def(graph_def, meta):
+    graph = tf.Graph()
+    with graph.as_default():
+      tf.import_graph_def(graph_def, name="")
+
+    predict_net = TensorflowNet()
+    predict_net.name = meta["name"]
+    predict_net.device = meta["device"]
+    predict_net.graph = graph
+    predict_net.external_input.extend(meta["external_input"])
+    predict_net.external_output.extend(meta["external_output"])
+    predict_net.tensor_dict = {
+        name: graph.get_tensor_by_name(tensor_name)
+        for name, tensor_name in meta["tensor_dict"].items()
+    }
+    if meta["init_op"] is not None:
+      predict_net.init_op = graph.get_operation_by_name(meta["init_op"])
+    predict_net.initializer_placeholders = meta["initializer_placeholders"]
+    predict_net.initializer_assign_ops = meta["initializer_assign_ops"]
+    if meta["saver_def"] is not None:
+      saver_def = tf.train.SaverDef()
+      saver_def.ParseFromString(base64.b64decode(meta["saver_def"]))
+      with graph.as_default():
+        predict_net.saver = tf.train.Saver(saver_def=saver_def)
+    predict_net.node_outputs = meta["node_outputs"]
+    return predict_net
@@ -0,0 +1,119 @@
+"""Session options of a TensorflowRep and their named presets.
+
+Session options are a flat dict. Keys naming a scalar field of
+tf.ConfigProto, e.g. intra_op_parallelism_threads, set that field. Besides
+them:
+  jit: True to compile the graph with XLA (global JIT level ON_1), False to
+    turn it off.
+  rewrite_options: Dict of the Grappler RewriterConfig fields to set, e.g.
+    {"constant_folding": False, "memory_optimization": "HEURISTICS"}.
+    Toggle fields take a bool or the name of a toggle value, enum fields
+    take the name of a value.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+
+import tensorflow as tf
+
+
+def _get_presets():
+  cpu_count = multiprocessing.cpu_count()
+  return {
+      # One run at a time, each op using every core.
+      "latency": {
+          "intra_op_parallelism_threads": cpu_count,
+          "inter_op_parallelism_threads": 1,
+      },
+      # Many concurrent runs, each op using a few cores, compiled by XLA.
+      "throughput": {
+          "intra_op_parallelism_threads": max(1, cpu_count // 4),
+          "inter_op_parallelism_threads": cpu_count,
+          "jit": True,
+      },
+      # Lowest peak memory: no constant folding, which duplicates weights,
+      # and Grappler swaps and recomputes to save memory.
+      "memory": {
+          "intra_op_parallelism_threads": cpu_count,
+          "inter_op_parallelism_threads": 1,
+          "rewrite_options": {
+              "constant_folding": False,
+              "memory_optimization": "HEURISTICS",
+          },
+      },
+  }
+
+
+SESSION_PRESETS = sorted(_get_presets().keys())
+
+
+def get_session_options(preset=None, options=None):
+  """
+  Session options of a preset, overridden by options.
+
+  Args:
+    preset: Name of a preset, one of SESSION_PRESETS, or None.
+    options: Dict of session options taking precedence over the preset.
+
+  Returns:
+    A new dict of session options.
+  """
+  session_options = {}
+  if preset is not None:
+    presets = _get_presets()
+    if preset not in presets:
+      raise ValueError("Unknown session preset {}, expected one of {}.".format(
+          preset, ", ".join(SESSION_PRESETS)))
+    session_options.update(presets[preset])
+  session_options.update(options or {})
+  return session_options
+
+
+def make_session_config(options=None, base=None):
+  """
+  Build the tf.ConfigProto of session options.
+
+  Args:
+    options: Dict of session options.
+    base: Optional tf.ConfigProto the options are applied to, it is not
+      modified.
+
+  Returns:
+    A tf.ConfigProto, or None when there is neither options nor base.
+  """
+  if not options:
+    return base
+  config = tf.ConfigProto()
+  if base is not None:
+    config.CopyFrom(base)
+  for name, value in options.items():
+    if name == "jit":
+      config.graph_options.optimizer_options.global_jit_level = (
+          tf.OptimizerOptions.ON_1 if value else tf.OptimizerOptions.OFF)
+    elif name == "rewrite_options":
+      _set_fields(config.graph_options.rewrite_options, value)
+    elif name in tf.ConfigProto.DESCRIPTOR.fields_by_name:
+      setattr(config, name, value)
+    else:
+      raise ValueError("Unknown session option {}.".format(name))
+  return config
+
+
+def _set_fields(message, values):
+  for name, value in values.items():
+    field = message.DESCRIPTOR.fields_by_name.get(name)
+    if field is None:
+      raise ValueError("Unknown rewrite option {}.".format(name))
+    if field.enum_type is not None:
+      if isinstance(value, bool):
+        value = "ON" if value else "OFF"
+      enum_value = field.enum_type.values_by_name.get(value)
+      if enum_value is None:
+        raise ValueError("Unknown value {} of rewrite option {}.".format(
+            value, name))
+      value = enum_value.number
+    setattr(message, name, value)
+
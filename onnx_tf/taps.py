@@ -0,0 +1,171 @@
+"""Storage and comparison of intermediate tensors fetched by
+TensorflowRep.run_taps, for debugging converted models layer by layer.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from collections import OrderedDict
+import json
+import os
+import re
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+LayerReport = namedtuple("LayerReport", [
+    "name", "shape", "max_abs_diff", "max_rel_diff", "mismatch_ratio",
+    "passed"
+])
+
+
+class TapStore(object):
+  """Directory of .npy files holding named arrays, read back memory-mapped.
+
+  The arrays are written one by one, so that storing the intermediate
+  tensors of a model never needs a second copy of all of them in memory.
+  An index file maps the tensor names, which need not be valid file names,
+  to the files holding them and keeps their order.
+
+  Args:
+    store_dir: Directory of the store, created if missing.
+  """
+
+  def __init__(self, store_dir):
+    self.store_dir = store_dir
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir)
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    # Tensor name -> name of the .npy file holding it.
+    self._files = OrderedDict()
+    if os.path.exists(index_path):
+      with open(index_path, "r") as index_file:
+        self._files = json.load(index_file, object_pairs_hook=OrderedDict)
+
+  def save(self, name, array):
+    """Write array under name, replacing any array of that name."""
+    self.save_all([(name, array)])
+
+  def save_all(self, items):
+    """Write the (name, array) pairs of items one after the other.
+
+    items may be a generator, so that each array can be released as soon as
+    it is written.
+    """
+    for name, array in items:
+      file_name = self._files.get(name)
+      if file_name is None:
+        file_name = "{}_{}.npy".format(
+            len(self._files), re.sub(r"[^\w.-]", "_", name))
+      array = np.asarray(array)
+      stored = np.lib.format.open_memmap(
+          os.path.join(self.store_dir, file_name),
+          mode="w+",
+          dtype=array.dtype,
+          shape=array.shape)
+      stored[...] = array
+      stored.flush()
+      del stored
+      self._files[name] = file_name
+    with open(os.path.join(self.store_dir, INDEX_FILE), "w") as index_file:
+      json.dump(self._files, index_file)
+
+  def keys(self):
+    return list(self._files.keys())
+
+  def __contains__(self, name):
+    return name in self._files
+
+  def __len__(self):
+    return len(self._files)
+
+  def __iter__(self):
+    return iter(self._files)
+
+  def __getitem__(self, name):
+    """The array stored under name, memory-mapped read only."""
+    return np.load(
+        os.path.join(self.store_dir, self._files[name]), mmap_mode="r")
+
+  def items(self):
+    return [(name, self[name]) for name in self._files]
+
+
+def load_reference(reference):
+  """Open a reference set of arrays.
+
+  Args:
+    reference: A dict of arrays, the path of a .npz file or the path of a
+      TapStore directory.
+
+  Returns:
+    A mapping from names to arrays.
+  """
+  if isinstance(reference, dict):
+    return reference
+  if os.path.isdir(reference):
+    return TapStore(reference)
+  return np.load(reference)
+
+
+def compare_taps(outputs, reference, rtol=1e-3, atol=1e-5):
+  """
+  Compare intermediate tensors with reference values, layer by layer.
+
+  Every comparison is a handful of vectorized NumPy reductions over the
+  whole tensor. Tensors without a reference value are skipped.
+
+  Args:
+    outputs: Mapping from tensor names to arrays, e.g. the result of
+      TensorflowRep.run_taps, in the order to report them.
+    reference: Reference arrays, see load_reference.
+    rtol: Relative tolerance, as in np.isclose.
+    atol: Absolute tolerance, as in np.isclose.
+
+  Returns:
+    A list of LayerReport, one per compared tensor. mismatch_ratio is the
+    fraction of the elements outside the tolerance; shape mismatches count
+    as a full mismatch.
+  """
+  reference = load_reference(reference)
+  report = []
+  for name in outputs:
+    if name not in reference:
+      continue
+    actual = np.asarray(outputs[name])
+    expected = np.asarray(reference[name])
+    if actual.shape != expected.shape:
+      report.append(
+          LayerReport(name, actual.shape, np.inf, np.inf, 1.0, False))
+      continue
+    if actual.size == 0:
+      report.append(LayerReport(name, actual.shape, 0.0, 0.0, 0.0, True))
+      continue
+    actual = actual.astype(np.float64)
+    expected = expected.astype(np.float64)
+    abs_diff = np.abs(actual - expected)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      rel_diff = abs_diff / np.abs(expected)
+    rel_diff[abs_diff == 0] = 0
+    mismatch = ~np.isclose(actual, expected, rtol=rtol, atol=atol,
+                           equal_nan=True)
+    mismatch_ratio = np.count_nonzero(mismatch) / mismatch.size
+    report.append(
+        LayerReport(name, actual.shape, float(np.max(abs_diff)),
+                    float(np.max(rel_diff)), mismatch_ratio,
+                    mismatch_ratio == 0))
+  return report
+
+
+def format_report(report):
+  """Render a list of LayerReport as a tab separated table."""
+  lines = ["name\tshape\tmax_abs_diff\tmax_rel_diff\tmismatch_%\tpassed"]
+  for layer in report:
+    lines.append("{}\t{}\t{:.3g}\t{:.3g}\t{:.2f}\t{}".format(
+        layer.name, "x".join(str(d) for d in layer.shape),
+        layer.max_abs_diff, layer.max_rel_diff, layer.mismatch_ratio * 100,
+        layer.passed))
+  return "\n".join(lines)
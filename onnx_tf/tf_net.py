@@ -12,6 +12,8 @@ class TensorflowNet(object):
   def __init__(self):
     # Record the computational graph
     self.graph = None
+    # Device string the ops of the graph are placed for, see DevicePlan.
+    self.device = None
     # Record string names of input tensors as defined in
     # the ONNX model.
     self.external_input = []
@@ -21,3 +23,21 @@ class TensorflowNet(object):
     # String name -> TF tensor map that records every tensor
     # produced for the execution of the graph.
     self.tensor_dict = {}
+    # String names of the tensors produced by the nodes of the graph, in
+    # the order the nodes were converted.
+    self.node_outputs = []
+    # Op initializing the variables created by handlers, or None if the
+    # graph has no such variables.
+    self.init_op = None
+    # Initializers loaded as variables: ONNX initializer name -> name of
+    # the placeholder to feed with its value when running the op of
+    # initializer_assign_ops.
+    self.initializer_placeholders = {}
+    # ONNX initializer name -> name of the op assigning the placeholder to
+    # the variable.
+    self.initializer_assign_ops = {}
+    # ONNX initializer name -> TensorProto holding the initial value.
+    self.initializer_values = {}
+    # tf.train.Saver of the initializers loaded as variables, keyed by
+    # their ONNX names, or None if there are none.
+    self.saver = None
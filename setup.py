@@ -1,8 +1,10 @@
 from setuptools import setup
 
+from onnx_tf.version import version
+
 setup(
     name='onnx-tf',
-    version='1.0',
+    version=version,
     description='Tensorflow backend for ONNX (Open Neural Network Exchange).',
     # as per https://github.com/tensorflow/tensorflow/issues/16488
     # need to bump numpy version manually.
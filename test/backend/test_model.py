@@ -3,11 +3,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 import numpy as np
 import tensorflow as tf
 import onnx
-from onnx_tf.backend import run_node, prepare
+import onnx_tf.autotune
+from onnx_tf.batching import MicroBatcher
+from onnx_tf.backend import run_node, run_nodes, prepare, TensorflowBackendBase
+from onnx_tf.graph_transform import GraphView, fold_batch_normalization
+from onnx_tf.prepare_cache import PrepareCache
+from onnx_tf.session_config import get_session_options, make_session_config
+from onnx_tf.taps import TapStore, compare_taps
 from onnx import helper
 from onnx.onnx_pb2 import TensorProto
 
@@ -33,6 +44,68 @@ class TestModel(unittest.TestCase):
     output = tf_rep.run({"X": X})
     np.testing.assert_almost_equal(output.X1, Y_ref)
 
+  def test_run_nodes(self):
+    X = np.random.randn(2, 3).astype(np.float32)
+    Y = np.random.randn(3, 4).astype(np.float32)
+    nodes_and_inputs = [
+        (helper.make_node("Relu", ["X"], ["Y"]), [X]),
+        (helper.make_node("MatMul", ["X", "Y"], ["Z"]), {"X": X, "Y": Y}),
+        (helper.make_node("Relu", ["X"], ["Y"]), [-X]),
+        (helper.make_node("Split", ["X"], ["A", "B"], axis=1, split=[1, 2]),
+         [X]),
+    ]
+    outputs = run_nodes(nodes_and_inputs)
+    self.assertEqual(len(outputs), 4)
+    np.testing.assert_almost_equal(outputs[0].Y, np.maximum(X, 0))
+    np.testing.assert_almost_equal(outputs[1].Z, np.dot(X, Y), decimal=5)
+    np.testing.assert_almost_equal(outputs[2].Y, np.maximum(-X, 0))
+    np.testing.assert_almost_equal(outputs[3].A, X[:, :1])
+    np.testing.assert_almost_equal(outputs[3].B, X[:, 1:])
+
+  def test_run_node_cache(self):
+    node_def = helper.make_node("Add", ["X", "Y"], ["Z"])
+    TensorflowBackendBase.run_node_cache_clear()
+    for _ in range(3):
+      X = np.random.randn(2, 3).astype(np.float32)
+      Y = np.random.randn(2, 3).astype(np.float32)
+      np.testing.assert_almost_equal(run_node(node_def, [X, Y]).Z, X + Y)
+    info = TensorflowBackendBase.run_node_cache_info()
+    self.assertEqual((info.hits, info.misses, info.currsize), (2, 1, 1))
+    # Another shape or dtype is another signature.
+    run_node(node_def, [X[:1], Y[:1]])
+    run_node(node_def, [X.astype(np.float64), Y.astype(np.float64)])
+    info = TensorflowBackendBase.run_node_cache_info()
+    self.assertEqual((info.hits, info.misses, info.currsize), (2, 3, 3))
+
+    cache_size = TensorflowBackendBase.run_node_cache_size
+    TensorflowBackendBase.run_node_cache_size = 2
+    try:
+      TensorflowBackendBase.run_node_cache_clear()
+      # A hit makes the entry the most recently used one: the (2, 1)
+      # graph evicts the (1, 3) one and keeps the (2, 3) one.
+      run_node(node_def, [X, Y])
+      run_node(node_def, [X[:1], Y[:1]])
+      run_node(node_def, [X, Y])
+      run_node(node_def, [X[:, :1], Y[:, :1]])
+      info = TensorflowBackendBase.run_node_cache_info()
+      self.assertEqual(info, (1, 3, 2, 2))
+      run_node(node_def, [X, Y])
+      self.assertEqual(TensorflowBackendBase.run_node_cache_info().hits, 2)
+      run_node(node_def, [X[:1], Y[:1]])
+      self.assertEqual(TensorflowBackendBase.run_node_cache_info().misses, 4)
+    finally:
+      TensorflowBackendBase.run_node_cache_size = cache_size
+
+    # Nodes with stateful kernels are not cached: a seeded random node
+    # returns the same values on every call.
+    TensorflowBackendBase.run_node_cache_clear()
+    node_def = helper.make_node(
+        "RandomNormalLike", ["X"], ["Y"], dtype=TensorProto.FLOAT, seed=3.)
+    Y = run_node(node_def, [X]).Y
+    np.testing.assert_almost_equal(run_node(node_def, [X]).Y, Y)
+    info = TensorflowBackendBase.run_node_cache_info()
+    self.assertEqual((info.hits, info.misses, info.currsize), (0, 2, 0))
+
   def test_initializer(self):
     X = np.array([[1, 2], [3, 4]]).astype(np.float32)
     Y = np.array([[1, 2], [3, 4]]).astype(np.float32)
@@ -67,6 +140,857 @@ class TestModel(unittest.TestCase):
     output = tf_rep.run({"X": X, "Y": Y})
     np.testing.assert_almost_equal(output["W2"], W_ref)
 
+  def test_run_taps(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node("Neg", ["X"], ["layer/neg"]),
+            helper.make_node("Relu", ["layer/neg"], ["relu"]),
+            helper.make_node("Exp", ["relu"], ["Y"]),
+        ],
+        name="test_run_taps",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2])],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 2])])
+    reference = {
+        "layer/neg": -X,
+        "relu": np.maximum(-X, 0),
+        "Y": np.exp(np.maximum(-X, 0)),
+    }
+    store_dir = tempfile.mkdtemp()
+    try:
+      with prepare(helper.make_model(graph_def)) as tf_rep:
+        taps = tf_rep.run_taps(X)
+        self.assertEqual(list(taps.keys()), ["layer/neg", "relu", "Y"])
+        taps = tf_rep.run_taps(X, names=["relu"], store_dir=store_dir)
+        self.assertIsInstance(taps["relu"], np.memmap)
+        np.testing.assert_almost_equal(taps["relu"], reference["relu"])
+
+        tf_rep.run_taps(X, store_dir=store_dir)
+        taps = TapStore(store_dir)
+        self.assertEqual(taps.keys(), ["relu", "layer/neg", "Y"])
+        report = compare_taps(taps, reference)
+        self.assertEqual([layer.name for layer in report], taps.keys())
+        self.assertTrue(all(layer.passed for layer in report))
+
+        reference["relu"] = reference["relu"] + 1
+        report = compare_taps(taps, reference)
+        self.assertEqual([layer.passed for layer in report],
+                         [False, True, True])
+        self.assertEqual(report[0].mismatch_ratio, 1)
+        np.testing.assert_almost_equal(report[0].max_abs_diff, 1)
+    finally:
+      shutil.rmtree(store_dir)
+
+  def test_session_lifecycle(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    node_def = helper.make_node("Relu", ["X"], ["Y"])
+    graph_def = helper.make_graph(
+        [node_def],
+        name="test",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2])],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 2])])
+    with prepare(helper.make_model(graph_def)) as tf_rep:
+      output = tf_rep.run(X)
+      sess = tf_rep.sess
+      output = tf_rep.run([X])
+      np.testing.assert_almost_equal(output.Y, np.clip(X, 0, np.inf))
+      self.assertIs(tf_rep.sess, sess)
+    self.assertTrue(sess._closed)
+    # A closed representation reopens a session on demand.
+    output = tf_rep.run({"X": X})
+    np.testing.assert_almost_equal(output["Y"], np.clip(X, 0, np.inf))
+    tf_rep.close()
+
+  def test_run_outputs(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node("Neg", ["X"], ["N"]),
+            helper.make_node("Relu", ["N"], ["Y1"]),
+            helper.make_node("Abs", ["N"], ["Y2"]),
+        ],
+        name="test_run_outputs",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2])],
+        outputs=[
+            helper.make_tensor_value_info("Y1", TensorProto.FLOAT, [3, 2]),
+            helper.make_tensor_value_info("Y2", TensorProto.FLOAT, [3, 2]),
+        ])
+    with prepare(helper.make_model(graph_def)) as tf_rep:
+      tf_rep.callable_cache_size = 2
+      output = tf_rep.run(X, outputs=["Y2"])
+      self.assertEqual(output._fields, ("Y2",))
+      np.testing.assert_almost_equal(output.Y2, np.abs(X))
+      output = tf_rep.run(X, outputs=["N", "Y1"])
+      np.testing.assert_almost_equal(output["N"], -X)
+      np.testing.assert_almost_equal(output["Y1"], np.maximum(-X, 0))
+      self.assertEqual(len(tf_rep.run(X)), 2)
+
+      # More fetch sets than callable_cache_size: the sets compiled again
+      # after their eviction still fetch their own outputs.
+      expected = {"N": -X, "Y1": np.maximum(-X, 0), "Y2": np.abs(X)}
+      for outputs in [["Y2"], ["N"], ["N", "Y1"], ["Y1"], ["Y2"]]:
+        output = tf_rep.run(X, outputs=outputs)
+        self.assertEqual(list(output._fields), outputs)
+        for name in outputs:
+          np.testing.assert_almost_equal(output[name], expected[name])
+      self.assertRaises(ValueError, tf_rep.run, X, outputs=["missing"])
+
+  def test_concurrent_run(self):
+    node_def = helper.make_node("Tanh", ["X"], ["Y"])
+    graph_def = helper.make_graph(
+        [node_def],
+        name="test",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [4, 8])],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [4, 8])])
+    tf_rep = prepare(helper.make_model(graph_def))
+    xs = [np.random.randn(4, 8).astype(np.float32) for _ in range(8)]
+    results = [None] * len(xs)
+
+    def worker(i):
+      for _ in range(20):
+        results[i] = tf_rep.run(xs[i]).Y
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    for x, y in zip(xs, results):
+      np.testing.assert_almost_equal(y, np.tanh(x), decimal=5)
+    tf_rep.close()
+
+  def test_prepare_cache(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node("Mul", ["X", "weight"], ["Z"]),
+            helper.make_node("Relu", ["Z"], ["Y"])
+        ],
+        name="test_prepare_cache",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2]),
+            helper.make_tensor_value_info("weight", TensorProto.FLOAT, [3, 2])
+        ],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 2])],
+        initializer=[
+            helper.make_tensor("weight", TensorProto.FLOAT, [3, 2],
+                               np.arange(6).astype(float))
+        ])
+    model = helper.make_model(graph_def)
+    Y_ref = np.clip(X * np.arange(6, dtype=np.float32).reshape([3, 2]), 0,
+                    np.inf)
+    cache_dir = tempfile.mkdtemp()
+    try:
+      for _ in range(2):
+        output = prepare(model, cache_dir=cache_dir).run(X)
+        np.testing.assert_almost_equal(output.Y, Y_ref)
+      entries = os.listdir(cache_dir)
+      self.assertEqual(len(entries), 1)
+
+      # A corrupt entry is evicted and rebuilt.
+      with open(os.path.join(cache_dir, entries[0], "graph.pb"), "wb") as f:
+        f.write(b"corrupt")
+      output = prepare(model, cache_dir=cache_dir).run(X)
+      np.testing.assert_almost_equal(output.Y, Y_ref)
+      output = prepare(model, cache_dir=cache_dir).run(X)
+      np.testing.assert_almost_equal(output.Y, Y_ref)
+
+      # Entries beyond the size cap are evicted.
+      prepare(model, cache_dir=cache_dir, cache_max_bytes=0)
+      self.assertEqual(os.listdir(cache_dir), [])
+
+      # Graphs calling Python functions are not cached.
+      pad_model = helper.make_model(
+          helper.make_graph(
+              [helper.make_node("Pad", ["X"], ["Y"], mode="edge",
+                                pads=[1, 1, 1, 1])],
+              name="test_prepare_cache_py_func",
+              inputs=[
+                  helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2])
+              ],
+              outputs=[
+                  helper.make_tensor_value_info("Y", TensorProto.FLOAT, [5, 4])
+              ]))
+      output = prepare(pad_model, cache_dir=cache_dir).run(X)
+      np.testing.assert_almost_equal(output.Y, np.pad(X, 1, "edge"))
+      self.assertEqual(os.listdir(cache_dir), [])
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_initializers_as_variables(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    weight = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [helper.make_node("Mul", ["X", "weight"], ["Y"])],
+        name="test_initializers_as_variables",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2]),
+            helper.make_tensor_value_info("weight", TensorProto.FLOAT, [3, 2])
+        ],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 2])],
+        initializer=[onnx.numpy_helper.from_array(weight, "weight")])
+    model = helper.make_model(graph_def)
+    export_dir = tempfile.mkdtemp()
+    try:
+      for cache_dir in [None, export_dir, export_dir]:
+        tf_rep = prepare(
+            model, cache_dir=cache_dir, initializers_as_variables=True)
+        output = tf_rep.run(X)
+        np.testing.assert_almost_equal(output.Y, X * weight)
+        # A new session assigns the variables again.
+        tf_rep.close()
+        np.testing.assert_almost_equal(tf_rep.run(X).Y, X * weight)
+
+      # The saver is part of the converted graph, the cached one included:
+      # exporting does not add ops to it.
+      num_ops = len(tf_rep.predict_net.graph.get_operations())
+      path = os.path.join(export_dir, "model.pb")
+      tf_rep.export_graph(path)
+      self.assertEqual(
+          len(tf_rep.predict_net.graph.get_operations()), num_ops)
+      graph_def = tf.GraphDef()
+      with open(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+      # The weights are not baked into the graph.
+      const_shapes = [[d.size for d in n.attr["value"].tensor.tensor_shape.dim]
+                      for n in graph_def.node if n.op == "Const"]
+      self.assertNotIn([3, 2], const_shapes)
+      reader = tf.train.NewCheckpointReader(path + ".ckpt")
+      np.testing.assert_almost_equal(reader.get_tensor("weight"), weight)
+    finally:
+      shutil.rmtree(export_dir)
+
+  def test_optimize_layout(self):
+    X = np.random.randn(2, 3, 8, 8).astype(np.float32)
+    W1 = np.random.randn(4, 3, 3, 3).astype(np.float32)
+    W2 = np.random.randn(4, 4, 3, 3).astype(np.float32)
+    B = np.random.randn(4).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node(
+                "Conv", ["X", "W1", "B"], ["C1"],
+                kernel_shape=[3, 3],
+                pads=[1, 1, 1, 1]),
+            helper.make_node("Relu", ["C1"], ["R1"]),
+            helper.make_node(
+                "MaxPool", ["R1"], ["P1"],
+                kernel_shape=[3, 3],
+                pads=[1, 1, 1, 1],
+                strides=[2, 2]),
+            helper.make_node(
+                "Conv", ["P1", "W2"], ["C2"],
+                kernel_shape=[3, 3],
+                pads=[1, 1, 1, 1]),
+            helper.make_node("Add", ["C2", "P1"], ["A2"]),
+            helper.make_node("Sigmoid", ["A2"], ["S2"]),
+            helper.make_node("Flatten", ["S2"], ["Y"], axis=1),
+        ],
+        name="test_optimize_layout",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                          [2, 3, 8, 8]),
+            helper.make_tensor_value_info("W1", TensorProto.FLOAT,
+                                          [4, 3, 3, 3]),
+            helper.make_tensor_value_info("W2", TensorProto.FLOAT,
+                                          [4, 4, 3, 3]),
+            helper.make_tensor_value_info("B", TensorProto.FLOAT, [4]),
+        ],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                               [2, 64])],
+        initializer=[
+            onnx.numpy_helper.from_array(W1, "W1"),
+            onnx.numpy_helper.from_array(W2, "W2"),
+            onnx.numpy_helper.from_array(B, "B"),
+        ])
+    model = helper.make_model(graph_def)
+
+    def count_transposes(tf_rep):
+      return len([
+          op for op in tf_rep.predict_net.graph.get_operations()
+          if op.type == "Transpose"
+      ])
+
+    tf_rep = prepare(model)
+    optimized_tf_rep = prepare(model, optimize_layout=True)
+    np.testing.assert_almost_equal(
+        optimized_tf_rep.run(X).Y, tf_rep.run(X).Y, decimal=4)
+    # The activations are transposed once on the way in and once on the
+    # way out instead of around every layout sensitive op.
+    self.assertLess(
+        count_transposes(optimized_tf_rep), count_transposes(tf_rep))
+
+  def test_device_plan(self):
+    self.assertIs(TensorflowBackendBase.get_device_plan("CPU"),
+                  TensorflowBackendBase.get_device_plan("CPU"))
+    self.assertTrue(
+        TensorflowBackendBase.get_device_plan("CUDA:1").support_cuda)
+
+    graph_def = helper.make_graph(
+        [
+            helper.make_node(
+                "Conv", ["X", "W"], ["Y"], kernel_shape=[3, 3],
+                pads=[1, 1, 1, 1])
+        ],
+        name="test_device_plan",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                          [1, 2, 5, 5]),
+            helper.make_tensor_value_info("W", TensorProto.FLOAT,
+                                          [2, 2, 3, 3]),
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                          [1, 2, 5, 5])
+        ])
+    model = helper.make_model(graph_def)
+    # The layout follows the targeted device, not the devices of the host.
+    for device, data_format in [("CPU", b"NHWC"), ("CUDA", b"NCHW")]:
+      predict_net = prepare(model, device=device).predict_net
+      convs = [
+          op for op in predict_net.graph.get_operations()
+          if op.type == "Conv2D"
+      ]
+      self.assertEqual([op.get_attr("data_format") for op in convs],
+                       [data_format])
+
+  def test_device_placement(self):
+    X = np.random.randn(2, 3).astype(np.float32)
+    graph_def = helper.make_graph(
+        [helper.make_node("Relu", ["X"], ["Y"])],
+        name="test_device_placement",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [2, 3])],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [2, 3])])
+    model = helper.make_model(graph_def)
+    for device in ["CPU:1", "/device:CPU:1"]:
+      with prepare(model, device=device) as tf_rep:
+        graph = tf_rep.predict_net.graph
+        self.assertEqual(
+            set(op.device for op in graph.get_operations()),
+            set(["/device:CPU:1"]))
+        # The session creates the second CPU device the graph is pinned to.
+        np.testing.assert_almost_equal(tf_rep.run(X).Y, np.maximum(X, 0))
+
+    node_def = helper.make_node("Relu", ["X"], ["Y"])
+    np.testing.assert_almost_equal(
+        run_node(node_def, [X], device="CPU:1").Y, np.maximum(X, 0))
+
+    # Ops the device has no kernel for, or devices the host does not have,
+    # fall back to the CPU.
+    with prepare(model, device="CUDA") as tf_rep:
+      np.testing.assert_almost_equal(tf_rep.run(X).Y, np.maximum(X, 0))
+    node_def = helper.make_node("Pad", ["X"], ["Y"], mode="edge",
+                                pads=[1, 1, 1, 1])
+    np.testing.assert_almost_equal(
+        run_node(node_def, [X], device="CUDA").Y, np.pad(X, 1, "edge"))
+
+  def test_fold_batch_norm(self):
+    X = np.random.randn(2, 3, 8, 8).astype(np.float32)
+    W = np.random.randn(4, 3, 3, 3).astype(np.float32)
+    B = np.random.randn(4).astype(np.float32)
+    scale = np.random.randn(4).astype(np.float32)
+    bias = np.random.randn(4).astype(np.float32)
+    mean = np.random.randn(4).astype(np.float32)
+    var = np.random.rand(4).astype(np.float32) + 0.5
+    graph_def = helper.make_graph(
+        [
+            helper.make_node(
+                "Conv", ["X", "W", "B"], ["C"],
+                kernel_shape=[3, 3],
+                pads=[1, 1, 1, 1]),
+            helper.make_node(
+                "BatchNormalization", ["C", "scale", "bias", "mean", "var"],
+                ["Y"],
+                is_test=1,
+                epsilon=1e-3),
+        ],
+        name="test_fold_batch_norm",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                          [2, 3, 8, 8])
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                          [2, 4, 8, 8])
+        ],
+        initializer=[
+            onnx.numpy_helper.from_array(W, "W"),
+            onnx.numpy_helper.from_array(B, "B"),
+            onnx.numpy_helper.from_array(scale, "scale"),
+            onnx.numpy_helper.from_array(bias, "bias"),
+            onnx.numpy_helper.from_array(mean, "mean"),
+            onnx.numpy_helper.from_array(var, "var"),
+        ])
+    model = helper.make_model(graph_def)
+
+    graph = GraphView(model.graph)
+    self.assertEqual(fold_batch_normalization(graph), 1)
+    self.assertEqual([node.op_type for node in graph.node], ["Conv"])
+    self.assertEqual(len(graph.initializer), 2)
+    # The model itself is left untouched.
+    self.assertEqual(len(model.graph.node), 2)
+
+    reference = prepare(model, fold_batch_norm=False).run(X).Y
+    output = prepare(model).run(X).Y
+    np.testing.assert_almost_equal(output, reference, decimal=4)
+    # Listing the Conv output keeps it from being folded.
+    tf_rep = prepare(model, outputs=["C", "Y"])
+    self.assertIn("C", tf_rep.predict_net.tensor_dict)
+
+    # A cache hit only asks prepare for the folded graph when the folded
+    # weights are variables.
+    cache_dir = tempfile.mkdtemp()
+    opset = model.opset_import[0].version
+    try:
+      cache = PrepareCache(cache_dir)
+      for initializers_as_variables, expected_calls in [(False, 0), (True, 1)]:
+        graph = GraphView(model.graph)
+        fold_batch_normalization(graph)
+        key = cache.get_key(
+            model, opset, None,
+            {"initializers_as_variables": initializers_as_variables})
+        cache.store(key,
+                    TensorflowBackendBase.onnx_graph_to_tensorflow_net(
+                        graph,
+                        opset=opset,
+                        initializers_as_variables=initializers_as_variables))
+        calls = []
+        self.assertIsNotNone(
+            cache.load(key, lambda: calls.append(graph) or graph))
+        self.assertEqual(len(calls), expected_calls)
+
+        for _ in range(2):
+          output = prepare(
+              model,
+              cache_dir=cache_dir,
+              initializers_as_variables=initializers_as_variables).run(X).Y
+          np.testing.assert_almost_equal(output, reference, decimal=4)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_handler_registry(self):
+    get_handler = TensorflowBackendBase._get_handler
+    handler = get_handler("BatchNormalization", 7)
+    self.assertIs(get_handler("BatchNormalization", 7), handler)
+    self.assertIn(("BatchNormalization", 7),
+                  TensorflowBackendBase.handler_registry)
+    self.assertIn("backend_v6", handler.__module__)
+    self.assertIn("backend_v1",
+                  get_handler("BatchNormalization", 5).__module__)
+    self.assertRaises(NotImplementedError, get_handler, "ATen", 1)
+
+  def test_prune_unreachable(self):
+    X = np.random.randn(2, 3).astype(np.float32)
+    Y = np.random.randn(2, 3).astype(np.float32)
+    weight = np.random.randn(2, 3).astype(np.float32)
+    unused = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node("Add", ["X", "weight"], ["A"]),
+            helper.make_node("Relu", ["A"], ["Z"]),
+            helper.make_node("Mul", ["Y", "unused"], ["debug"]),
+            helper.make_node("Neg", ["debug"], ["debug_neg"]),
+        ],
+        name="test_prune_unreachable",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [2, 3]),
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [2, 3]),
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Z", TensorProto.FLOAT, [2, 3])
+        ],
+        initializer=[
+            onnx.numpy_helper.from_array(weight, "weight"),
+            onnx.numpy_helper.from_array(unused, "unused"),
+        ])
+    model = helper.make_model(graph_def)
+
+    tf_rep = prepare(model)
+    self.assertEqual(tf_rep.predict_net.external_input, ["X", "Y"])
+    self.assertNotIn("debug_neg", tf_rep.predict_net.tensor_dict)
+    self.assertNotIn("unused", tf_rep.predict_net.tensor_dict)
+    np.testing.assert_almost_equal(
+        tf_rep.run([X, Y]).Z, np.maximum(X + weight, 0))
+
+    tf_rep = prepare(model, outputs=["A"])
+    self.assertEqual(tf_rep.predict_net.external_input, ["X"])
+    self.assertEqual(tf_rep.predict_net.external_output, ["A"])
+    self.assertNotIn("Z", tf_rep.predict_net.tensor_dict)
+    np.testing.assert_almost_equal(tf_rep.run(X).A, X + weight)
+
+    self.assertRaises(ValueError, prepare, model, outputs=["missing"])
+
+  def test_session_options(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [helper.make_node("Relu", ["X"], ["Y"])],
+        name="test_session_options",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2])],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 2])
+        ])
+    model = helper.make_model(graph_def)
+    tf_rep = prepare(
+        model,
+        session_preset="memory",
+        session_options={"inter_op_parallelism_threads": 2})
+    self.assertEqual(tf_rep.session_options["inter_op_parallelism_threads"],
+                     2)
+    np.testing.assert_almost_equal(tf_rep.run(X)["Y"], np.maximum(X, 0))
+    config = make_session_config(tf_rep.session_options)
+    self.assertEqual(config.inter_op_parallelism_threads, 2)
+    rewrite_options = config.graph_options.rewrite_options
+    self.assertEqual(rewrite_options.constant_folding,
+                     rewrite_options.OFF)
+    self.assertEqual(rewrite_options.memory_optimization,
+                     rewrite_options.HEURISTICS)
+    self.assertEqual(
+        make_session_config({"jit": True}).graph_options.optimizer_options.
+        global_jit_level, tf.OptimizerOptions.ON_1)
+
+    # New options apply to the next session.
+    sess = tf_rep.sess
+    tf_rep.session_options = get_session_options("latency")
+    self.assertIsNot(tf_rep.sess, sess)
+    np.testing.assert_almost_equal(tf_rep.run(X)["Y"], np.maximum(X, 0))
+
+    self.assertRaises(ValueError, prepare, model, session_preset="fastest")
+    self.assertRaises(
+        ValueError, prepare, model, session_options={"threads": 2})
+    self.assertRaises(
+        ValueError,
+        make_session_config,
+        {"rewrite_options": {"constant_folding": "MAYBE"}})
+
+  def test_autotune(self):
+    X = np.random.randn(3, 2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [helper.make_node("Relu", ["X"], ["Y"])],
+        name="test_autotune",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [-1, 2])
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [-1, 2])
+        ])
+    model = helper.make_model(graph_def)
+    cache_dir = tempfile.mkdtemp()
+    try:
+      tf_rep = prepare(model, cache_dir=cache_dir)
+      trials = tf_rep.autotune(X, budget_seconds=0.1, batch_sizes=[1, 8])
+      self.assertEqual(
+          len(trials),
+          2 * len(onnx_tf.autotune.get_thread_configs()))
+      best = trials[0]
+      self.assertEqual(best.throughput,
+                       max(trial.throughput for trial in trials))
+      self.assertEqual(tf_rep.session_options, best.session_options)
+      np.testing.assert_almost_equal(tf_rep.run(X)["Y"], np.maximum(X, 0))
+
+      # Later prepares of the model start with the tuned options.
+      self.assertEqual(
+          prepare(model, cache_dir=cache_dir).session_options,
+          best.session_options)
+      tf_rep = prepare(
+          model, cache_dir=cache_dir,
+          session_options={"inter_op_parallelism_threads": 3})
+      self.assertEqual(tf_rep.session_options["inter_op_parallelism_threads"],
+                       3)
+      self.assertEqual(tf_rep.session_options["intra_op_parallelism_threads"],
+                       best.session_options["intra_op_parallelism_threads"])
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_micro_batcher(self):
+    graph_def = helper.make_graph(
+        [helper.make_node("Relu", ["X"], ["Y"])],
+        name="test_micro_batcher",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [-1, -1])
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [-1, -1])
+        ])
+    tf_rep = prepare(helper.make_model(graph_def))
+    batch_sizes = []
+    run = tf_rep.run
+
+    def counting_run(inputs, **kwargs):
+      batch_sizes.append(len(inputs[0]))
+      return run(inputs, **kwargs)
+
+    tf_rep.run = counting_run
+
+    def run_clients(batcher, inputs):
+      results = [None] * len(inputs)
+
+      def client(i):
+        results[i] = batcher.run(inputs[i])
+
+      threads = [
+          threading.Thread(target=client, args=(i,))
+          for i in range(len(inputs))
+      ]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      return results
+
+    # Requests of one shape are run as one batch, split back per caller.
+    inputs = [
+        np.random.randn(rows, 3).astype(np.float32) for rows in [1, 2, 1, 3]
+    ]
+    with MicroBatcher(tf_rep, max_batch_size=7, max_latency_ms=10000) as b:
+      results = run_clients(b, inputs)
+    self.assertEqual(batch_sizes, [7])
+    for x, result in zip(inputs, results):
+      np.testing.assert_almost_equal(result["Y"], np.maximum(x, 0))
+
+    # Requests of other shapes are bucketed apart, or padded together.
+    inputs = [np.random.randn(1, width).astype(np.float32)
+              for width in [2, 3, 2, 3]]
+    del batch_sizes[:]
+    with MicroBatcher(tf_rep, max_batch_size=2, max_latency_ms=10000) as b:
+      results = run_clients(b, inputs)
+    self.assertEqual(batch_sizes, [2, 2])
+    for x, result in zip(inputs, results):
+      np.testing.assert_almost_equal(result["Y"], np.maximum(x, 0))
+
+    del batch_sizes[:]
+    with MicroBatcher(
+        tf_rep, max_batch_size=4, max_latency_ms=10000, pad=True) as b:
+      results = run_clients(b, inputs)
+    self.assertEqual(batch_sizes, [4])
+    for x, result in zip(inputs, results):
+      self.assertEqual(result["Y"].shape, (1, 3))
+      np.testing.assert_almost_equal(result["Y"][:, :x.shape[1]],
+                                     np.maximum(x, 0))
+
+  def test_run_iter(self):
+    samples = [np.random.randn(2).astype(np.float32) for _ in range(10)]
+    for batch_size in [-1, 4]:
+      graph_def = helper.make_graph(
+          [helper.make_node("Relu", ["X"], ["Y"])],
+          name="test_run_iter",
+          inputs=[
+              helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                            [batch_size, 2])
+          ],
+          outputs=[
+              helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                            [batch_size, 2])
+          ])
+      tf_rep = prepare(helper.make_model(graph_def))
+      results = list(
+          tf_rep.run_iter(iter(samples), batch_size=4, prefetch=1))
+      self.assertEqual(len(results), len(samples))
+      for x, result in zip(samples, results):
+        np.testing.assert_almost_equal(result["Y"], np.maximum(x, 0))
+
+    # Samples are read lazily and stopping early stops the reader.
+    def generate():
+      for i in range(1000):
+        read.append(i)
+        yield samples[0]
+
+    read = []
+    results = tf_rep.run_iter(generate(), batch_size=4, prefetch=1)
+    next(results)
+    results.close()
+    self.assertLess(len(read), 1000)
+
+    def fail():
+      yield samples[0]
+      raise IOError("unreadable sample")
+
+    self.assertRaises(IOError, list, tf_rep.run_iter(fail(), batch_size=4))
+
+  def test_run_pipeline(self):
+    X = np.random.randn(10, 2).astype(np.float32)
+    B = np.random.randn(2).astype(np.float32)
+    graph_def = helper.make_graph(
+        [helper.make_node("Add", ["X", "B"], ["Y"], broadcast=1)],
+        name="test_run_pipeline",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [-1, 2]),
+            helper.make_tensor_value_info("B", TensorProto.FLOAT, [2])
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [-1, 2])
+        ],
+        initializer=[helper.make_tensor("B", TensorProto.FLOAT, [2], B)])
+    tf_rep = prepare(
+        helper.make_model(graph_def), initializers_as_variables=True)
+
+    source_dir = tempfile.mkdtemp()
+    try:
+      np.save(os.path.join(source_dir, "X.npy"), X)
+      # .npy files are read with their own type and byte order.
+      big_endian_path = os.path.join(source_dir, "X_big_endian.npy")
+      np.save(big_endian_path, X.astype(">f8"))
+      npz_path = os.path.join(source_dir, "inputs.npz")
+      np.savez(npz_path, X=X)
+      tfrecord_path = os.path.join(source_dir, "inputs.tfrecord")
+      with tf.python_io.TFRecordWriter(tfrecord_path) as writer:
+        for x in X:
+          example = tf.train.Example(features=tf.train.Features(
+              feature={
+                  "X": tf.train.Feature(
+                      float_list=tf.train.FloatList(value=x))
+              }))
+          writer.write(example.SerializeToString())
+
+      for source in [{"X": X}, source_dir, npz_path, tfrecord_path,
+                     {"X": np.load(big_endian_path, mmap_mode="r")}]:
+        batches = list(tf_rep.run_pipeline(source, batch_size=4))
+        self.assertEqual([len(batch["Y"]) for batch in batches], [4, 4, 2])
+        np.testing.assert_almost_equal(
+            np.concatenate([batch["Y"] for batch in batches]), X + B)
+    finally:
+      shutil.rmtree(source_dir)
+
+  def test_run_chunks(self):
+    X = np.random.randn(10, 3).astype(np.float32)
+    W = np.random.randn(3, 4).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node("MatMul", ["X", "W"], ["XW"]),
+            helper.make_node("Relu", ["XW"], ["Y"])
+        ],
+        name="test_run_chunks",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [-1, 3]),
+            helper.make_tensor_value_info("W", TensorProto.FLOAT, [3, 4])
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [-1, 4])
+        ],
+        initializer=[
+            helper.make_tensor("W", TensorProto.FLOAT, [3, 4], W.flatten())
+        ])
+    model = helper.make_model(graph_def)
+    Y_ref = prepare(model).run(X)["Y"]
+    for options in [{"max_batch_per_call": 4},
+                    {"memory_budget_bytes": 100}]:
+      tf_rep = prepare(model, **options)
+      np.testing.assert_almost_equal(tf_rep.run(X)["Y"], Y_ref, decimal=5)
+      self.assertLess(tf_rep._get_chunk_size(("Y",)), len(X))
+
+    # Inputs with a static first dimension are not split: a graph with a
+    # static batch runs unchunked, a bias input is fed whole to every chunk.
+    B = np.random.randn(3).astype(np.float32)
+    for batch_dim, X_batch in [[1, X[:1]], [-1, X]]:
+      graph_def = helper.make_graph(
+          [helper.make_node("Add", ["X", "B"], ["Y"], broadcast=1)],
+          name="test_run_chunks_static",
+          inputs=[
+              helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                            [batch_dim, 3]),
+              helper.make_tensor_value_info("B", TensorProto.FLOAT, [3])
+          ],
+          outputs=[
+              helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                            [batch_dim, 3])
+          ])
+      tf_rep = prepare(helper.make_model(graph_def), max_batch_per_call=4)
+      np.testing.assert_almost_equal(
+          tf_rep.run([X_batch, B])["Y"], X_batch + B)
+
+    # The batch is followed through the reshapes and transposes of a
+    # grouped 1x1 Conv, which keeps its rows independent.
+    X = np.random.randn(10, 4, 3, 3).astype(np.float32)
+    W = np.random.randn(6, 2, 1, 1).astype(np.float32)
+    graph_def = helper.make_graph(
+        [
+            helper.make_node(
+                "Conv", ["X", "W"], ["Y"], kernel_shape=[1, 1], group=2)
+        ],
+        name="test_run_chunks_grouped_conv",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT,
+                                          [-1, 4, 3, 3]),
+            helper.make_tensor_value_info("W", TensorProto.FLOAT,
+                                          [6, 2, 1, 1])
+        ],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT,
+                                          [-1, 6, 3, 3])
+        ],
+        initializer=[onnx.numpy_helper.from_array(W, "W")])
+    model = helper.make_model(graph_def)
+    tf_rep = prepare(model, max_batch_per_call=4)
+    np.testing.assert_almost_equal(
+        tf_rep.run(X)["Y"], prepare(model).run(X)["Y"], decimal=5)
+
+    # Graphs mixing rows are rejected by their shapes.
+    graph_def = helper.make_graph(
+        [helper.make_node("ReduceSum", ["X"], ["Y"], axes=[0])],
+        name="test_run_chunks_mixing",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [-1, 2])],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [])])
+    tf_rep = prepare(helper.make_model(graph_def), max_batch_per_call=2)
+    self.assertRaises(ValueError, tf_rep.run,
+                      np.random.randn(10, 2).astype(np.float32))
+
+    # Mixes the shapes do not show are caught by running rows apart, on
+    # request.
+    graph_def = helper.make_graph(
+        [helper.make_node("Reshape", ["X", "shape"], ["Y"])],
+        name="test_run_chunks_mixing_dynamic",
+        inputs=[
+            helper.make_tensor_value_info("X", TensorProto.FLOAT, [-1, -1]),
+            helper.make_tensor_value_info("shape", TensorProto.INT64, [2])
+        ],
+        outputs=[helper.make_tensor_value_info("Y", TensorProto.FLOAT, [])],
+        initializer=[
+            helper.make_tensor("shape", TensorProto.INT64, [2], [-1, 4])
+        ])
+    tf_rep = prepare(helper.make_model(graph_def), max_batch_per_call=2)
+    tf_rep.check_chunk_rows = True
+    self.assertRaises(ValueError, tf_rep.run,
+                      np.random.randn(10, 2).astype(np.float32))
+
+  @unittest.skipIf(sys.version_info < (3, 5), "run_async needs asyncio")
+  def test_run_async(self):
+    import asyncio
+    graph_def = helper.make_graph(
+        [helper.make_node("Relu", ["X"], ["Y"])],
+        name="test_run_async",
+        inputs=[helper.make_tensor_value_info("X", TensorProto.FLOAT, [3, 2])],
+        outputs=[
+            helper.make_tensor_value_info("Y", TensorProto.FLOAT, [3, 2])
+        ])
+    inputs = [np.random.randn(3, 2).astype(np.float32) for _ in range(16)]
+    loop = asyncio.new_event_loop()
+    try:
+      with prepare(helper.make_model(graph_def)) as tf_rep:
+        tf_rep.async_max_workers = 2
+        tf_rep.async_queue_depth = 3
+        num_threads = threading.active_count()
+        tasks = [
+            loop.create_task(tf_rep.run_async(x, timeout_ms=10000))
+            for x in inputs
+        ]
+        results = loop.run_until_complete(asyncio.gather(*tasks))
+        for x, result in zip(inputs, results):
+          np.testing.assert_almost_equal(result["Y"], np.maximum(x, 0))
+        # The calls share the threads of the runner.
+        self.assertLessEqual(threading.active_count() - num_threads, 2)
+
+        # Closing while calls run or wait for a slot: the running calls
+        # complete on the old session, the waiting ones on a new one.
+        tasks = [
+            loop.create_task(tf_rep.run_async(x, timeout_ms=10000))
+            for x in inputs
+        ]
+        loop.run_until_complete(asyncio.sleep(0.01))
+        tf_rep.close()
+        results = loop.run_until_complete(asyncio.gather(*tasks))
+        for x, result in zip(inputs, results):
+          np.testing.assert_almost_equal(result["Y"], np.maximum(x, 0))
+    finally:
+      loop.close()
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -7,6 +7,7 @@ import unittest
 import numpy as np
 import tensorflow as tf
 from onnx_tf.backend import run_node
+from onnx_tf.backend import run_nodes
 from onnx_tf.backend import supports_device
 from onnx import helper
 from onnx.onnx_pb2 import TensorProto
@@ -221,6 +222,53 @@ class TestNode(unittest.TestCase):
 
     np.testing.assert_almost_equal(output["Y"], test_output, decimal=5)
 
+  def _grouped_conv(self, x, weights, group, strides, pads):
+    # Reference grouped convolution, NCHW input and MCHW weights.
+    pad_width = [(0, 0), (0, 0), (pads[0], pads[2]), (pads[1], pads[3])]
+    x = np.pad(x, pad_width, mode="constant")
+    kernel_h, kernel_w = weights.shape[2:]
+    out_h = (x.shape[2] - kernel_h) // strides[0] + 1
+    out_w = (x.shape[3] - kernel_w) // strides[1] + 1
+    in_group, out_group = weights.shape[1], weights.shape[0] // group
+    y = np.zeros([x.shape[0], weights.shape[0], out_h, out_w])
+    for m in range(weights.shape[0]):
+      g = m // out_group
+      x_g = x[:, g * in_group:(g + 1) * in_group]
+      for i in range(out_h):
+        for j in range(out_w):
+          window = x_g[:, :, i * strides[0]:i * strides[0] + kernel_h,
+                       j * strides[1]:j * strides[1] + kernel_w]
+          y[:, m, i, j] = np.sum(window * weights[m], axis=(1, 2, 3))
+    return y
+
+  def test_grouped_conv(self):
+    x = self._get_rnd([2, 6, 7, 7])
+    # (group, weight shape, strides, pads): depthwise with a channel
+    # multiplier, grouped pointwise, grouped 3x3.
+    cases = [
+        (6, [12, 1, 3, 3], [2, 2], [1, 1, 1, 1]),
+        (3, [9, 2, 1, 1], [2, 2], [0, 0, 0, 0]),
+        (2, [4, 3, 3, 3], [1, 1], [1, 0, 0, 1]),
+    ]
+    nodes_and_inputs = []
+    for group, weight_shape, strides, pads in cases:
+      weights = self._get_rnd(weight_shape)
+      bias = self._get_rnd(weight_shape[:1])
+      node_def = helper.make_node(
+          "Conv", ["X", "weights", "bias"], ["Y"],
+          group=group,
+          kernel_shape=weight_shape[2:],
+          strides=strides,
+          pads=pads)
+      nodes_and_inputs.append((node_def, [x, weights, bias]))
+    outputs = run_nodes(nodes_and_inputs)
+    for (group, _, strides, pads), (_, inputs), output in zip(
+        cases, nodes_and_inputs, outputs):
+      _, weights, bias = inputs
+      test_output = self._grouped_conv(x, weights, group, strides,
+                                       pads) + bias.reshape([1, -1, 1, 1])
+      np.testing.assert_almost_equal(output["Y"], test_output, decimal=4)
+
   def test_conv_transpose(self):
     # Fix test in the future.
     return
@@ -506,6 +554,47 @@ class TestNode(unittest.TestCase):
               max(x[i1][i2][j1][2*j2], x[i1][i2][j1][2*j2 + 1])
     np.testing.assert_almost_equal(output["Y"], test_output)
 
+  def _pool_with_pads(self, x, kernel_shape, strides, pads, pool_func):
+    # Reference pooling that ignores the padded (NaN) elements.
+    pad_width = [(0, 0), (0, 0), (pads[0], pads[2]), (pads[1], pads[3])]
+    padded = np.pad(x, pad_width, mode="constant", constant_values=np.nan)
+    out_h = (padded.shape[2] - kernel_shape[0]) // strides[0] + 1
+    out_w = (padded.shape[3] - kernel_shape[1]) // strides[1] + 1
+    y = np.zeros(list(x.shape[:2]) + [out_h, out_w], dtype=np.float32)
+    for i in range(out_h):
+      for j in range(out_w):
+        window = padded[:, :, i * strides[0]:i * strides[0] + kernel_shape[0],
+                        j * strides[1]:j * strides[1] + kernel_shape[1]]
+        y[:, :, i, j] = pool_func(window.reshape(x.shape[:2] + (-1,)), axis=2)
+    return y
+
+  def test_pool_with_pads(self):
+    x = self._get_rnd([2, 3, 9, 8])
+    for op_type, pool_func in [("MaxPool", np.nanmax),
+                               ("AveragePool", np.nanmean)]:
+      node_def = helper.make_node(
+          op_type, ["X"], ["Y"],
+          kernel_shape=[3, 2],
+          pads=[2, 0, 1, 1],
+          strides=[2, 1])
+      output = run_node(node_def, [x])
+      np.testing.assert_almost_equal(
+          output["Y"],
+          self._pool_with_pads(x, [3, 2], [2, 1], [2, 0, 1, 1], pool_func),
+          decimal=5)
+
+      # SAME_LOWER puts the odd padding element at the beginning.
+      node_def = helper.make_node(
+          op_type, ["X"], ["Y"],
+          kernel_shape=[2, 3],
+          auto_pad="SAME_LOWER",
+          strides=[1, 2])
+      output = run_node(node_def, [x])
+      np.testing.assert_almost_equal(
+          output["Y"],
+          self._pool_with_pads(x, [2, 3], [1, 2], [1, 1, 0, 0], pool_func),
+          decimal=5)
+
   def test_min(self):
     node_def = helper.make_node("Min", ["X1", "X2", "X3", "X4"], ["Z"])
     x1 = self._get_rnd([10, 10])